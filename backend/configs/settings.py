@@ -13,6 +13,8 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -47,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'message.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -77,20 +80,179 @@ TEMPLATES = [
 WSGI_APPLICATION = 'configs.wsgi.application'
 
 
+# Settings profile: 'full' is the stack above, admin included; 'api' serves
+# only the JSON API. It drops admin, auth, contrib messages, staticfiles and
+# templates, and keeps the middleware MessageViewSet needs: sessions carry
+# the active user, DRF views are csrf_exempt and nothing reads request.user
+# or renders frames. `python manage.py bench_startup` compares the two
+
+SETTINGS_PROFILE = os.getenv('SETTINGS_PROFILE', 'full')
+
+API_INSTALLED_APPS = [
+    'django.contrib.sessions',
+    'corsheaders',
+    'message',
+]
+
+API_MIDDLEWARE = [
+    'message.middleware.RequestMetricsMiddleware',
+    'corsheaders.middleware.CorsMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+API_REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'UNAUTHENTICATED_USER': None,
+}
+
+if SETTINGS_PROFILE == 'api':
+    INSTALLED_APPS = API_INSTALLED_APPS
+    MIDDLEWARE = API_MIDDLEWARE
+    TEMPLATES = []
+    REST_FRAMEWORK = API_REST_FRAMEWORK
+elif SETTINGS_PROFILE != 'full':
+    raise ImproperlyConfigured(
+        f"SETTINGS_PROFILE must be 'full' or 'api', not {SETTINGS_PROFILE!r}"
+    )
+
+
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# Connections: DATABASE_POOL=True gives each worker process a psycopg 3 pool
+# per database, holding DATABASE_POOL_MIN_SIZE to DATABASE_POOL_MAX_SIZE
+# connections (keep the max at MESSAGE_MAX_CONCURRENT_REQUESTS plus the reply
+# worker threads); a request waits up to DATABASE_POOL_TIMEOUT seconds for one.
+# Without a pool DATABASE_CONN_MAX_AGE keeps each thread's connection open
+# that many seconds ('None': forever, 0: a new one per request). With
+# DATABASE_CONN_HEALTH_CHECKS a reused connection is checked before use, in
+# both modes. message.backends.postgresql times every connect or checkout
+# and /api/metrics shows the pools' size, waiters and checkouts
+
+DATABASE_POOL = os.getenv('DATABASE_POOL', 'False') == 'True'
+
+DATABASE_POOL_OPTIONS = {
+    'min_size': int(os.getenv('DATABASE_POOL_MIN_SIZE', 2)),
+    'max_size': int(os.getenv('DATABASE_POOL_MAX_SIZE', 20)),
+    'timeout': float(os.getenv('DATABASE_POOL_TIMEOUT', 10)),
+}
+
+# Connections the web workers may hold on one database, all of them together
+# (Postgres allows 100 by default; leave room for the reply worker and
+# admin sessions). 0 leaves it to MESSAGE_MAX_CONCURRENT_REQUESTS alone
+
+DATABASE_MAX_CONNECTIONS = int(os.getenv('DATABASE_MAX_CONNECTIONS', 90))
+
+DATABASE_CONN_MAX_AGE = os.getenv('DATABASE_CONN_MAX_AGE') or '0'
+
+DATABASE_CONN_MAX_AGE = None if DATABASE_CONN_MAX_AGE == 'None' else int(DATABASE_CONN_MAX_AGE)
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'message.backends.postgresql',
         'NAME': os.getenv('DATABASE_NAME'),
         'USER': os.getenv('DATABASE_USERNAME'),
         'PASSWORD': os.getenv('DATABASE_PASSWORD'),
         'HOST': os.getenv('DATABASE_HOST'),
         'PORT': os.getenv('DATABASE_PORT'),
+        # Pooled connections go back to the pool instead of persisting
+        'CONN_MAX_AGE': 0 if DATABASE_POOL else DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': os.getenv('DATABASE_CONN_HEALTH_CHECKS', 'True') == 'True',
+        'OPTIONS': {'pool': DATABASE_POOL_OPTIONS} if DATABASE_POOL else {},
     }
 }
 
+# Conversations are hash-sharded by user across 'default' and the databases
+# named in DATABASE_SHARDS (comma-separated). Each one reuses the default
+# credentials unless DATABASE_SHARD_<N>_HOST/_PORT/_USERNAME/_PASSWORD are set.
+# After adding one, run migrate_shards and then rebalance_shards
+
+MESSAGE_SHARDS = ['default']
+
+for number, name in enumerate(filter(None, os.getenv('DATABASE_SHARDS', '').split(',')), start=1):
+    prefix = f'DATABASE_SHARD_{number}_'
+    MESSAGE_SHARDS.append(f'shard_{number}')
+    DATABASES[f'shard_{number}'] = {
+        **DATABASES['default'],
+        'NAME': name.strip(),
+        'HOST': os.getenv(f'{prefix}HOST', DATABASES['default']['HOST']),
+        'PORT': os.getenv(f'{prefix}PORT', DATABASES['default']['PORT']),
+        'USER': os.getenv(f'{prefix}USERNAME', DATABASES['default']['USER']),
+        'PASSWORD': os.getenv(f'{prefix}PASSWORD', DATABASES['default']['PASSWORD']),
+    }
+
+# Read replicas: DATABASE_REPLICAS (for 'default') and DATABASE_SHARD_<N>_REPLICAS
+# list host[:port] entries, each becoming a '<primary>_replica_<M>' alias with
+# the primary's credentials. user_messages and search read from them, except
+# for MESSAGE_REPLICA_STICKY_SECONDS after the session wrote; a replica that
+# errors is skipped for MESSAGE_REPLICA_RETRY_INTERVAL seconds
+
+MESSAGE_REPLICAS = {}
+
+for primary in MESSAGE_SHARDS:
+    variable = 'DATABASE_REPLICAS' if primary == 'default' else f'DATABASE_{primary.upper()}_REPLICAS'
+    MESSAGE_REPLICAS[primary] = []
+    for number, address in enumerate(filter(None, os.getenv(variable, '').split(',')), start=1):
+        host, _, port = address.strip().partition(':')
+        MESSAGE_REPLICAS[primary].append(f'{primary}_replica_{number}')
+        DATABASES[f'{primary}_replica_{number}'] = {
+            **DATABASES[primary],
+            'HOST': host,
+            'PORT': port or DATABASES[primary]['PORT'],
+            'TEST': {'MIRROR': primary},
+        }
+
+MESSAGE_REPLICA_STICKY_SECONDS = float(os.getenv('MESSAGE_REPLICA_STICKY_SECONDS', 10))
+
+MESSAGE_REPLICA_RETRY_INTERVAL = float(os.getenv('MESSAGE_REPLICA_RETRY_INTERVAL', 30))
+
+DATABASE_ROUTERS = ['message.sharding.ShardRouter']
+
+
+# Cache
+# locmem is per process: with several workers point CACHE_BACKEND at a shared
+# backend (e.g. django.core.cache.backends.redis.RedisCache) so history
+# versions bumped by one worker are seen by all of them
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+MESSAGE_HISTORY_CACHE_TIMEOUT = int(os.getenv('MESSAGE_HISTORY_CACHE_TIMEOUT', 300))
+
+
+# Sessions
+# Only 'active_user' lives in the session, so by default it travels in a
+# signed, expiring cookie and API calls never touch the django_session table.
+# 'cache' keeps it server-side in CACHES (shared backend needed with several
+# workers); 'db' is Django's default database-backed store.
+
+SESSION_ENGINES = {
+    'cookie': 'django.contrib.sessions.backends.signed_cookies',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'db': 'django.contrib.sessions.backends.db',
+}
+
+SESSION_MODE = os.getenv('SESSION_MODE', 'cookie')
+
+if SESSION_MODE not in SESSION_ENGINES:
+    raise ImproperlyConfigured(
+        f"SESSION_MODE must be one of {', '.join(map(repr, SESSION_ENGINES))}, "
+        f"not {SESSION_MODE!r}"
+    )
+
+SESSION_ENGINE = SESSION_ENGINES[SESSION_MODE]
+
+SESSION_COOKIE_AGE = int(os.getenv('SESSION_COOKIE_AGE', 60 * 60 * 24 * 14))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -128,6 +290,147 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Serve login, user_messages and send_message from the native async views
+# (message/async_views.py) instead of the DRF ViewSet; meant for ASGI
+
+MESSAGE_ASYNC_VIEWS = os.getenv('MESSAGE_ASYNC_VIEWS', 'False') == 'True'
+
+# Worker processes serving requests (uvicorn --workers in
+# docker-compose.prod.yml); per-process limits are sized against it
+
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', 1))
+
+# Message events (SSE stream)
+# 'message.events.LocalBroker' fans out inside one process; use
+# 'message.events.PostgresBroker' (LISTEN/NOTIFY) with several workers
+
+MESSAGE_EVENTS_BACKEND = os.getenv(
+    'MESSAGE_EVENTS_BACKEND', 'message.events.LocalBroker'
+)
+
+MESSAGE_STREAM_KEEPALIVE = int(os.getenv('MESSAGE_STREAM_KEEPALIVE', 15))
+
+# Largest list accepted by the send_messages batch endpoint
+
+MESSAGE_BATCH_MAX_SIZE = int(os.getenv('MESSAGE_BATCH_MAX_SIZE', 500))
+
+# Bot replies: 'inline' writes them inside send_message, 'queue' hands them
+# to run_reply_worker through the ReplyJob table
+
+MESSAGE_REPLY_MODE = os.getenv('MESSAGE_REPLY_MODE', 'inline')
+
+MESSAGE_REPLY_MAX_ATTEMPTS = int(os.getenv('MESSAGE_REPLY_MAX_ATTEMPTS', 5))
+
+MESSAGE_REPLY_RETRY_BACKOFF = float(os.getenv('MESSAGE_REPLY_RETRY_BACKOFF', 2))
+
+MESSAGE_REPLY_LEASE_SECONDS = int(os.getenv('MESSAGE_REPLY_LEASE_SECONDS', 60))
+
+# Message writes: 'direct' inserts inside send_message; 'buffered' (inline
+# replies only) fsyncs them to a spill file in MESSAGE_BUFFER_DIR, answers,
+# and bulk-inserts every MESSAGE_BUFFER_FLUSH_SIZE messages or
+# MESSAGE_BUFFER_FLUSH_INTERVAL milliseconds. Spill files of a crashed worker
+# are loaded by the next one to start, or by recover_message_buffer. Unflushed
+# messages are only readable by the process holding them, so buffered mode
+# refuses to start with WEB_CONCURRENCY above 1
+
+MESSAGE_WRITE_MODE = os.getenv('MESSAGE_WRITE_MODE', 'direct')
+
+MESSAGE_BUFFER_DIR = os.getenv('MESSAGE_BUFFER_DIR') or BASE_DIR / 'spill'
+
+MESSAGE_BUFFER_FLUSH_SIZE = int(os.getenv('MESSAGE_BUFFER_FLUSH_SIZE', 500))
+
+MESSAGE_BUFFER_FLUSH_INTERVAL = int(os.getenv('MESSAGE_BUFFER_FLUSH_INTERVAL', 200))
+
+# Bot response rules (JSON), reloaded when the file changes
+
+MESSAGE_RULES_FILE = os.getenv('MESSAGE_RULES_FILE') or BASE_DIR / 'message' / 'rules.json'
+
+MESSAGE_RULES_RELOAD_INTERVAL = float(os.getenv('MESSAGE_RULES_RELOAD_INTERVAL', 5))
+
+# Message retention. On PostgreSQL `partition_messages --convert` splits the
+# message table into monthly partitions by created_at; prune_messages then
+# archives expired months as gzipped CSV in MESSAGE_ARCHIVE_DIR and drops
+# them, and deletes other expired rows in chunks (the only path elsewhere).
+# MESSAGE_RETENTION_DAYS=0 keeps everything
+
+MESSAGE_PARTITION_MONTHS_AHEAD = int(os.getenv('MESSAGE_PARTITION_MONTHS_AHEAD', 3))
+
+MESSAGE_RETENTION_DAYS = int(os.getenv('MESSAGE_RETENTION_DAYS', 0))
+
+MESSAGE_ARCHIVE_DIR = os.getenv('MESSAGE_ARCHIVE_DIR') or BASE_DIR / 'archive'
+
+MESSAGE_RETENTION_CHUNK_SIZE = int(os.getenv('MESSAGE_RETENTION_CHUNK_SIZE', 5000))
+
+# Message count rollups behind /api/message/stats/ (message/stats.py). Writes
+# add to counters spread over MESSAGE_STATS_SLOTS rows each, so concurrent
+# senders don't wait on one row lock; reconcile_stats recounts each hour
+# once it is MESSAGE_STATS_SETTLE_SECONDS in the past
+
+MESSAGE_STATS_SLOTS = int(os.getenv('MESSAGE_STATS_SLOTS', 8))
+
+MESSAGE_STATS_SETTLE_SECONDS = int(os.getenv('MESSAGE_STATS_SETTLE_SECONDS', 300))
+
+# Rate limits per action, "<requests>/<period>" (s, m, h or d): token
+# buckets in CACHES for each session user ('user') and each client IP ('ip'),
+# so with several workers CACHE_BACKEND must be shared. Throttled requests get
+# a 429 with Retry-After; an empty rate disables that bucket
+
+MESSAGE_RATE_LIMITS = {
+    'login': {
+        'ip': os.getenv('MESSAGE_RATE_LIMIT_LOGIN_IP', '30/m'),
+    },
+    'send_message': {
+        'user': os.getenv('MESSAGE_RATE_LIMIT_SEND_MESSAGE', '60/m'),
+        'ip': os.getenv('MESSAGE_RATE_LIMIT_SEND_MESSAGE_IP', '120/m'),
+    },
+    'send_messages': {
+        'user': os.getenv('MESSAGE_RATE_LIMIT_SEND_MESSAGES', '10/m'),
+        'ip': os.getenv('MESSAGE_RATE_LIMIT_SEND_MESSAGES_IP', '20/m'),
+    },
+    'user_messages': {
+        'user': os.getenv('MESSAGE_RATE_LIMIT_USER_MESSAGES', '120/m'),
+        'ip': os.getenv('MESSAGE_RATE_LIMIT_USER_MESSAGES_IP', '240/m'),
+    },
+}
+
+# How long a send_message Idempotency-Key is remembered: a retry with the
+# same key within the window gets the first response back, unwritten.
+# prune_messages deletes older keys
+
+MESSAGE_IDEMPOTENCY_WINDOW = int(os.getenv('MESSAGE_IDEMPOTENCY_WINDOW', 86400))
+
+# Requests each worker process serves at once (0 disables). The limit is per
+# process, so it is lowered to DATABASE_MAX_CONNECTIONS // WEB_CONCURRENCY and,
+# with DATABASE_POOL, to DATABASE_POOL_MAX_SIZE; while the pool has requests
+# waiting no new one is let in. A request that finds every slot taken for
+# MESSAGE_CONCURRENCY_TIMEOUT seconds gets a 503
+
+MESSAGE_MAX_CONCURRENT_REQUESTS = int(os.getenv('MESSAGE_MAX_CONCURRENT_REQUESTS', 20))
+
+MESSAGE_CONCURRENCY_TIMEOUT = float(os.getenv('MESSAGE_CONCURRENCY_TIMEOUT', 0.5))
+
+# Request metrics: per-view timings served as Prometheus text at /api/metrics.
+# Each worker process keeps its own; with several workers point
+# MESSAGE_METRICS_DIR at a directory they share so the endpoint adds them up.
+# Requests slower than MESSAGE_SLOW_REQUEST_MS (0 disables) are logged to
+# 'message.slow_requests' with their SQL. The endpoint has no login of its
+# own: it answers staff users and the addresses or networks (comma-separated,
+# e.g. 10.0.0.0/8 for the Prometheus host) in MESSAGE_METRICS_ALLOWED_IPS
+
+MESSAGE_METRICS_ENABLED = os.getenv('MESSAGE_METRICS_ENABLED', 'True') == 'True'
+
+MESSAGE_METRICS_DIR = os.getenv('MESSAGE_METRICS_DIR') or None
+
+MESSAGE_METRICS_ALLOWED_IPS = [
+    network.strip()
+    for network in os.getenv('MESSAGE_METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+    if network.strip()
+]
+
+MESSAGE_METRICS_FLUSH_INTERVAL = float(os.getenv('MESSAGE_METRICS_FLUSH_INTERVAL', 5))
+
+MESSAGE_SLOW_REQUEST_MS = float(os.getenv('MESSAGE_SLOW_REQUEST_MS', 0))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -1,3 +1,229 @@
+"""
+Admin for message tables too large for the stock change list.
+
+The default change list counts every row with ``COUNT(*)``, pages with
+growing OFFSETs and lists the date hierarchy with a ``SELECT DISTINCT`` over
+the whole table. Here the count is PostgreSQL's estimate, pages are keyset
+ranges on ``(created_at, id)`` (``before``/``after`` cursors, newest first)
+and the hierarchy finds each year, month or day with one index probe, so a
+page costs the same on the first and the ten-millionth row.
+
+It lists the messages of the default database; with several shards the
+others have to be looked at on their own databases.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.text import Truncator
+
+from .models import Conversation, Message, MessageQuerySet, USER_TYPE_CHOICES
+from .pagination import InvalidCursor, KeysetPaginator
+
+
+BEFORE_VAR = 'before'
+AFTER_VAR = 'after'
+
+# Exact counts below this many (estimated) rows are cheap enough to run
+EXACT_COUNT_LIMIT = 100_000
+
+
+def _table_estimate(connection, table):
+    # A partitioned table has no statistics of its own; its partitions do
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT sum(reltuples) FROM pg_class WHERE relkind = 'r' AND reltuples >= 0 "
+            "AND (oid = %s::regclass OR oid IN "
+            "(SELECT inhrelid FROM pg_inherits WHERE inhparent = %s::regclass))",
+            [table, table]
+        )
+        estimate = cursor.fetchone()[0]
+    return None if estimate is None else int(estimate)
+
+
+def _planner_estimate(connection, queryset):
+    sql, params = queryset.order_by().query.get_compiler(connection=connection).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def estimate_count(queryset):
+    """
+    Rows in ``queryset`` as PostgreSQL estimates them: ``pg_class.reltuples``
+    for the whole table, the planner's row estimate when filtered. None on
+    other databases or when the estimate is small enough to count exactly.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    estimate = None
+    if not queryset.query.where:
+        estimate = _table_estimate(connection, queryset.model._meta.db_table)
+    if estimate is None:
+        estimate = _planner_estimate(connection, queryset)
+    return estimate if estimate >= EXACT_COUNT_LIMIT else None
+
+
+class EstimatedCountPaginator(Paginator):
+    estimated = False
+
+    @cached_property
+    def count(self):
+        estimate = estimate_count(self.object_list)
+        if estimate is None:
+            return super().count
+        self.estimated = True
+        return estimate
+
+
+def _truncate(moment, kind):
+    if settings.USE_TZ:
+        moment = timezone.localtime(moment)
+    moment = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    if kind in ('month', 'year'):
+        moment = moment.replace(day=1)
+    if kind == 'year':
+        moment = moment.replace(month=1)
+    return moment
+
+
+def _next_period(start, kind):
+    if kind == 'year':
+        return start.replace(year=start.year + 1)
+    if kind == 'month':
+        # From the 1st, 32 days always land in the next month
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+class MessageAdminQuerySet(MessageQuerySet):
+    def datetimes(self, field_name, kind, order='ASC', tzinfo=None):
+        """
+        The years, months or days holding rows, for the date hierarchy.
+        Rather than truncating and de-duplicating every row, each period is
+        found by one probe for the first row after the previous period (a
+        loose index scan): the cost follows the periods, not the rows.
+        """
+        if kind not in ('year', 'month', 'day') or tzinfo is not None:
+            return super().datetimes(field_name, kind, order, tzinfo)
+        moments = self.order_by(field_name).values_list(field_name, flat=True)
+        periods = []
+        moment = moments.first()
+        while moment is not None:
+            periods.append(_truncate(moment, kind))
+            moment = moments.filter(
+                **{f'{field_name}__gte': _next_period(periods[-1], kind)}
+            ).first()
+        return periods if order == 'ASC' else periods[::-1]
+
+
+class KeysetChangeList(ChangeList):
+    """Change list paged by ``before``/``after`` cursors instead of ``?p=`` offsets"""
+    def get_filters_params(self, params=None):
+        lookup_params = super().get_filters_params(params)
+        lookup_params.pop(BEFORE_VAR, None)
+        lookup_params.pop(AFTER_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        keyset = KeysetPaginator(self.list_per_page)
+        after, before = self.params.get(AFTER_VAR), self.params.get(BEFORE_VAR)
+        try:
+            if after:
+                page = keyset.after(self.queryset, *keyset.decode_cursor(after))
+                has_newer, has_older = page['has_more'], True
+            elif before:
+                page = keyset.before(self.queryset, *keyset.decode_cursor(before))
+                has_newer, has_older = True, page['has_more']
+            else:
+                page = keyset.before(self.queryset)
+                has_newer, has_older = False, page['has_more']
+        except InvalidCursor as exc:
+            raise IncorrectLookupParameters(exc) from exc
+        # Pages come oldest first; the list shows the newest first
+        result_list = page['results'][::-1]
+
+        self.first_url = self.newer_url = self.older_url = None
+        if after or before:
+            self.first_url = self.get_query_string(remove=[AFTER_VAR, BEFORE_VAR])
+        if result_list and has_newer:
+            newest = result_list[0]
+            self.newer_url = self.get_query_string(
+                {AFTER_VAR: keyset.encode_cursor(newest.created_at, newest.pk)}, [BEFORE_VAR]
+            )
+        if result_list and has_older:
+            oldest = result_list[-1]
+            self.older_url = self.get_query_string(
+                {BEFORE_VAR: keyset.encode_cursor(oldest.created_at, oldest.pk)}, [AFTER_VAR]
+            )
+
+        self.result_count = paginator.count
+        self.result_count_estimated = paginator.estimated
+        self.show_full_result_count = False
+        self.full_result_count = None
+        self.show_admin_actions = True
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = has_newer or has_older
+        self.paginator = paginator
+
+
+class UserSenderFilter(admin.SimpleListFilter):
+    """
+    By user type. A message's user_sender is always its conversation's user,
+    so this filters on the conversation: the ``(conversation, created_at,
+    id)`` index then serves both the filter and the page order.
+    """
+    title = 'usuário'
+    parameter_name = 'user_sender'
+
+    def lookups(self, request, model_admin):
+        return USER_TYPE_CHOICES
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        conversation = (
+            Conversation.objects.using(queryset.db).filter(user=self.value())
+            .values_list('pk', flat=True).first()
+        )
+        if conversation is None:
+            return queryset.none()
+        return queryset.filter(conversation_id=conversation)
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'created_at', 'user_sender', 'sender_role', 'text')
+    list_filter = (UserSenderFilter, ('created_at', admin.DateFieldListFilter))
+    date_hierarchy = 'created_at'
+    ordering = ('-created_at', '-id')
+    # Any other order would need its own index to page through
+    sortable_by = ()
+    list_per_page = 100
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    raw_id_fields = ('conversation',)
+
+    def get_queryset(self, request):
+        return MessageAdminQuerySet(self.model).order_by(*self.ordering)
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
 
-# Register your models here.
+    @admin.display(description='texto')
+    def text(self, message):
+        return Truncator(message.user_text or message.bot_text or '').chars(80)
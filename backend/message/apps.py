@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class MessageConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'message'
+
+    def ready(self):
+        from . import buffer
+
+        # Fail at startup rather than on the first buffered write
+        if buffer.enabled():
+            buffer.check_vendors()
+            buffer.check_workers()
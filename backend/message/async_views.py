@@ -0,0 +1,237 @@
+"""
+Native async versions of login, user_messages and send_message.
+
+DRF views are synchronous, so under ASGI each request holds a thread while it
+waits on Postgres. These views use Django's async ORM and async session API
+instead and are routed in place of the MessageViewSet actions when
+MESSAGE_ASYNC_VIEWS is enabled. Responses are byte-for-byte the ones the
+ViewSet produces. send_message's writes need a transaction, so they run the
+ViewSet's write_message in a thread.
+"""
+import functools
+import json
+
+from asgiref.sync import sync_to_async
+
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+
+from rest_framework import status
+
+from . import buffer, replicas
+from .cache import (
+    ahistory_version, aget_cached_history,
+    aset_cached_history, etag_matches, history_etag,
+)
+from .idempotency import MAX_KEY_LENGTH, KeyReused, request_hash, run_idempotent
+from .models import Message
+from .pagination import InvalidCursor
+from .renderers import FastJSONRenderer
+from .serializers import FastMessageSerializer
+from .throttling import (
+    OVERLOADED_MESSAGE, THROTTLED_MESSAGE, acheck_rate_limits, client_ip,
+    limiter, retry_after,
+)
+from .views import PAGINATION_PARAMS, VALID_USERS, HistoryPage, write_message
+
+
+def _response(data, status_code=status.HTTP_200_OK):
+    return HttpResponse(
+        FastJSONRenderer().render(data),
+        content_type='application/json',
+        status=status_code
+    )
+
+
+def _request_data(request):
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+    return request.POST
+
+
+def _not_logged_in():
+    return _response(
+        {"Erro": "Usuário não está logado"},
+        status_code=status.HTTP_401_UNAUTHORIZED
+    )
+
+
+def _with_etag(response, etag):
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def writes(view):
+    """After a successful write, the session reads from the primary for a while"""
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        response = await view(request, *args, **kwargs)
+        if status.is_success(response.status_code):
+            await replicas.astick_to_primary(request.session)
+        return response
+    return wrapper
+
+
+def limited(action):
+    """MESSAGE_RATE_LIMITS for ``action`` and the concurrency limit, as in the ViewSet"""
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            wait = await acheck_rate_limits(
+                action, await request.session.aget('active_user'), client_ip(request)
+            )
+            if wait is not None:
+                response = _response(
+                    {"Erro": THROTTLED_MESSAGE.format(retry_after(wait))},
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS
+                )
+                response['Retry-After'] = retry_after(wait)
+                return response
+
+            if not await limiter.aacquire():
+                response = _response(
+                    {"Erro": OVERLOADED_MESSAGE},
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+                )
+                response['Retry-After'] = '1'
+                return response
+            try:
+                return await view(request, *args, **kwargs)
+            finally:
+                limiter.release()
+        return wrapper
+    return decorator
+
+
+# DRF views are CSRF-exempt for anonymous sessions; keep the same contract
+@csrf_exempt
+@require_POST
+@limited('login')
+async def login(request):
+    user = _request_data(request).get('user') or request.GET.get('user')
+    if user not in VALID_USERS:
+        return _response(
+            {"Erro": "Usuário deve ser do tipo 'A' ou 'B'"},
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
+
+    await request.session.aset('active_user', user)
+
+    return _response({
+        "active_user": user, "message": f"Logged in as {user}"
+    })
+
+
+@csrf_exempt
+@require_GET
+@limited('user_messages')
+async def user_messages(request):
+    active_user = await request.session.aget('active_user')
+
+    if not active_user:
+        return _not_logged_in()
+
+    pending = buffer.pending_rows(active_user)
+    etag = data = None
+    if not pending:
+        version = await ahistory_version(active_user)
+        etag = history_etag(active_user, version, request.GET)
+        if etag_matches(request, etag):
+            return _with_etag(HttpResponse(status=status.HTTP_304_NOT_MODIFIED), etag)
+        data = await aget_cached_history(etag)
+
+    if data is None:
+        try:
+            data, from_replica = await replicas.aread(
+                request.session,
+                lambda: _history_data(request, active_user, pending),
+                fallback_on=InvalidCursor
+            )
+        except InvalidCursor:
+            return _response(
+                {"Erro": "Cursor de paginação inválido"},
+                status_code=status.HTTP_400_BAD_REQUEST
+            )
+        if from_replica:
+            etag = None
+        if etag is not None:
+            await aset_cached_history(etag, data)
+
+    if etag is None:
+        return _response(data)
+    return _with_etag(_response(data), etag)
+
+
+async def _history_data(request, active_user, pending=()):
+    queryset = Message.objects.for_user(active_user).order_by('created_at')
+
+    if PAGINATION_PARAMS.isdisjoint(request.GET):
+        if not pending:
+            return await FastMessageSerializer.amany(queryset)
+        rows = [row async for row in queryset.values(*FastMessageSerializer.attnames())]
+        return FastMessageSerializer.from_values(buffer.merge_pending(rows, pending))
+
+    queryset = queryset.values(*FastMessageSerializer.attnames())
+    page = HistoryPage(request.GET, pending)
+    if page.after_id is not None:
+        page.set_position(await page.position_query(queryset).afirst())
+    return page.data([row async for row in page.query(queryset)])
+
+
+@csrf_exempt
+@require_POST
+@limited('send_message')
+@writes
+async def send_message(request):
+    active_user = await request.session.aget('active_user')
+
+    if not active_user:
+        return _not_logged_in()
+
+    text = _request_data(request).get('text') or request.GET.get('text')
+
+    if not text or not str(text).strip():
+        return _response(
+            {"Erro": "O texto é obrigatório"},
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
+
+    key = request.headers.get('Idempotency-Key')
+    if key is not None:
+        return await _send_message_idempotent(active_user, text, key)
+
+    # The message, its reply and their counts commit together, which needs
+    # a transaction the async ORM doesn't offer yet; the write buffer's
+    # locks and fsync are blocking too
+    data, status_code = await sync_to_async(write_message)(active_user, text)
+    return _response(data, status_code=status_code)
+
+
+async def _send_message_idempotent(active_user, text, key):
+    # The claim and the writes share a transaction, so this runs the sync path
+    if not key.strip() or len(key) > MAX_KEY_LENGTH:
+        return _response(
+            {"Erro": f"Idempotency-Key deve ter de 1 a {MAX_KEY_LENGTH} caracteres"},
+            status_code=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        data, status_code, replayed = await sync_to_async(run_idempotent)(
+            active_user, key, request_hash(text.strip()),
+            lambda: write_message(active_user, text)
+        )
+    except KeyReused:
+        return _response(
+            {"Erro": "Idempotency-Key já usada com outro texto"},
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY
+        )
+
+    response = _response(data, status_code=status_code)
+    if replayed:
+        response['Idempotent-Replayed'] = 'true'
+    return response
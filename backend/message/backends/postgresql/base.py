@@ -0,0 +1,23 @@
+"""
+Django's PostgreSQL backend, timing how long each connection takes to get.
+
+That is a new connection (connect, authenticate, configure) unless
+DATABASES has a pool, in which case it's a checkout from the pool: free
+when a connection is idle, the wait for one otherwise. Observed into
+``message_db_connection_acquire_seconds``.
+"""
+import time
+
+from django.db.backends.postgresql import base
+
+from message.metrics import record_connection
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        started = time.perf_counter()
+        try:
+            return super().get_new_connection(conn_params)
+        finally:
+            record_connection(self.alias, time.perf_counter() - started)
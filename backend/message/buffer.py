@@ -0,0 +1,444 @@
+"""
+Write-behind ingestion for send_message (MESSAGE_WRITE_MODE = 'buffered').
+
+Accepted messages get their ids up front, from the table's own sequence
+reserved in blocks, and are appended to a spill file in
+MESSAGE_BUFFER_DIR and fsynced before the request is answered. A background
+thread then inserts them in bulk every MESSAGE_BUFFER_FLUSH_SIZE messages or
+MESSAGE_BUFFER_FLUSH_INTERVAL milliseconds, whichever comes first, and
+deletes the spill segments it has committed.
+
+Each spill segment is flock()ed by the process writing it. Segments nobody
+holds belong to a process that died: ``recover()`` inserts whatever rows of
+theirs are missing (the ids make this safe to repeat) and deletes them.
+
+Until a message is flushed only its own process knows about it, and
+user_messages merges it in (``pending_rows()``). Another worker would serve
+a history without it, so buffered mode runs in a single process
+(``check_workers()``).
+
+Ids come from the sequence of the shard each message is stored on, and a
+flush commits every shard's rows in that shard's own transaction.
+"""
+import atexit
+import fcntl
+import itertools
+import json
+import logging
+import os
+import threading
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.utils.dateparse import parse_datetime
+
+from . import stats
+from .cache import bump_history_version, invalidate_history
+from .events import publish_messages
+from .models import Message
+from .serializers import FastMessageSerializer
+from .sharding import shard_for, shards
+
+
+logger = logging.getLogger(__name__)
+
+ID_BLOCK_SIZE = 100
+
+# Where reserve_ids() knows how to take ids from the table's sequence
+SUPPORTED_VENDORS = ('postgresql', 'sqlite')
+
+
+class FlushFailed(Exception):
+    """Some shards' rows couldn't be inserted; they stay pending"""
+
+
+def enabled():
+    return settings.MESSAGE_WRITE_MODE == 'buffered'
+
+
+def check_vendors():
+    """Refuse buffered writes on a shard whose ids reserve_ids() can't reserve"""
+    for shard in shards():
+        vendor = connections[shard].vendor
+        if vendor not in SUPPORTED_VENDORS:
+            raise ImproperlyConfigured(
+                f"MESSAGE_WRITE_MODE = 'buffered' needs {' or '.join(SUPPORTED_VENDORS)}, "
+                f"but shard {shard!r} is {vendor}"
+            )
+
+
+def check_workers():
+    """Refuse buffered writes when several processes serve requests"""
+    if settings.WEB_CONCURRENCY > 1:
+        raise ImproperlyConfigured(
+            "MESSAGE_WRITE_MODE = 'buffered' needs WEB_CONCURRENCY = 1: unflushed "
+            "messages can only be read back by the worker process holding them"
+        )
+
+
+def reserve_ids(count, using=DEFAULT_DB_ALIAS):
+    """``count`` fresh message ids, taken from the table's sequence on ``using``"""
+    table = Message._meta.db_table
+    connection = connections[using]
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [table, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+        # SQLite; other vendors are turned away by check_vendors() up front.
+        # AUTOINCREMENT never hands out ids at or below sqlite_sequence.seq
+        cursor.execute(
+            f'INSERT INTO sqlite_sequence (name, seq) '
+            f'SELECT %s, coalesce(max(id), 0) FROM "{table}" '
+            f'WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = %s)',
+            [table, table],
+        )
+        cursor.execute(
+            'UPDATE sqlite_sequence SET seq = seq + %s WHERE name = %s RETURNING seq',
+            [count, table],
+        )
+        last = cursor.fetchone()[0]
+        return list(range(last - count + 1, last + 1))
+
+
+def insert_messages(messages, using=DEFAULT_DB_ALIAS):
+    """
+    INSERT ``messages`` as they are, ids and created_at included.
+    ``bulk_create`` would overwrite created_at (auto_now_add) with the flush
+    time; a raw insert skips pre_save. Messages without an id get one from
+    the table's sequence, set on them as ``bulk_create`` would.
+    """
+    with_ids = [message for message in messages if message.pk is not None]
+    without_ids = [message for message in messages if message.pk is None]
+    if with_ids:
+        _insert(with_ids, Message._meta.concrete_fields, using)
+    if without_ids:
+        fields = [field for field in Message._meta.concrete_fields if not field.primary_key]
+        _insert(without_ids, fields, using, returning=Message._meta.db_returning_fields)
+    for message in messages:
+        message._state.adding = False
+        message._state.db = using
+    return messages
+
+
+def _insert(messages, fields, using, returning=None):
+    batch_size = connections[using].ops.bulk_batch_size(fields, messages) or len(messages)
+    for start in range(0, len(messages), batch_size):
+        batch = messages[start:start + batch_size]
+        rows = Message.objects._insert(
+            batch, fields=fields, returning_fields=returning, using=using, raw=True
+        )
+        for message, values in zip(batch, rows or ()):
+            for field, value in zip(returning, values):
+                setattr(message, field.attname, value)
+
+
+def by_shard(messages):
+    """``{shard: messages}``, keeping the order of ``messages``"""
+    groups = defaultdict(list)
+    for message in messages:
+        groups[shard_for(message.user_sender)].append(message)
+    return groups
+
+
+def _record(message):
+    return {
+        field.attname: getattr(message, field.attname)
+        for field in Message._meta.concrete_fields
+    }
+
+
+def _dump(message):
+    record = _record(message)
+    record['created_at'] = record['created_at'].isoformat()
+    return json.dumps(record, ensure_ascii=False)
+
+
+def _load(line):
+    record = json.loads(line)
+    record['created_at'] = parse_datetime(record['created_at'])
+    return Message(**record)
+
+
+class Segment:
+    """One spill file, locked by this process for as long as it is open"""
+    def __init__(self, directory, name):
+        path = Path(directory) / f"{name}.jsonl"
+        temporary = path.with_name(f"{path.name}.tmp")
+        self.file = open(temporary, 'a', encoding='utf-8')
+        # Locked before it is visible under its real name, so recover() in
+        # another process can never mistake it for an orphan
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        os.rename(temporary, path)
+        _fsync_directory(directory)
+        self.path = path
+        self.written = 0
+        self.synced = 0
+        self.sync_lock = threading.Lock()
+
+    def write(self, lines):
+        self.file.write(''.join(f"{line}\n" for line in lines))
+        self.file.flush()
+        self.written += 1
+        return self.written
+
+    def sync(self, ticket):
+        # Group commit: one fsync covers every write that reached the file before it
+        with self.sync_lock:
+            if self.file.closed or self.synced >= ticket:
+                return
+            upto = self.written
+            os.fsync(self.file.fileno())
+            self.synced = upto
+
+    def delete(self):
+        with self.sync_lock:
+            self.path.unlink(missing_ok=True)
+            self.file.close()
+
+
+def _fsync_directory(directory):
+    descriptor = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+class WriteBuffer:
+    def __init__(self, directory, flush_size=500, flush_interval=200, background=True):
+        self.directory = Path(directory)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval / 1000
+        self.background = background
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._ids = defaultdict(list)
+        self._pending = []
+        self._flushing = []
+        self._sealed = []
+        self._names = itertools.count()
+        self._segment = None
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._segment = self._new_segment()
+        self.recover()
+        if self.background:
+            self._thread = threading.Thread(
+                target=self._run, name='message-write-buffer', daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _new_segment(self):
+        return Segment(self.directory, f"{os.getpid()}-{next(self._names):06d}")
+
+    def _take_ids(self, count, shard):
+        with self._lock:
+            free = self._ids[shard]
+            if len(free) < count:
+                free.extend(reserve_ids(max(count, ID_BLOCK_SIZE), shard))
+            ids, self._ids[shard] = free[:count], free[count:]
+        return ids
+
+    def accept(self, messages):
+        """
+        Give ``messages`` ids and make them durable in the spill file; they
+        are inserted by the next flush. Returns them once fsynced.
+        """
+        for shard, group in by_shard(messages).items():
+            for message, pk in zip(group, self._take_ids(len(group), shard)):
+                message.id = pk
+        lines = [_dump(message) for message in messages]
+
+        with self._lock:
+            segment = self._segment
+            ticket = segment.write(lines)
+            self._pending.extend(messages)
+            full = len(self._pending) >= self.flush_size
+        segment.sync(ticket)
+
+        for user in {message.user_sender for message in messages}:
+            bump_history_version(user)
+        if full:
+            self._wake.set()
+        return messages
+
+    def pending_for(self, user):
+        with self._lock:
+            return [
+                message for message in itertools.chain(self._flushing, self._pending)
+                if message.user_sender == user
+            ]
+
+    def flush(self):
+        """Insert everything accepted so far; returns how many rows went in"""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, []
+                self._flushing = batch
+                # New writes go to a fresh segment; the sealed ones are
+                # deleted only once their rows are committed
+                self._sealed.append(self._segment)
+                self._segment = self._new_segment()
+
+            failed = []
+            for shard, rows in by_shard(batch).items():
+                try:
+                    self._commit(rows, shard)
+                except Exception:
+                    failed.extend(rows)
+                    logger.exception("Flushing buffered messages to %s failed", shard)
+            if failed:
+                # Committed shards are done; the rest is retried from memory
+                # and, until it succeeds, stays in the sealed segments
+                with self._lock:
+                    self._pending = failed + self._pending
+                    self._flushing = []
+                raise FlushFailed(len(failed))
+
+            with self._lock:
+                self._flushing = []
+                sealed, self._sealed = self._sealed, []
+            for segment in sealed:
+                segment.delete()
+            return len(batch)
+
+    @staticmethod
+    def _commit(batch, shard):
+        with transaction.atomic(using=shard):
+            insert_messages(batch, shard)
+            stats.record(batch, shard)
+            users = {message.user_sender for message in batch}
+            for user in users:
+                invalidate_history(user, using=shard)
+            for user in users:
+                data = [
+                    FastMessageSerializer.one(message)
+                    for message in batch if message.user_sender == user
+                ]
+                transaction.on_commit(
+                    lambda user=user, data=data: publish_messages(user, *data),
+                    using=shard
+                )
+
+    def recover(self):
+        """Insert the rows of spill segments left by dead processes"""
+        recovered = 0
+        for path in sorted(self.directory.glob('*.jsonl')):
+            with open(path, 'r', encoding='utf-8') as spill:
+                try:
+                    fcntl.flock(spill, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # a live process owns it
+                messages = []
+                for line in spill:
+                    try:
+                        messages.append(_load(line))
+                    except ValueError:
+                        # A torn last line was never acknowledged
+                        logger.warning("Skipping unreadable line in %s", path)
+                for shard, group in by_shard(messages).items():
+                    recovered += self._insert_missing(group, shard)
+                path.unlink(missing_ok=True)
+        if recovered:
+            logger.info("Recovered %d buffered messages", recovered)
+        return recovered
+
+    def _insert_missing(self, messages, shard):
+        with transaction.atomic(using=shard):
+            existing = set(
+                Message.objects.using(shard)
+                .filter(id__in=[message.id for message in messages])
+                .values_list('id', flat=True)
+            )
+            missing = [message for message in messages if message.id not in existing]
+            if missing:
+                insert_messages(missing, shard)
+                stats.record(missing, shard)
+                for user in {message.user_sender for message in missing}:
+                    invalidate_history(user, using=shard)
+        return len(missing)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                # The rows stay pending and on disk; the next round retries
+                logger.exception("Flushing buffered messages failed")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Final flush failed; the spill files will be recovered")
+            return
+        with self._lock:
+            if not self._pending and self._segment is not None:
+                self._segment.delete()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            check_vendors()
+            check_workers()
+            _buffer = WriteBuffer(
+                settings.MESSAGE_BUFFER_DIR,
+                flush_size=settings.MESSAGE_BUFFER_FLUSH_SIZE,
+                flush_interval=settings.MESSAGE_BUFFER_FLUSH_INTERVAL,
+            )
+            _buffer.start()
+        return _buffer
+
+
+def pending_rows(user):
+    """``values()``-style rows of ``user``'s accepted but unflushed messages"""
+    if _buffer is None:
+        return []
+    return [_record(message) for message in _buffer.pending_for(user)]
+
+
+def merge_pending(rows, pending, descending=False, after=None, before=None):
+    """
+    Merge pending rows into rows read from the database, ordered by
+    ``(created_at, id)``; ``after``/``before`` keep only pending rows past a
+    keyset cursor. A row flushed in between is only kept once.
+    """
+    seen = {row['id'] for row in rows}
+    extra = [
+        row for row in pending
+        if row['id'] not in seen
+        and (after is None or (row['created_at'], row['id']) > tuple(after))
+        and (before is None or (row['created_at'], row['id']) < tuple(before))
+    ]
+    if not extra:
+        return rows
+    return sorted(
+        rows + extra, key=lambda row: (row['created_at'], row['id']), reverse=descending
+    )
@@ -0,0 +1,86 @@
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+
+def _version_key(user):
+    return f"message:history-version:{user}"
+
+
+def history_version(user):
+    """
+    Current version of ``user``'s conversation history.
+
+    A missing counter (first use, eviction, cache restart) starts again from
+    the clock, so it can never fall back to a version that was already
+    cached with older contents.
+    """
+    key = _version_key(user)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+async def ahistory_version(user):
+    key = _version_key(user)
+    version = await cache.aget(key)
+    if version is None:
+        await cache.aadd(key, time.time_ns(), None)
+        version = await cache.aget(key)
+    return version
+
+
+def bump_history_version(user):
+    try:
+        cache.incr(_version_key(user))
+    except ValueError:
+        cache.add(_version_key(user), time.time_ns(), None)
+
+
+def invalidate_history(user, using=None):
+    """
+    Bump the version now and again once the surrounding transaction (on the
+    ``using`` database) commits, so a reader that cached the pre-commit state
+    can't keep serving it.
+    """
+    bump_history_version(user)
+    transaction.on_commit(lambda: bump_history_version(user), using=using)
+
+
+def history_etag(user, version, query_params):
+    params = '&'.join(
+        f"{key}={value}" for key, value in sorted(query_params.items())
+    )
+    digest = hashlib.sha256(f"{user}:{version}:{params}".encode()).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def get_cached_history(etag):
+    return cache.get(f"message:history:{etag}")
+
+
+async def aget_cached_history(etag):
+    return await cache.aget(f"message:history:{etag}")
+
+
+def set_cached_history(etag, data):
+    cache.set(
+        f"message:history:{etag}", data, settings.MESSAGE_HISTORY_CACHE_TIMEOUT
+    )
+
+
+async def aset_cached_history(etag, data):
+    await cache.aset(
+        f"message:history:{etag}", data, settings.MESSAGE_HISTORY_CACHE_TIMEOUT
+    )
+
+
+def etag_matches(request, etag):
+    header = request.headers.get('If-None-Match', '')
+    candidates = {value.strip().removeprefix('W/') for value in header.split(',')}
+    return etag in candidates or '*' in candidates
@@ -0,0 +1,222 @@
+import json
+import logging
+import os
+import string
+import threading
+import time
+import unicodedata
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES_FILE = Path(__file__).resolve().parent / 'rules.json'
+
+# The only placeholder bot_reply fills in a response
+PLACEHOLDERS = {'nome': ''}
+
+
+def fold(text):
+    """Case- and accent-insensitive form used for matching ("Olá" -> "ola")"""
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(
+        char for char in decomposed if not unicodedata.combining(char)
+    ).casefold()
+
+
+@dataclass(frozen=True)
+class Rule:
+    intent: str
+    keywords: tuple
+    response: str
+    priority: int = 0
+
+
+def check_response(intent, response):
+    """
+    Raise ValueError unless ``response`` only uses the known placeholders,
+    so a typo in the rules file is caught on load rather than on every
+    message the rule answers.
+    """
+    try:
+        fields = {
+            field for _, field, _, _ in string.Formatter().parse(response)
+            if field is not None
+        }
+        unknown = fields - PLACEHOLDERS.keys()
+        if unknown:
+            raise ValueError(f"unknown placeholder {sorted(unknown)[0]!r}")
+        response.format(**PLACEHOLDERS)
+    except (ValueError, KeyError, IndexError, AttributeError) as exc:
+        raise ValueError(f"Invalid response for intent {intent!r}: {exc}") from exc
+
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over folded keywords.
+
+    Matching costs one pass over the message whatever the number of
+    keywords; hits are only reported on word boundaries, so "oi" does not
+    fire inside "noite".
+    """
+    def __init__(self, keywords):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._lengths = []
+        for index, keyword in enumerate(keywords):
+            self._add(index, keyword)
+        self._build_failure_links()
+
+    def _add(self, index, keyword):
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append(index)
+        self._lengths.append(len(keyword))
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[child] = target if target != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def search(self, text):
+        """Yield ``(keyword_index, start)`` for every whole-word hit in ``text``"""
+        goto, fail, output, lengths = self._goto, self._fail, self._output, self._lengths
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index in output[node]:
+                start = position - lengths[index] + 1
+                if _is_boundary(text, start - 1) and _is_boundary(text, position + 1):
+                    yield index, start
+
+
+def _is_boundary(text, position):
+    return position < 0 or position >= len(text) or not text[position].isalnum()
+
+
+class ResponseEngine:
+    """Compiled rule set: every keyword of every rule in one matcher"""
+    def __init__(self, rules):
+        self.rules = list(rules)
+        keywords, self._keyword_rules = [], []
+        for rule_index, rule in enumerate(self.rules):
+            for keyword in rule.keywords:
+                folded = fold(keyword).strip()
+                if folded:
+                    keywords.append(folded)
+                    self._keyword_rules.append(rule_index)
+        self._matcher = KeywordMatcher(keywords)
+
+    def match(self, text):
+        """
+        Best rule for ``text``, or None.
+
+        Highest priority wins, then the rule with most keyword hits, then
+        the one that matched earliest in the message.
+        """
+        scores = {}
+        for keyword_index, start in self._matcher.search(fold(text)):
+            rule_index = self._keyword_rules[keyword_index]
+            hits, first = scores.get(rule_index, (0, start))
+            scores[rule_index] = (hits + 1, min(first, start))
+        if not scores:
+            return None
+        best = max(
+            scores,
+            key=lambda index: (
+                self.rules[index].priority, scores[index][0], -scores[index][1]
+            ),
+        )
+        return self.rules[best]
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, encoding='utf-8') as rules_file:
+            data = json.load(rules_file)
+        rules = [
+            Rule(
+                intent=item['intent'],
+                keywords=tuple(item['keywords']),
+                response=item['response'],
+                priority=item.get('priority', 0),
+            )
+            for item in data
+        ]
+        for rule in rules:
+            check_response(rule.intent, rule.response)
+        return cls(rules)
+
+
+class EngineLoader:
+    """
+    Keeps the compiled engine in sync with the rules file.
+
+    The file's mtime is checked at most once per ``interval`` seconds and the
+    engine is rebuilt on change, so edited rules go live without a restart.
+    A broken file is logged and the previous engine keeps serving.
+    """
+    def __init__(self, path, interval=5.0):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._engine = None
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def get(self):
+        if self._engine is None or time.monotonic() - self._checked_at >= self.interval:
+            self._refresh()
+        return self._engine
+
+    def _refresh(self):
+        with self._lock:
+            self._checked_at = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime and self._engine is not None:
+                    return
+                self._engine = ResponseEngine.from_file(self.path)
+                self._mtime = mtime
+            except (OSError, ValueError, KeyError, TypeError):
+                logger.exception("Could not load response rules from %s", self.path)
+                if self._engine is None:
+                    self._engine = ResponseEngine([])
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_engine():
+    global _loader
+    path = getattr(settings, 'MESSAGE_RULES_FILE', None) or DEFAULT_RULES_FILE
+    if _loader is None or _loader.path != path:
+        with _loader_lock:
+            if _loader is None or _loader.path != path:
+                _loader = EngineLoader(
+                    path, getattr(settings, 'MESSAGE_RULES_RELOAD_INTERVAL', 5.0)
+                )
+    return _loader.get()
@@ -0,0 +1,219 @@
+import asyncio
+import json
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'message.events.LocalBroker'
+NOTIFY_CHANNEL = 'message_events'
+# Postgres rejects NOTIFY payloads of 8000 bytes or more
+NOTIFY_PAYLOAD_LIMIT = 7900
+CHANNEL_PREFIX = "messages."
+# Queued to a subscriber whose events may have been lost: its stream ends
+RESET = object()
+
+
+def channel_for(user):
+    return f"{CHANNEL_PREFIX}{user}"
+
+
+class LocalBroker:
+    """
+    In-process pub/sub.
+
+    Subscribers are asyncio queues living on the event loop that serves the
+    stream, while publishers are usually sync views running in a worker
+    thread, so events are handed over with ``call_soon_threadsafe``.
+    """
+    queue_size = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def publish(self, channel, event):
+        self.dispatch(channel, event)
+
+    def dispatch(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        self._deliver(subscribers, event)
+
+    def reset(self):
+        """End every open subscription, so its client reconnects and replays"""
+        with self._lock:
+            subscribers = [entry for entries in self._subscribers.values() for entry in entries]
+        self._deliver(subscribers, RESET)
+
+    def _deliver(self, subscribers, event):
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._offer, queue, event)
+            except RuntimeError:
+                # The loop was closed under us; its subscriber is gone
+                pass
+
+    @staticmethod
+    def _offer(queue, event):
+        if event is RESET and queue.full():
+            # The stream replays from the table anyway; make room for the reset
+            queue.get_nowait()
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.warning("Dropping event for a slow stream subscriber")
+
+    def subscribe(self, channel):
+        """
+        Register a subscriber on the running event loop.
+
+        Registration happens immediately, so nothing published after this
+        call is missed even if the caller does other work before iterating.
+        """
+        subscription = Subscription(self, channel, asyncio.Queue(self.queue_size))
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(subscription.entry)
+        self.on_subscribe()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel, set())
+            subscribers.discard(subscription.entry)
+            if not subscribers:
+                self._subscribers.pop(subscription.channel, None)
+
+    def on_subscribe(self):
+        pass
+
+
+class Subscription:
+    def __init__(self, broker, channel, queue):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue
+        self.entry = (asyncio.get_running_loop(), queue)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.queue.get()
+        if event is RESET:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Fan-out across workers through Postgres LISTEN/NOTIFY.
+
+    Every process keeps a single LISTEN connection and re-dispatches what it
+    receives to its local subscribers, so the number of database connections
+    does not grow with the number of open streams.
+
+    A lost connection is logged and reopened with exponential backoff.
+    Notifications sent while it was down never arrive, so once it listens
+    again every open stream is reset: clients reconnect with Last-Event-ID
+    and replay what they missed from the table.
+    """
+    retry_delay = 0.5
+    max_retry_delay = 30.0
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+
+    def publish(self, channel, event):
+        payload = json.dumps({"channel": channel, "event": event})
+        if len(payload.encode()) > NOTIFY_PAYLOAD_LIMIT:
+            payload = json.dumps({"channel": channel, "id": event["id"]})
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", [NOTIFY_CHANNEL, payload])
+
+    def on_subscribe(self):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        delay, failed = self.retry_delay, False
+
+        def listening():
+            nonlocal delay, failed
+            delay = self.retry_delay
+            if failed:
+                failed = False
+                self.reset()
+
+        while True:
+            try:
+                await self._listen_once(listening)
+            except Exception:
+                logger.exception("LISTEN connection failed; reconnecting in %.1fs", delay)
+            else:
+                logger.warning("LISTEN connection closed; reconnecting in %.1fs", delay)
+            failed = True
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
+
+    async def _listen_once(self, listening):
+        import psycopg
+        from psycopg import sql
+
+        db = settings.DATABASES['default']
+        conn = await psycopg.AsyncConnection.connect(
+            dbname=db['NAME'], user=db['USER'], password=db['PASSWORD'],
+            host=db['HOST'], port=db['PORT'], autocommit=True,
+        )
+        async with conn:
+            await conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(NOTIFY_CHANNEL)))
+            listening()
+            async for notify in conn.notifies():
+                payload = json.loads(notify.payload)
+                event = payload.get("event")
+                if event is None:
+                    event = await self._load_event(payload["channel"], payload["id"])
+                    if event is None:
+                        continue
+                self.dispatch(payload["channel"], event)
+
+    @staticmethod
+    async def _load_event(channel, pk):
+        from .models import Message
+        from .serializers import FastMessageSerializer
+
+        # Ids are only unique within a shard: look on the channel user's one
+        user = channel.removeprefix(CHANNEL_PREFIX)
+        message = await Message.objects.for_user(user).filter(pk=pk).afirst()
+        if message is None:
+            return None
+        return FastMessageSerializer.one(message)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                backend = getattr(settings, 'MESSAGE_EVENTS_BACKEND', DEFAULT_BACKEND)
+                _broker = import_string(backend)()
+    return _broker
+
+
+def publish_messages(user, *events):
+    broker = get_broker()
+    for event in events:
+        broker.publish(channel_for(user), event)
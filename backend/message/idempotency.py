@@ -0,0 +1,83 @@
+"""
+Idempotency-Key support for send_message.
+
+A client retrying a request with the same key gets the response stored for
+the first attempt instead of another user/bot pair, for
+MESSAGE_IDEMPOTENCY_WINDOW seconds. The IdempotencyKey row is claimed before
+anything is written and in the same transaction, so a duplicate arriving
+while the first request is still running waits on the unique constraint and
+then replays its response; if the first request fails, its claim is rolled
+back with it and the retry starts over.
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .models import IdempotencyKey
+from .sharding import shard_for
+
+
+MAX_KEY_LENGTH = IdempotencyKey._meta.get_field('key').max_length
+
+
+class KeyReused(Exception):
+    """The key was already used for a request with a different body"""
+
+
+def request_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def window_start(now=None):
+    return (now or timezone.now()) - timedelta(seconds=settings.MESSAGE_IDEMPOTENCY_WINDOW)
+
+
+def run_idempotent(user, key, fingerprint, perform):
+    """
+    Call ``perform()`` (returning ``(data, status_code)``) once per
+    ``(user, key)``. Returns ``(data, status_code, replayed)``.
+
+    The key lives on the user's shard, next to the messages ``perform()``
+    writes, so both commit together.
+    """
+    shard = shard_for(user)
+    with transaction.atomic(using=shard):
+        record, created = _claim(shard, user, key, fingerprint)
+        if not created:
+            if record.request_hash != fingerprint:
+                raise KeyReused(key)
+            return record.response, record.status_code, True
+
+        data, status_code = perform()
+        record.response, record.status_code = data, status_code
+        record.save(update_fields=['response', 'status_code'])
+    return data, status_code, False
+
+
+def _claim(shard, user, key, fingerprint):
+    keys = IdempotencyKey.objects.using(shard)
+    while True:
+        try:
+            with transaction.atomic(using=shard):
+                return keys.create(user=user, key=key, request_hash=fingerprint), True
+        except IntegrityError:
+            pass
+
+        record = keys.filter(user=user, key=key).first()
+        if record is None:
+            # Expired and deleted by a concurrent request: claim it again
+            continue
+        if record.created_at >= window_start():
+            return record, False
+        record.delete()
+
+
+def delete_expired(now=None, using=None):
+    """Drop keys older than the window from shard ``using``; returns how many went"""
+    deleted, _ = IdempotencyKey.objects.using(using).filter(
+        created_at__lt=window_start(now)
+    ).delete()
+    return deleted
@@ -0,0 +1,220 @@
+"""
+Bulk loading of historical transcripts from NDJSON or CSV.
+
+Files are read as a stream and loaded in chunks, each in one transaction
+together with its ImportProgress row: COPY on Postgres (psycopg 3),
+batched INSERTs elsewhere. The columns are the ones export_messages writes,
+so an export can be loaded back as-is; ``id`` and ``conversation`` are
+ignored and every row joins its user's conversation.
+
+With several shards each one keeps its own ImportProgress row, committed
+with the rows it received, so a resumed import skips exactly what each
+shard already has.
+"""
+import csv
+import gzip
+import json
+import os
+from contextlib import contextmanager
+
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import stats
+from .buffer import insert_messages
+from .cache import invalidate_history
+from .models import Conversation, ImportProgress, Message, SenderRole, USER_TYPE_CHOICES
+from .sharding import shard_for, shards
+
+
+VALID_USERS = {user for user, _ in USER_TYPE_CHOICES}
+COPY_COLUMNS = ('conversation_id', 'user_sender', 'sender_role', 'user_text', 'bot_text', 'created_at')
+
+
+class InvalidRecord(ValueError):
+    pass
+
+
+def detect_format(path):
+    name = path.removesuffix('.gz')
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl', '.json')):
+        return 'ndjson'
+    raise ValueError(path)
+
+
+@contextmanager
+def open_source(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as source:
+        yield source
+
+
+def read_records(source, fmt):
+    """Yield ``(record number, dict or None)``; None marks a line that isn't JSON"""
+    if fmt == 'csv':
+        yield from enumerate(csv.DictReader(source), start=1)
+        return
+    for number, line in enumerate(source, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield number, record if isinstance(record, dict) else None
+
+
+def clean_record(record):
+    """Validate one record; returns ``(user_sender, sender_role, user_text, bot_text, created_at)``"""
+    if record is None:
+        raise InvalidRecord("not a JSON object")
+
+    user = record.get('user_sender')
+    if not isinstance(user, str) or user not in VALID_USERS:
+        raise InvalidRecord(f"user_sender must be one of {sorted(VALID_USERS)}, got {user!r}")
+
+    role = record.get('sender_role') or SenderRole.USER
+    if role not in SenderRole.values:
+        raise InvalidRecord(f"unknown sender_role {role!r}")
+
+    user_text = record.get('user_text') or None
+    bot_text = record.get('bot_text') or None
+    for name, text in (('user_text', user_text), ('bot_text', bot_text)):
+        if text is not None and not isinstance(text, str):
+            raise InvalidRecord(f"{name} must be a string, got {text!r}")
+    if user_text is None and bot_text is None:
+        raise InvalidRecord("user_text and bot_text are both empty")
+
+    created_at = record.get('created_at')
+    if created_at:
+        if not isinstance(created_at, str):
+            raise InvalidRecord(f"invalid created_at {created_at!r}")
+        try:
+            # None when malformed, ValueError when well formed but impossible
+            moment = parse_datetime(created_at)
+        except ValueError:
+            moment = None
+        if moment is None:
+            raise InvalidRecord(f"invalid created_at {created_at!r}")
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+    else:
+        moment = timezone.now()
+
+    return user, role, user_text, bot_text, moment
+
+
+class MessageImporter:
+    """
+    Loads one source file, committing every ``chunk_size`` records along
+    with the ImportProgress row of each shard. Re-running with the same
+    ``source`` key skips the records already committed.
+    """
+    def __init__(self, source_key, chunk_size=5000, use_copy=None):
+        self.source_key = source_key
+        self.chunk_size = chunk_size
+        self.use_copy = use_copy
+        self.conversations = {
+            user: Conversation.objects.for_user(user).pk for user in VALID_USERS
+        }
+        self.progress = {
+            shard: ImportProgress.objects.using(shard).get_or_create(source=source_key)[0]
+            for shard in shards()
+        }
+        self.errors = []
+        self.imported = 0
+
+    @property
+    def resume_after(self):
+        return min(progress.records_done for progress in self.progress.values())
+
+    def run(self, records, on_chunk=None):
+        start = self.resume_after
+        chunk, last = [], start
+        for number, record in records:
+            if number <= start:
+                continue
+            last = number
+            try:
+                row = clean_record(record)
+            except InvalidRecord as exc:
+                self.errors.append((number, str(exc)))
+            else:
+                # A shard that got further before an interruption has it already
+                if number > self.progress[shard_for(row[0])].records_done:
+                    chunk.append(row)
+            if number - start >= self.chunk_size:
+                self._commit(chunk, last)
+                chunk, start = [], last
+                if on_chunk:
+                    on_chunk(self)
+        if chunk or last > start:
+            self._commit(chunk, last)
+            if on_chunk:
+                on_chunk(self)
+        return self.imported
+
+    def _commit(self, rows, last):
+        for shard, progress in self.progress.items():
+            if progress.records_done >= last:
+                continue
+            shard_rows = [row for row in rows if shard_for(row[0]) == shard]
+            with transaction.atomic(using=shard):
+                if shard_rows:
+                    if self._use_copy(shard):
+                        self._copy(shard_rows, shard)
+                    else:
+                        self._insert(shard_rows, shard)
+                    stats.record_rows(
+                        ((created_at, user, role)
+                         for user, role, _, _, created_at in shard_rows),
+                        shard
+                    )
+                    for user in {row[0] for row in shard_rows}:
+                        invalidate_history(user, using=shard)
+                ImportProgress.objects.using(shard).filter(pk=progress.pk).update(
+                    records_done=last,
+                    rows_imported=F('rows_imported') + len(shard_rows),
+                    updated_at=timezone.now(),
+                )
+            progress.records_done = last
+            self.imported += len(shard_rows)
+
+    def _use_copy(self, shard):
+        return _copy_supported(shard) if self.use_copy is None else self.use_copy
+
+    def _copy(self, rows, shard):
+        table = Message._meta.db_table
+        columns = ', '.join(COPY_COLUMNS)
+        with connections[shard].cursor() as cursor:
+            with cursor.cursor.copy(f'COPY "{table}" ({columns}) FROM STDIN') as copy:
+                for user, role, user_text, bot_text, created_at in rows:
+                    copy.write_row(
+                        (self.conversations[user], user, role, user_text, bot_text, created_at)
+                    )
+
+    def _insert(self, rows, shard):
+        messages = [
+            Message(
+                conversation_id=self.conversations[user], user_sender=user,
+                sender_role=role, user_text=user_text, bot_text=bot_text,
+                created_at=created_at,
+            )
+            for user, role, user_text, bot_text, created_at in rows
+        ]
+        insert_messages(messages, shard)
+
+
+def _copy_supported(shard):
+    if connections[shard].vendor != 'postgresql':
+        return False
+    from django.db.backends.postgresql.psycopg_any import is_psycopg3
+    return is_psycopg3
+
+
+def source_key(path):
+    return os.path.abspath(path)[-255:]
@@ -0,0 +1,224 @@
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from . import stats
+from .cache import invalidate_history
+from .events import publish_messages
+from .models import Message, ReplyJob, ReplyJobStatus, SenderRole
+from .replies import bot_reply
+from .serializers import FastMessageSerializer
+from .sharding import shards
+
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_reply(user_message):
+    """Queue the bot reply for ``user_message`` in the caller's transaction"""
+    return ReplyJob.objects.using(user_message._state.db).create(user_message=user_message)
+
+
+def send_queued_message(conversation, active_user, text):
+    """
+    Store the user message and queue its bot reply in one transaction.
+
+    Returns the serialized user message and the ReplyJob; the reply itself is
+    written and published by run_reply_worker.
+    """
+    shard = conversation._state.db
+    with transaction.atomic(using=shard):
+        user_msg = conversation.messages.create(
+            user_sender=active_user,
+            sender_role=SenderRole.USER,
+            user_text=text.strip()
+        )
+        job = enqueue_reply(user_msg)
+        stats.record([user_msg], shard)
+        invalidate_history(active_user, using=shard)
+        user_data = FastMessageSerializer.one(user_msg)
+        transaction.on_commit(lambda: publish_messages(active_user, user_data), using=shard)
+    return user_data, job
+
+
+class ReplyWorker:
+    """
+    Consumes the ReplyJob queue.
+
+    Jobs are claimed with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the
+    database supports it, so any number of workers can poll the same table
+    without handing the same job out twice. A job that keeps failing is
+    retried with exponential backoff and ends up ``dead`` after
+    ``max_attempts``; jobs left ``running`` by a crashed worker are claimed
+    again once their lease expires. A worker serves the queue of one shard,
+    ``database``.
+
+    A worker that overruns its lease may still be working on a job another
+    worker has claimed since: every outcome is written only while the job
+    still carries this worker's claim (``_owned``), so the late one writes
+    no second reply.
+    """
+    def __init__(self, batch_size=10, max_attempts=None, retry_backoff=None,
+                 lease_seconds=None, database=DEFAULT_DB_ALIAS):
+        self.database = database
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts or settings.MESSAGE_REPLY_MAX_ATTEMPTS
+        self.retry_backoff = retry_backoff or settings.MESSAGE_REPLY_RETRY_BACKOFF
+        self.lease_seconds = lease_seconds or settings.MESSAGE_REPLY_LEASE_SECONDS
+
+    def claim(self):
+        now = timezone.now()
+        ready = Q(status=ReplyJobStatus.PENDING, available_at__lte=now) | Q(
+            status=ReplyJobStatus.RUNNING,
+            locked_at__lt=now - timedelta(seconds=self.lease_seconds),
+        )
+        claimed = dict(
+            status=ReplyJobStatus.RUNNING, locked_at=now, attempts=F('attempts') + 1
+        )
+        queue = ReplyJob.objects.using(self.database)
+        with transaction.atomic(using=self.database):
+            jobs = queue.filter(ready).order_by('available_at', 'id')
+            jobs = jobs.select_related('user_message')
+            features = connections[self.database].features
+            if features.has_select_for_update_skip_locked:
+                # Only the job rows: locking the joined messages would block
+                # their writers and make workers skip unrelated jobs
+                of = ('self',) if features.has_select_for_update_of else ()
+                jobs = list(jobs.select_for_update(skip_locked=True, of=of)[:self.batch_size])
+                queue.filter(pk__in=[job.pk for job in jobs]).update(**claimed)
+            else:
+                # No row locks (SQLite): claim each job with a compare-and-set
+                # so two workers can't both take it
+                jobs = [
+                    job for job in jobs[:self.batch_size]
+                    if queue.filter(
+                        pk=job.pk, status=job.status, locked_at=job.locked_at
+                    ).update(**claimed)
+                ]
+        for job in jobs:
+            job.status = ReplyJobStatus.RUNNING
+            job.locked_at = now
+            job.attempts += 1
+        return jobs
+
+    def _owned(self, job):
+        """``job`` while it is still running under this worker's claim"""
+        return ReplyJob.objects.using(self.database).filter(
+            pk=job.pk, status=ReplyJobStatus.RUNNING, locked_at=job.locked_at,
+            bot_message__isnull=True,
+        )
+
+    def process(self, job):
+        user_message = job.user_message
+        try:
+            with transaction.atomic(using=self.database):
+                # Marked done first: the row lock makes a second claimant
+                # wait here, then find nothing to update
+                if not self._owned(job).update(status=ReplyJobStatus.DONE, last_error=''):
+                    logger.warning("Reply job %s was claimed again; not replying twice", job.pk)
+                    return False
+                bot_msg = Message.objects.using(self.database).create(
+                    conversation_id=user_message.conversation_id,
+                    user_sender=user_message.user_sender,
+                    sender_role=SenderRole.BOT,
+                    bot_text=bot_reply(user_message.user_sender, user_message.user_text),
+                )
+                ReplyJob.objects.using(self.database).filter(pk=job.pk).update(
+                    bot_message=bot_msg
+                )
+                job.status = ReplyJobStatus.DONE
+                job.bot_message = bot_msg
+                job.last_error = ''
+                stats.record([bot_msg], self.database)
+                invalidate_history(user_message.user_sender, using=self.database)
+                event = FastMessageSerializer.one(bot_msg)
+                transaction.on_commit(
+                    lambda: publish_messages(user_message.user_sender, event),
+                    using=self.database
+                )
+        except Exception as exc:
+            self.fail(job, exc)
+            return False
+        return True
+
+    def fail(self, job, exc):
+        logger.exception("Reply job %s failed (attempt %s)", job.pk, job.attempts)
+        job.last_error = repr(exc)
+        if job.attempts >= self.max_attempts:
+            job.status = ReplyJobStatus.DEAD
+        else:
+            job.status = ReplyJobStatus.PENDING
+            job.available_at = timezone.now() + timedelta(
+                seconds=self.retry_backoff * 2 ** (job.attempts - 1)
+            )
+        self._owned(job).update(
+            status=job.status, last_error=job.last_error, available_at=job.available_at
+        )
+
+    def run_once(self):
+        """Claim and process one batch; returns how many jobs were handled"""
+        jobs = self.claim()
+        for job in jobs:
+            self.process(job)
+        return len(jobs)
+
+    def run(self, stop_event, poll_interval=1.0, drain=False):
+        while not stop_event.is_set():
+            # Recycle stale connections, but never one a caller holds a
+            # transaction on (e.g. when driven from a test or a shell)
+            if not connections[self.database].in_atomic_block:
+                close_old_connections()
+            if self.run_once():
+                continue
+            if drain:
+                break
+            stop_event.wait(poll_interval)
+
+
+def _run_in_thread(worker, *args):
+    try:
+        worker.run(*args)
+    finally:
+        connections.close_all()
+
+
+def run_workers(concurrency=1, poll_interval=1.0, drain=False, stop_event=None,
+                databases=None, **worker_options):
+    """
+    Run ``concurrency`` workers per shard in ``databases`` (every shard by
+    default), each on its own thread and DB connection
+    """
+    stop_event = stop_event or threading.Event()
+    databases = databases or shards()
+    workers = [
+        ReplyWorker(database=database, **worker_options)
+        for database in databases for _ in range(concurrency)
+    ]
+    if len(workers) == 1:
+        workers[0].run(stop_event, poll_interval, drain)
+        return
+
+    threads = [
+        threading.Thread(
+            target=_run_in_thread,
+            args=(worker, stop_event, poll_interval, drain),
+            name=f"reply-worker-{worker.database}-{number}",
+            daemon=True,
+        )
+        for number, worker in enumerate(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+    except KeyboardInterrupt:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
@@ -0,0 +1,192 @@
+import statistics
+import time
+import uuid
+from datetime import timedelta
+from urllib.parse import urlencode
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from message.buffer import insert_messages
+from message.models import Conversation, Message, SenderRole, USER_TYPE_CHOICES
+from message.pagination import KeysetPaginator
+from message.sharding import shard_for
+
+
+SEED_CHUNK = 1_000_000
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed the default database with --messages rows spread over --days "
+        "and time the Message admin on them: the change list, its user and "
+        "date filters, date hierarchy drill-downs and a page half way down "
+        "the table. The exact COUNT(*) and OFFSET query the stock admin "
+        "would run for that page are timed alongside for comparison."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=10_000_000)
+        parser.add_argument('--days', type=int, default=730,
+                            help="Seeded messages go back this many days")
+        parser.add_argument('--runs', type=int, default=5,
+                            help="Requests per page; medians are reported")
+        parser.add_argument('--no-seed', action='store_true',
+                            help="Reuse the rows already in the database")
+        parser.add_argument('--cleanup', action='store_true',
+                            help="Delete the seeded messages afterwards")
+
+    def handle(self, *args, **options):
+        if not apps.is_installed('django.contrib.admin'):
+            raise CommandError("The admin is only served by the 'full' settings profile")
+        conversations = [
+            Conversation.objects.for_user(user) for user, _ in USER_TYPE_CHOICES
+            if shard_for(user) == DEFAULT_DB_ALIAS
+        ]
+        if not conversations:
+            raise CommandError("No conversation lives on the default database")
+
+        messages = Message.objects.using(DEFAULT_DB_ALIAS)
+        first_new_id = (messages.order_by('-id').values_list('id', flat=True).first() or 0) + 1
+        if not options['no_seed']:
+            started = time.perf_counter()
+            self._seed(conversations, options['messages'], options['days'])
+            self.stdout.write(
+                f"Seeded {options['messages']} messages in {time.perf_counter() - started:.1f}s"
+            )
+
+        User = apps.get_model('auth', 'User')
+        user = User.objects.create_superuser(f"bench-{uuid.uuid4().hex[:8]}", password=None)
+        try:
+            client = Client(SERVER_NAME='localhost')
+            client.force_login(user)
+            for label, query in self._pages(messages):
+                self._report(label, self._time(client, query, options['runs']))
+            self._baseline(messages, options['runs'])
+        finally:
+            user.delete()
+            if options['cleanup']:
+                messages.filter(id__gte=first_new_id).delete()
+
+    def _seed(self, conversations, count, days):
+        now = timezone.now()
+        step = timedelta(days=days) / max(count, 1)
+        if connection.vendor == 'postgresql':
+            self._seed_postgresql(conversations, count, now, step)
+            return
+        batch = []
+        for number in range(count):
+            conversation = conversations[number % len(conversations)]
+            is_user = number // len(conversations) % 2 == 0
+            batch.append(Message(
+                conversation=conversation,
+                user_sender=conversation.user,
+                sender_role=SenderRole.USER if is_user else SenderRole.BOT,
+                user_text=f"Mensagem de teste {number}" if is_user else None,
+                bot_text=None if is_user else "Obrigado por seu contato.",
+                created_at=now - step * number,
+            ))
+            if len(batch) == 5000:
+                self._bulk_create(batch)
+                batch = []
+        if batch:
+            self._bulk_create(batch)
+
+    @staticmethod
+    def _bulk_create(batch):
+        # Not bulk_create: auto_now_add would stamp every row with the insert time
+        insert_messages(batch, DEFAULT_DB_ALIAS)
+
+    @staticmethod
+    def _seed_postgresql(conversations, count, now, step):
+        ids = [conversation.pk for conversation in conversations]
+        users = [conversation.user for conversation in conversations]
+        with connection.cursor() as cursor:
+            for start in range(0, count, SEED_CHUNK):
+                cursor.execute(
+                    'INSERT INTO "message_message" '
+                    '(conversation_id, user_sender, sender_role, user_text, bot_text, created_at) '
+                    'SELECT (%s::bigint[])[n %% %s + 1], (%s::text[])[n %% %s + 1], '
+                    "CASE WHEN n / %s %% 2 = 0 THEN 'user' ELSE 'bot' END, "
+                    "CASE WHEN n / %s %% 2 = 0 THEN 'Mensagem de teste ' || n END, "
+                    "CASE WHEN n / %s %% 2 = 1 THEN 'Obrigado por seu contato.' END, "
+                    '%s::timestamptz - n * %s::interval '
+                    'FROM generate_series(%s, %s) AS n',
+                    [ids, len(ids), users, len(ids), len(ids), len(ids), len(ids),
+                     now, step, start, min(start + SEED_CHUNK, count) - 1]
+                )
+            # Fresh statistics, as autovacuum would leave them
+            cursor.execute('ANALYZE "message_message"')
+
+    def _pages(self, messages):
+        # Not at the top: message.admin can only be imported with the admin installed
+        from message.admin import BEFORE_VAR
+
+        changelist = reverse('admin:message_message_changelist')
+        newest = messages.order_by('-created_at').values_list('created_at', flat=True).first()
+        oldest = messages.order_by('created_at').values_list('created_at', flat=True).first()
+        if newest is None:
+            raise CommandError("There are no messages to page through")
+        newest = timezone.localtime(newest)
+        middle = oldest + (newest - oldest) / 2
+        row = (
+            messages.filter(created_at__lt=middle).order_by('-created_at', '-id')
+            .values_list('created_at', 'id').first()
+        )
+        # The bounds DateFieldListFilter's "Últimos 7 dias" link carries
+        today = newest.replace(hour=0, minute=0, second=0, microsecond=0)
+        week_ago, tomorrow = today - timedelta(days=7), today + timedelta(days=1)
+        pages = [
+            ("first page", {}),
+            ("user filter", {'user_sender': 'A'}),
+            ("last 7 days", {'created_at__gte': week_ago, 'created_at__lt': tomorrow}),
+            ("hierarchy year", {'created_at__year': newest.year}),
+            ("hierarchy month",
+             {'created_at__year': newest.year, 'created_at__month': newest.month}),
+        ]
+        if row:
+            pages.append(("middle page", {BEFORE_VAR: KeysetPaginator.encode_cursor(*row)}))
+        return [(label, f'{changelist}?{urlencode(query)}') for label, query in pages]
+
+    @staticmethod
+    def _time(client, url, runs):
+        samples, queries = [], 0
+        for _ in range(runs):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                response = client.get(url)
+                samples.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                raise CommandError(f"{url} answered {response.status_code}")
+            queries = len(captured)
+        return statistics.median(samples), max(samples), queries
+
+    def _baseline(self, messages, runs):
+        count = messages.count()
+
+        def exact_count():
+            return messages.count()
+
+        def offset_page():
+            offset = count // 2
+            return list(messages.order_by('-created_at', '-id')[offset:offset + 100])
+
+        for label, query in (("stock COUNT(*)", exact_count), ("stock OFFSET page", offset_page)):
+            samples = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                query()
+                samples.append(time.perf_counter() - started)
+            self._report(label, (statistics.median(samples), max(samples), 1))
+
+    def _report(self, label, result):
+        median, worst, queries = result
+        self.stdout.write(
+            f"{label:<18} p50={median * 1000:8.1f}ms max={worst * 1000:8.1f}ms "
+            f"queries={queries}"
+        )
@@ -0,0 +1,68 @@
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from message.engine import ResponseEngine, Rule
+
+
+WORDS = [
+    'pedido', 'entrega', 'boleto', 'cartão', 'senha', 'cadastro', 'pagamento',
+    'reembolso', 'troca', 'produto', 'garantia', 'nota', 'fiscal', 'atraso',
+    'endereço', 'frete', 'cupom', 'desconto', 'assinatura', 'fatura',
+]
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark of the response engine against a large rule set"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules', type=int, default=5000)
+        parser.add_argument('--keywords-per-rule', type=int, default=5)
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+
+        def keyword():
+            suffix = ''.join(rng.choices(string.ascii_lowercase, k=4))
+            return f"{rng.choice(WORDS)} {suffix}"
+
+        rules = [
+            Rule(
+                intent=f"intent_{number}",
+                keywords=tuple(keyword() for _ in range(options['keywords_per_rule'])),
+                response="Resposta {nome}",
+                priority=rng.randint(0, 3),
+            )
+            for number in range(options['rules'])
+        ]
+        all_keywords = [kw for rule in rules for kw in rule.keywords]
+
+        started = time.perf_counter()
+        engine = ResponseEngine(rules)
+        compile_seconds = time.perf_counter() - started
+
+        # Half of the messages contain a known keyword, half only noise
+        messages = []
+        for number in range(options['messages']):
+            words = rng.choices(WORDS, k=12)
+            if number % 2 == 0:
+                words.insert(rng.randrange(len(words)), rng.choice(all_keywords))
+            messages.append(f"Olá, {' '.join(words)}. Obrigado!")
+
+        started = time.perf_counter()
+        matched = sum(1 for message in messages if engine.match(message) is not None)
+        match_seconds = time.perf_counter() - started
+
+        self.stdout.write(
+            f"rules={len(rules)} keywords={len(all_keywords)} "
+            f"compile={compile_seconds * 1000:.1f}ms"
+        )
+        self.stdout.write(
+            f"messages={len(messages)} matched={matched} "
+            f"time={match_seconds:.3f}s "
+            f"rate={len(messages) / match_seconds:,.0f} matches/s"
+        )
@@ -0,0 +1,80 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from message.models import Conversation, Message, SenderRole
+from message.renderers import FastJSONRenderer
+from message.serializers import FastMessageSerializer, MessageSerializer
+from message.sharding import shard_for
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare MessageSerializer + JSONRenderer with the fast values_list() "
+        "path. Rows are seeded inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+        parser.add_argument('--repeat', type=int, default=3,
+                            help="Runs per path; the best time is reported")
+
+    def handle(self, *args, **options):
+        shard = shard_for('A')
+        with transaction.atomic(using=shard):
+            conversation = Conversation.objects.for_user('A')
+            Message.objects.using(shard).filter(conversation=conversation).delete()
+            seeded = 0
+            for rows in sorted(options['rows']):
+                self._seed(conversation, rows - seeded)
+                seeded = rows
+                self._compare(conversation, rows, options['repeat'])
+            transaction.set_rollback(True)
+
+    def _seed(self, conversation, count):
+        Message.objects.using(conversation._state.db).bulk_create(
+            (
+                Message(
+                    conversation=conversation,
+                    user_sender='A',
+                    sender_role=SenderRole.USER if number % 2 == 0 else SenderRole.BOT,
+                    user_text=f"Mensagem número {number}" if number % 2 == 0 else None,
+                    bot_text=None if number % 2 == 0 else "Obrigado por seu contato.",
+                )
+                for number in range(count)
+            ),
+            batch_size=5000,
+        )
+
+    def _compare(self, conversation, rows, repeat):
+        queryset = Message.objects.using(conversation._state.db).filter(
+            conversation=conversation
+        ).order_by('created_at')
+
+        def drf_path():
+            return JSONRenderer().render(MessageSerializer(queryset, many=True).data)
+
+        def fast_path():
+            return FastJSONRenderer().render(FastMessageSerializer.many(queryset))
+
+        drf_seconds, drf_body = self._best(drf_path, repeat)
+        fast_seconds, fast_body = self._best(fast_path, repeat)
+
+        self.stdout.write(
+            f"rows={rows:>7} drf={drf_seconds * 1000:9.1f}ms "
+            f"fast={fast_seconds * 1000:9.1f}ms "
+            f"speedup={drf_seconds / fast_seconds:5.1f}x "
+            f"identical={drf_body == fast_body}"
+        )
+
+    @staticmethod
+    def _best(path, repeat):
+        best, body = None, None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            body = path()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best, body
@@ -0,0 +1,160 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# Runs in a fresh interpreter per sample, so the clock starts before Django
+# is imported. The probe is an anonymous user_messages call: it goes through
+# every middleware and the ViewSet but answers 401 without touching the
+# database, so what's left is the stack itself.
+PROBE = r'''
+import time
+started = time.perf_counter()
+
+import io, json, sys
+import django
+django.setup()
+setup = time.perf_counter()
+
+from django.urls import get_resolver, resolve
+get_resolver().url_patterns
+urls = time.perf_counter()
+
+from django.core.handlers.wsgi import WSGIHandler, WSGIRequest
+from django.conf import settings
+from importlib import import_module
+from asgiref.sync import async_to_sync, iscoroutinefunction
+handler = WSGIHandler()
+middleware = time.perf_counter()
+
+PATH = '/api/message/user_messages/'
+
+def environ():
+    return {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': PATH, 'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost',
+        'HTTP_ACCEPT': 'application/json', 'wsgi.input': io.BytesIO(),
+        'wsgi.url_scheme': 'http',
+    }
+
+def through_stack():
+    response = handler(environ(), lambda status, headers: None)
+    response.close()
+    return response.status_code
+
+view = resolve(PATH).func
+if iscoroutinefunction(view):
+    # MESSAGE_ASYNC_VIEWS; the handler adapts it the same way under WSGI
+    view = async_to_sync(view)
+SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+
+def view_only():
+    request = WSGIRequest(environ())
+    request.session = SessionStore()
+    response = view(request)
+    if hasattr(response, 'render'):
+        response.render()
+    return response.status_code
+
+status = through_stack()
+first = time.perf_counter()
+
+def per_request(call, count):
+    began = time.perf_counter()
+    for _ in range(count):
+        call()
+    return (time.perf_counter() - began) / count
+
+count = int(sys.argv[1])
+per_request(through_stack, min(count, 100))
+stack = per_request(through_stack, count)
+bare = per_request(view_only, count)
+
+print(json.dumps({
+    'setup': setup - started,
+    'urls': urls - setup,
+    'middleware_load': middleware - urls,
+    'first_request': first - middleware,
+    'startup': first - started,
+    'status': status,
+    'middleware': len(settings.MIDDLEWARE),
+    'apps': len(settings.INSTALLED_APPS),
+    'stack': stack,
+    'view': bare,
+    'modules': len(sys.modules),
+}))
+'''
+
+PROFILES = ['full', 'api']
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the 'full' and API-only ('api') settings profiles: cold-start "
+        "time (django.setup, URLconf, middleware, first request) in fresh "
+        "interpreters, and the per-request overhead of the handler and "
+        "middleware: an anonymous user_messages call through the whole stack "
+        "minus the same call made on the view directly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5,
+                            help="Fresh interpreters per profile; medians are reported")
+        parser.add_argument('--requests', type=int, default=2000,
+                            help="Requests per run for the overhead figures")
+        parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=PROFILES)
+
+    def handle(self, *args, **options):
+        results = {}
+        for profile in options['profiles']:
+            samples = [
+                self._sample(profile, options['requests']) for _ in range(options['runs'])
+            ]
+            results[profile] = {
+                name: statistics.median(sample[name] for sample in samples)
+                for name in samples[0]
+            }
+            self._report(profile, results[profile])
+
+        if set(results) == {'full', 'api'}:
+            full, api = results['full'], results['api']
+            self.stdout.write(
+                f"api vs full: startup {self._change(full['startup'], api['startup'])}, "
+                f"middleware overhead "
+                f"{self._change(full['stack'] - full['view'], api['stack'] - api['view'])}, "
+                f"request {self._change(full['stack'], api['stack'])}"
+            )
+
+    def _sample(self, profile, requests):
+        completed = subprocess.run(
+            [sys.executable, '-c', PROBE, str(requests)],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, 'SETTINGS_PROFILE': profile},
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            raise CommandError(f"[{profile}] probe failed:\n{completed.stderr}")
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    def _report(self, profile, result):
+        ms = {name: value * 1000 for name, value in result.items()}
+        self.stdout.write(
+            f"profile={profile:<4} apps={result['apps']:.0f} "
+            f"middleware={result['middleware']:.0f} modules={result['modules']:.0f} "
+            f"status={result['status']:.0f}\n"
+            f"  startup={ms['startup']:7.1f}ms (setup={ms['setup']:.1f} "
+            f"urls={ms['urls']:.1f} middleware={ms['middleware_load']:.1f} "
+            f"first request={ms['first_request']:.1f})\n"
+            f"  request={ms['stack'] * 1000:7.1f}µs view={ms['view'] * 1000:.1f}µs "
+            f"middleware overhead={(ms['stack'] - ms['view']) * 1000:.1f}µs"
+        )
+
+    @staticmethod
+    def _change(before, after):
+        return f"{(after - before) / before * 100:+.1f}%"
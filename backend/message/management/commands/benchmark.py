@@ -0,0 +1,310 @@
+import json
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from http.cookies import SimpleCookie
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from message import buffer
+from message.models import Conversation, Message, SenderRole, USER_TYPE_CHOICES
+from message.sharding import shard_for, shards
+
+
+# Seeded conversations use synthetic users ("#" + 9 digits fits max_length=10)
+# that can never collide with a real login, whatever the DB collation
+BENCH_USER_PREFIX = '#'
+ENDPOINTS = ('login', 'send_message', 'user_messages')
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class InProcessDriver:
+    """Drives the API through Django's test client in this process"""
+    def __init__(self):
+        self.client = Client(SERVER_NAME='localhost')
+        self.urls = {name: reverse(f'message-{name.replace("_", "-")}') for name in ENDPOINTS}
+
+    def request(self, endpoint, data=None):
+        if endpoint == 'user_messages':
+            response = self.client.get(self.urls[endpoint])
+        else:
+            response = self.client.post(
+                self.urls[endpoint], json.dumps(data or {}), content_type='application/json'
+            )
+        return response.status_code, len(response.content)
+
+
+class LiveServerDriver:
+    """Drives a running server over HTTP, keeping its own session cookie"""
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.cookies = {}
+
+    def request(self, endpoint, data=None):
+        url = f"{self.base_url}/api/message/{endpoint}/"
+        body, method = None, 'GET'
+        if endpoint != 'user_messages':
+            body, method = json.dumps(data or {}).encode(), 'POST'
+        request = urllib.request.Request(url, data=body, method=method)
+        request.add_header('Content-Type', 'application/json')
+        if self.cookies:
+            # Session cookies are Secure, so a cookie jar wouldn't send them over http
+            request.add_header(
+                'Cookie', '; '.join(f"{key}={value}" for key, value in self.cookies.items())
+            )
+        try:
+            with urllib.request.urlopen(request) as response:
+                self._store_cookies(response.headers.get_all('Set-Cookie') or [])
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as error:
+            return error.code, len(error.read())
+
+    def _store_cookies(self, headers):
+        for header in headers:
+            cookie = SimpleCookie()
+            cookie.load(header)
+            for key, morsel in cookie.items():
+                self.cookies[key] = morsel.value
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed Message rows across many conversations, drive login/send_message/"
+        "user_messages concurrently and report throughput, p50/p95/p99 latency "
+        "and query counts per endpoint as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--conversations', type=int, default=1000,
+                            help="Synthetic conversations to seed")
+        parser.add_argument('--messages', type=int, default=100000,
+                            help="Messages seeded across those conversations")
+        parser.add_argument('--history', type=int, default=1000,
+                            help="Messages seeded into each of the A/B conversations")
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help="Simulated clients, one thread each")
+        parser.add_argument('--requests', type=int, default=200,
+                            help="Requests per client after logging in")
+        parser.add_argument('--read-ratio', type=float, default=0.8,
+                            help="Share of requests that are user_messages")
+        parser.add_argument('--url', default=None,
+                            help="Base URL of a running server; in-process when omitted")
+        parser.add_argument('--no-seed', action='store_true',
+                            help="Reuse the rows already in the database")
+        parser.add_argument('--cleanup', action='store_true',
+                            help="Delete everything the run created afterwards")
+        parser.add_argument('--output', default=None,
+                            help="Write the JSON report to this file instead of stdout")
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        first_new_ids = {
+            shard: (
+                Message.objects.using(shard).order_by('-id').values_list('id', flat=True).first()
+                or 0
+            ) + 1
+            for shard in shards()
+        }
+
+        seed_seconds = None
+        if not options['no_seed']:
+            started = time.perf_counter()
+            self._seed(options['conversations'], options['messages'], options['history'])
+            seed_seconds = time.perf_counter() - started
+
+        # A handful of clients sending hundreds of messages each is exactly
+        # what the rate limits refuse; in process, measure the API without them
+        limits = {} if not options['url'] else settings.MESSAGE_RATE_LIMITS
+        try:
+            with override_settings(MESSAGE_RATE_LIMITS=limits):
+                report = self._drive(options)
+            if not options['url'] and buffer.enabled():
+                # Write-behind rows must be in the table before --cleanup runs
+                buffer.get_buffer().flush()
+        finally:
+            if options['cleanup']:
+                for shard, first_new_id in first_new_ids.items():
+                    Message.objects.using(shard).filter(id__gte=first_new_id).delete()
+                    Conversation.objects.using(shard).filter(
+                        user__startswith=BENCH_USER_PREFIX
+                    ).delete()
+
+        report['config'] = {
+            'vendor': connection.vendor,
+            'mode': 'live' if options['url'] else 'in-process',
+            'url': options['url'],
+            'conversations': options['conversations'],
+            'messages': options['messages'],
+            'history': options['history'],
+            'concurrency': options['concurrency'],
+            'requests_per_client': options['requests'],
+            'read_ratio': options['read_ratio'],
+            'seed_seconds': seed_seconds,
+        }
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as report_file:
+                report_file.write(output)
+        else:
+            self.stdout.write(output)
+
+    def _seed(self, conversation_count, message_count, history):
+        names = [f"{BENCH_USER_PREFIX}{number:09d}" for number in range(conversation_count)]
+        conversations = []
+        for shard in shards():
+            # Conversations left by an earlier run without --cleanup are reused
+            Conversation.objects.using(shard).bulk_create(
+                (Conversation(user=name) for name in names if shard_for(name) == shard),
+                batch_size=5000,
+                ignore_conflicts=True,
+            )
+            conversations.extend(
+                Conversation.objects.using(shard).filter(user__startswith=BENCH_USER_PREFIX)
+                .order_by('user')[:conversation_count]
+            )
+        conversations = sorted(conversations, key=lambda conversation: conversation.user)
+        conversations = conversations[:conversation_count]
+        users = [user for user, _ in USER_TYPE_CHOICES]
+        own = [Conversation.objects.for_user(user) for user in users]
+
+        def rows():
+            for number in range(message_count):
+                if not conversations:
+                    break
+                yield self._message(self.rng.choice(conversations), number)
+            for conversation in own:
+                for number in range(history):
+                    yield self._message(conversation, number)
+
+        batches = {shard: [] for shard in shards()}
+        for message in rows():
+            batch = batches[message.conversation._state.db]
+            batch.append(message)
+            if len(batch) == 5000:
+                Message.objects.using(message.conversation._state.db).bulk_create(batch)
+                batch.clear()
+        for shard, batch in batches.items():
+            if batch:
+                Message.objects.using(shard).bulk_create(batch)
+
+    @staticmethod
+    def _message(conversation, number):
+        is_user = number % 2 == 0
+        return Message(
+            conversation=conversation,
+            user_sender=conversation.user,
+            sender_role=SenderRole.USER if is_user else SenderRole.BOT,
+            user_text=f"Mensagem de teste {number}" if is_user else None,
+            bot_text=None if is_user else "Obrigado por seu contato. Em breve responderemos.",
+        )
+
+    def _drive(self, options):
+        samples = {endpoint: [] for endpoint in ENDPOINTS}
+        lock = threading.Lock()
+        users = [user for user, _ in USER_TYPE_CHOICES]
+
+        def client(number):
+            rng = random.Random(options['seed'] + number)
+            driver = LiveServerDriver(options['url']) if options['url'] else InProcessDriver()
+            results = []
+            user = users[number % len(users)]
+            results.append(self._timed(driver, 'login', {'user': user}))
+            for _ in range(options['requests']):
+                if rng.random() < options['read_ratio']:
+                    results.append(self._timed(driver, 'user_messages'))
+                else:
+                    text = f"Mensagem {rng.randrange(10 ** 6)}"
+                    results.append(self._timed(driver, 'send_message', {'text': text}))
+            with lock:
+                for endpoint, sample in results:
+                    samples[endpoint].append(sample)
+            # Threads own their connections; the single-client run borrows the caller's
+            if not options['url'] and options['concurrency'] > 1:
+                connection.close()
+
+        started = time.perf_counter()
+        if options['concurrency'] == 1:
+            client(0)
+        else:
+            threads = [
+                threading.Thread(target=client, args=(number,))
+                for number in range(options['concurrency'])
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - started
+
+        endpoints = {
+            endpoint: self._summary(endpoint_samples, elapsed)
+            for endpoint, endpoint_samples in samples.items()
+        }
+        every_sample = [sample for endpoint_samples in samples.values() for sample in endpoint_samples]
+        return {
+            'elapsed_seconds': round(elapsed, 3),
+            'total': self._summary(every_sample, elapsed),
+            'endpoints': endpoints,
+        }
+
+    def _timed(self, driver, endpoint, data=None):
+        with self._count_queries() as queries:
+            started = time.perf_counter()
+            status_code, size = driver.request(endpoint, data)
+            latency = time.perf_counter() - started
+        return endpoint, {
+            'latency': latency,
+            'ok': status_code < 400,
+            'bytes': size,
+            # Only known when the server runs in this process
+            'queries': None if isinstance(driver, LiveServerDriver) else queries[0],
+        }
+
+    @staticmethod
+    @contextmanager
+    def _count_queries():
+        counter = [0]
+
+        def wrapper(execute, sql, params, many, context):
+            counter[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(wrapper):
+            yield counter
+
+    @staticmethod
+    def _summary(samples, elapsed):
+        latencies = sorted(sample['latency'] * 1000 for sample in samples)
+        queries = [sample['queries'] for sample in samples if sample['queries'] is not None]
+
+        def ms(value):
+            return None if value is None else round(value, 3)
+
+        return {
+            'requests': len(samples),
+            'errors': sum(1 for sample in samples if not sample['ok']),
+            'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+            'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+            'p50_ms': ms(percentile(latencies, 0.50)),
+            'p95_ms': ms(percentile(latencies, 0.95)),
+            'p99_ms': ms(percentile(latencies, 0.99)),
+            'max_ms': ms(latencies[-1]) if latencies else None,
+            'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+            'mean_bytes': round(sum(s['bytes'] for s in samples) / len(samples)) if samples else None,
+        }
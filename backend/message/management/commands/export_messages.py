@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from message.export import (
+    DEFAULT_CHUNK_SIZE, FORMATS, ExportEncoder, export_querysets, iter_export, parse_bound,
+)
+from message.models import USER_TYPE_CHOICES
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream messages as NDJSON or CSV, optionally gzipped, filtered by "
+        "user and date range. Memory use doesn't grow with the export."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--user', action='append', dest='users',
+                            choices=[user for user, _ in USER_TYPE_CHOICES],
+                            help="Repeat for several users; all users by default")
+        parser.add_argument('--since', help="ISO date or datetime, inclusive")
+        parser.add_argument('--until', help="ISO date (inclusive) or datetime (exclusive)")
+        parser.add_argument('--gzip', action='store_true')
+        parser.add_argument('--output', default='-', help="File to write; '-' for stdout")
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_bound(options['since'])
+            until = parse_bound(options['until'], end=True)
+        except ValueError as exc:
+            raise CommandError(f"Invalid date: {exc}")
+
+        parts = iter_export(
+            export_querysets(options['users'], since, until),
+            ExportEncoder(options['format'], options['gzip']),
+            options['chunk_size'],
+        )
+        if options['output'] == '-':
+            self._write(sys.stdout.buffer, parts)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options['output'], 'wb') as output:
+                self._write(output, parts)
+
+    @staticmethod
+    def _write(output, parts):
+        for part in parts:
+            output.write(part)
@@ -0,0 +1,75 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from message.imports import (
+    MessageImporter, detect_format, open_source, read_records, source_key,
+)
+from message.models import ImportProgress
+from message.sharding import shards
+
+
+MAX_REPORTED_ERRORS = 20
+
+
+class Command(BaseCommand):
+    help = (
+        "Load messages from NDJSON or CSV files (optionally .gz) in chunks: "
+        "COPY on PostgreSQL, bulk_create elsewhere. An interrupted import "
+        "resumes where its last committed chunk ended."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+')
+        parser.add_argument('--format', choices=['ndjson', 'csv'],
+                            help="Taken from the file extension by default")
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--restart', action='store_true',
+                            help="Forget earlier progress and import from the start")
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            try:
+                fmt = options['format'] or detect_format(path)
+            except ValueError:
+                raise CommandError(f"Can't tell the format of {path}; pass --format")
+            self._import(path, fmt, options)
+
+    def _import(self, path, fmt, options):
+        key = source_key(path)
+        if options['restart']:
+            for shard in shards():
+                ImportProgress.objects.using(shard).filter(source=key).delete()
+
+        importer = MessageImporter(key, options['chunk_size'])
+        if importer.resume_after:
+            self.stdout.write(f"{path}: resuming after record {importer.resume_after}")
+
+        started = time.perf_counter()
+
+        def report(importer):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"{path}: {importer.imported} rows imported "
+                f"({importer.imported / elapsed:,.0f} rows/s)"
+            )
+
+        try:
+            with open_source(path) as source:
+                importer.run(read_records(source, fmt), on_chunk=report)
+        except OSError as exc:
+            raise CommandError(str(exc))
+
+        for number, error in importer.errors[:MAX_REPORTED_ERRORS]:
+            self.stderr.write(f"{path}: record {number} skipped: {error}")
+        if len(importer.errors) > MAX_REPORTED_ERRORS:
+            self.stderr.write(
+                f"{path}: {len(importer.errors) - MAX_REPORTED_ERRORS} more records skipped"
+            )
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{path}: done, {importer.imported} rows in {elapsed:.1f}s "
+            f"({importer.imported / elapsed if elapsed else 0:,.0f} rows/s), "
+            f"{len(importer.errors)} skipped"
+        )
@@ -0,0 +1,23 @@
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from message.sharding import shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Run migrate on every database in MESSAGE_SHARDS. The message app is "
+        "migrated everywhere, the other apps only on 'default'."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--noinput', '--no-input', action='store_false',
+                            dest='interactive')
+
+    def handle(self, *args, **options):
+        for shard in shards():
+            self.stdout.write(f"Migrating {shard}")
+            call_command(
+                'migrate', database=shard, interactive=options['interactive'],
+                verbosity=options['verbosity'], stdout=self.stdout, stderr=self.stderr
+            )
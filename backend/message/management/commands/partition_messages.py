@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from message import partitions
+from message.sharding import shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the monthly message partitions ahead of time (PostgreSQL). "
+        "--convert turns the plain message table into a partitioned one first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--convert', action='store_true',
+                            help="Partition the existing table (locks it while it runs)")
+        parser.add_argument('--months-ahead', type=int,
+                            default=settings.MESSAGE_PARTITION_MONTHS_AHEAD)
+
+    def handle(self, *args, **options):
+        for shard in shards():
+            self.partition(shard, options)
+
+    def partition(self, shard, options):
+        if options['convert']:
+            try:
+                converted = partitions.convert(using=shard)
+            except partitions.PartitioningError as exc:
+                raise CommandError(f"[{shard}] {exc}")
+            self.stdout.write(
+                f"[{shard}] Converted the message table" if converted
+                else f"[{shard}] Already partitioned"
+            )
+
+        if not partitions.is_partitioned(shard):
+            self.stdout.write(f"[{shard}] The message table isn't partitioned; nothing to create")
+            return
+
+        created = partitions.ensure_partitions(options['months_ahead'], using=shard)
+        for name in created:
+            self.stdout.write(f"[{shard}] Created {name}")
+        if not created:
+            self.stdout.write(f"[{shard}] All partitions already exist")
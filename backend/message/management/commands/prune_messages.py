@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from message import idempotency, partitions
+from message.sharding import shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply the message retention policy: expired monthly partitions are "
+        "archived as gzipped CSV and dropped, any other expired rows are "
+        "deleted in chunks. Expired idempotency keys are deleted as well."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.MESSAGE_RETENTION_DAYS,
+                            help="Keep this many days of messages (0 keeps everything)")
+        parser.add_argument('--archive-dir', default=settings.MESSAGE_ARCHIVE_DIR)
+        parser.add_argument('--chunk-size', type=int,
+                            default=settings.MESSAGE_RETENTION_CHUNK_SIZE,
+                            help="Rows per DELETE for rows outside dropped partitions")
+
+    def handle(self, *args, **options):
+        for shard in shards():
+            self.prune(shard, options)
+
+    def prune(self, shard, options):
+        expired_keys = idempotency.delete_expired(using=shard)
+        self.stdout.write(f"[{shard}] Deleted {expired_keys} expired idempotency keys")
+
+        if options['days'] <= 0:
+            self.stdout.write(f"[{shard}] No retention configured; nothing to prune")
+            return
+
+        dropped, deleted = partitions.apply_retention(
+            options['days'], options['archive_dir'], options['chunk_size'], using=shard
+        )
+        for name in dropped:
+            self.stdout.write(f"[{shard}] Archived and dropped {name}")
+        self.stdout.write(f"[{shard}] Deleted {deleted} expired messages")
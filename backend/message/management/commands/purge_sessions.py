@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+
+DB_BACKED_ENGINES = {
+    'django.contrib.sessions.backends.db',
+    'django.contrib.sessions.backends.cached_db',
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Empty the django_session table once sessions no longer live in the "
+        "database (SESSION_MODE=cookie or cache). Meant to run after migrate."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true',
+                            help="Purge even while sessions are database-backed")
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help="Rows per DELETE when TRUNCATE isn't available")
+
+    def handle(self, *args, **options):
+        if settings.SESSION_ENGINE in DB_BACKED_ENGINES and not options['force']:
+            self.stdout.write("Sessions are database-backed; nothing to purge")
+            return
+
+        table = Session._meta.db_table
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f'TRUNCATE TABLE "{table}"')
+            self.stdout.write(f"Truncated {table}")
+            return
+
+        deleted = 0
+        while True:
+            keys = list(
+                Session.objects.values_list('pk', flat=True)[:options['chunk_size']]
+            )
+            if not keys:
+                break
+            deleted += Session.objects.filter(pk__in=keys).delete()[0]
+        self.stdout.write(f"Deleted {deleted} rows from {table}")
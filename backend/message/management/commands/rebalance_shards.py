@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from message.rebalance import CHUNK_SIZE, rebalance
+
+
+class Command(BaseCommand):
+    help = (
+        "Move conversations to the shard their user hashes to, after databases "
+        "were added to MESSAGE_SHARDS. Safe to interrupt and run again; run it "
+        "until nothing is left to move."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help="Messages copied per transaction")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only list the conversations that would move")
+
+    def handle(self, *args, **options):
+        moved = rebalance(chunk_size=options['chunk_size'], dry_run=options['dry_run'])
+        verb = "Would move" if options['dry_run'] else "Moved"
+        for user, source, target, count in moved:
+            self.stdout.write(f"{verb} {user} ({count} messages): {source} -> {target}")
+        if not moved:
+            self.stdout.write("Every conversation is on its shard")
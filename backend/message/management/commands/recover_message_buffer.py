@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from message.buffer import WriteBuffer
+
+
+class Command(BaseCommand):
+    help = (
+        "Insert the messages left in write-behind spill files by workers that "
+        "stopped before flushing them. Files still held by a running worker "
+        "are left alone."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=settings.MESSAGE_BUFFER_DIR)
+
+    def handle(self, *args, **options):
+        recovered = WriteBuffer(options['dir'], background=False).recover()
+        self.stdout.write(f"Recovered {recovered} buffered messages")
@@ -0,0 +1,40 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from message.jobs import run_workers
+
+
+class Command(BaseCommand):
+    help = "Consume queued bot replies (MESSAGE_REPLY_MODE=queue)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help="Worker threads per shard, each with its own DB connection")
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help="Jobs claimed per poll")
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty")
+        parser.add_argument('--max-attempts', type=int, default=None,
+                            help="Attempts before a job is marked dead")
+        parser.add_argument('--drain', action='store_true',
+                            help="Exit once no job is ready instead of polling")
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+
+        self.stdout.write(
+            f"Reply worker started with {options['concurrency']} thread(s) per shard"
+        )
+        run_workers(
+            concurrency=options['concurrency'],
+            poll_interval=options['poll_interval'],
+            drain=options['drain'],
+            stop_event=stop_event,
+            batch_size=options['batch_size'],
+            max_attempts=options['max_attempts'],
+        )
+        self.stdout.write("Reply worker stopped")
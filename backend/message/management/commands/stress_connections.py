@@ -0,0 +1,201 @@
+import io
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import override_settings
+
+from message import metrics
+from message.management.commands.benchmark import percentile
+from message.models import Message, USER_TYPE_CHOICES
+from message.sharding import shards
+
+
+MODES = ('direct', 'persistent', 'pool')
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive concurrent send_message requests through the full WSGI stack "
+        "with a new connection per request ('direct'), persistent health-"
+        "checked connections ('persistent') and a psycopg pool ('pool', "
+        "PostgreSQL only), and report latency next to how often and for how "
+        "long requests waited to get a connection. Messages it sends are "
+        "deleted afterwards."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32],
+                            help="Simulated clients, one thread each")
+        parser.add_argument('--requests', type=int, default=50,
+                            help="send_message calls per client")
+
+    def handle(self, *args, **options):
+        modes = options['modes']
+        if 'pool' in modes and connection.vendor != 'postgresql':
+            self.stdout.write("Skipping 'pool': connection pools need PostgreSQL")
+            modes = [mode for mode in modes if mode != 'pool']
+
+        first_new_ids = {
+            shard: (
+                Message.objects.using(shard).order_by('-id').values_list('id', flat=True).first()
+                or 0
+            ) + 1
+            for shard in shards()
+        }
+        self.handler = WSGIHandler()
+        try:
+            # Hundreds of messages a minute per user is what the rate limits
+            # refuse, and shedding would hide the waits this is measuring
+            with override_settings(MESSAGE_RATE_LIMITS={}, MESSAGE_MAX_CONCURRENT_REQUESTS=0):
+                for mode in modes:
+                    with connection_mode(mode):
+                        for clients in options['concurrency']:
+                            self._report(mode, clients, self._drive(clients, options['requests']))
+        finally:
+            for shard, first_new_id in first_new_ids.items():
+                Message.objects.using(shard).filter(id__gte=first_new_id).delete()
+
+    def _drive(self, clients, requests):
+        latencies, errors = [], []
+        lock = threading.Lock()
+        users = [user for user, _ in USER_TYPE_CHOICES]
+
+        def client(number):
+            cookies = {}
+            self._request('login', {'user': users[number % len(users)]}, cookies)
+            mine, failed = [], 0
+            for sequence in range(requests):
+                started = time.perf_counter()
+                status_code = self._request(
+                    'send_message', {'text': f"Carga {number}-{sequence}"}, cookies
+                )
+                mine.append(time.perf_counter() - started)
+                failed += status_code >= 400
+            with lock:
+                latencies.extend(mine)
+                errors.append(failed)
+            connections.close_all()
+
+        before = metrics.registry.snapshot()
+        started = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        after = metrics.registry.snapshot()
+
+        return {
+            'requests': len(latencies),
+            'errors': sum(errors),
+            'elapsed': elapsed,
+            'latencies': sorted(latencies),
+            'acquire': self._delta(before, after, 'message_db_connection_acquire_seconds'),
+            'queued': self._delta(before, after, 'message_db_pool_queued_total'),
+            'waited': self._delta(before, after, 'message_db_pool_wait_seconds_total'),
+            'opened': self._delta(before, after, 'message_db_pool_connects_total'),
+        }
+
+    def _request(self, action, data, cookies):
+        body = json.dumps(data).encode()
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'PATH_INFO': f'/api/message/{action}/',
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80',
+            'HTTP_HOST': 'localhost',
+            'CONTENT_TYPE': 'application/json',
+            'CONTENT_LENGTH': str(len(body)),
+            # Session cookies are Secure; sent by hand like the live benchmark does
+            'HTTP_COOKIE': '; '.join(f"{key}={value}" for key, value in cookies.items()),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.url_scheme': 'http',
+        }
+        response = self.handler(environ, lambda status, headers: None)
+        for key, morsel in response.cookies.items():
+            cookies[key] = morsel.value
+        response.close()
+        return response.status_code
+
+    @staticmethod
+    def _delta(before, after, name):
+        """``after - before`` summed over databases; histograms give ``(count, seconds)``"""
+        count = seconds = 0
+        for key, value in after.items():
+            if key[0] != name:
+                continue
+            previous = before.get(key)
+            if isinstance(value, list):
+                previous = previous or [0] * len(value)
+                count += sum(value[:-1]) - sum(previous[:-1])
+                seconds += value[-1] - previous[-1]
+            else:
+                count += value - (previous or 0)
+        return (count, seconds) if name in metrics.HISTOGRAMS else count
+
+    def _report(self, mode, clients, result):
+        latencies = [latency * 1000 for latency in result['latencies']]
+        acquires, acquire_seconds = result['acquire']
+        line = (
+            f"mode={mode:<10} clients={clients:>3} requests={result['requests']:>5} "
+            f"errors={result['errors']} "
+            f"rps={result['requests'] / result['elapsed']:8.1f} "
+            f"p50={percentile(latencies, 0.50):7.2f}ms p99={percentile(latencies, 0.99):7.2f}ms"
+        )
+        if acquires:
+            line += (
+                f" | acquires={acquires} ({acquires / result['requests']:.2f}/request) "
+                f"mean={acquire_seconds / acquires * 1000:.3f}ms "
+                f"total={acquire_seconds * 1000:.1f}ms"
+            )
+        if mode == 'pool':
+            line += (
+                f" | pool opened={result['opened']} queued={result['queued']} "
+                f"waited={result['waited'] * 1000:.1f}ms"
+            )
+        self.stdout.write(line)
+
+
+@contextmanager
+def connection_mode(mode):
+    """Switch every database to ``mode`` for the duration, then restore it"""
+    saved = {
+        alias: {key: connections.settings[alias].get(key) for key in (
+            'CONN_MAX_AGE', 'CONN_HEALTH_CHECKS', 'OPTIONS'
+        )}
+        for alias in connections
+    }
+    _close_everything()
+    for alias in connections:
+        options = {
+            key: value for key, value in saved[alias]['OPTIONS'].items() if key != 'pool'
+        }
+        if mode == 'pool':
+            options['pool'] = settings.DATABASE_POOL_OPTIONS
+        connections.settings[alias].update({
+            'CONN_MAX_AGE': None if mode == 'persistent' else 0,
+            'CONN_HEALTH_CHECKS': mode != 'direct',
+            'OPTIONS': options,
+        })
+    try:
+        yield
+    finally:
+        _close_everything()
+        for alias, values in saved.items():
+            connections.settings[alias].update(values)
+
+
+def _close_everything():
+    connections.close_all()
+    for alias in connections:
+        if connections.settings[alias]['OPTIONS'].get('pool'):
+            connections[alias].close_pool()
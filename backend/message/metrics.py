@@ -0,0 +1,321 @@
+"""
+Per-request metrics exposed in the Prometheus text format.
+
+Every thread records into its own shard, so observing a request never takes a
+lock; a scrape sums the shards. Worker processes can't see each other's
+memory, so with MESSAGE_METRICS_DIR set each process also writes its totals
+to a file of its own there and the metrics view adds up the files of the
+processes still running; a dead worker's file is deleted. Histograms and
+counters are summed, gauges are point-in-time values of one process and are
+reported per ``pid`` instead.
+
+The endpoint answers staff users and clients whose address is in
+MESSAGE_METRICS_ALLOWED_IPS (loopback by default) only.
+
+Databases with a psycopg connection pool (DATABASE_POOL) report its size,
+waiters and checkout counters too, read from the pool when totals are taken.
+"""
+import contextvars
+import ipaddress
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections
+
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+HISTOGRAMS = {
+    'message_request_duration_seconds': ("Wall time per request", DURATION_BUCKETS),
+    'message_request_db_seconds': ("Time spent in database queries per request", DURATION_BUCKETS),
+    'message_request_queries': ("Database queries per request", QUERY_BUCKETS),
+    'message_request_serialization_seconds': ("Time spent rendering the response body", DURATION_BUCKETS),
+    'message_response_size_bytes': ("Response body size in bytes", SIZE_BUCKETS),
+    'message_db_connection_acquire_seconds': (
+        "Time to get a database connection: a new one, or a checkout from the pool",
+        DURATION_BUCKETS,
+    ),
+}
+
+COUNTERS = {
+    'message_requests_total': "Requests by view, method and status code",
+    'message_db_pool_checkouts_total': "Connections handed out by the pool",
+    'message_db_pool_queued_total': "Checkouts that had to wait for a connection",
+    'message_db_pool_wait_seconds_total': "Time checkouts spent waiting for a connection",
+    'message_db_pool_timeouts_total': "Checkouts that gave up waiting",
+    'message_db_pool_connects_total': "Connections the pool opened",
+    'message_db_pool_connect_seconds_total': "Time the pool spent opening connections",
+}
+
+GAUGES = {
+    'message_db_pool_connections': "Connections the pool holds, idle or in use",
+    'message_db_pool_idle_connections': "Connections waiting in the pool",
+    'message_db_pool_max_connections': "Most connections the pool may hold",
+    'message_db_pool_waiting': "Requests waiting for a connection right now",
+}
+
+# Metric name -> (psycopg_pool stat, scale)
+POOL_STATS = {
+    'message_db_pool_checkouts_total': ('requests_num', 1),
+    'message_db_pool_queued_total': ('requests_queued', 1),
+    'message_db_pool_wait_seconds_total': ('requests_wait_ms', 0.001),
+    'message_db_pool_timeouts_total': ('requests_errors', 1),
+    'message_db_pool_connects_total': ('connections_num', 1),
+    'message_db_pool_connect_seconds_total': ('connections_ms', 0.001),
+    'message_db_pool_connections': ('pool_size', 1),
+    'message_db_pool_idle_connections': ('pool_available', 1),
+    'message_db_pool_max_connections': ('pool_max', 1),
+    'message_db_pool_waiting': ('requests_waiting', 1),
+}
+
+
+class RequestStats:
+    """What a single request spent in the database and in rendering"""
+    __slots__ = ('queries', 'db_seconds', 'serialization_seconds', 'statements')
+
+    def __init__(self, capture_sql=False):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = None
+        self.statements = [] if capture_sql else None
+
+
+_current = contextvars.ContextVar('message_request_stats', default=None)
+
+
+def start_request(capture_sql=False):
+    stats = RequestStats(capture_sql)
+    return stats, _current.set(stats)
+
+
+def finish_request(token):
+    _current.reset(token)
+
+
+def record_serialization(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.serialization_seconds = (stats.serialization_seconds or 0.0) + seconds
+
+
+def record_connection(alias, seconds):
+    registry.observe('message_db_connection_acquire_seconds', seconds, (('database', alias),))
+
+
+def pool_totals():
+    """``{(name, labels): value}`` from every database pool this process has"""
+    totals = {}
+    for alias in connections:
+        if not connections.settings[alias].get('OPTIONS', {}).get('pool'):
+            continue
+        stats = connections[alias].pool.get_stats()
+        for name, (stat, scale) in POOL_STATS.items():
+            totals[(name, (('database', alias),))] = stats.get(stat, 0) * scale
+    return totals
+
+
+def instrument_queries(execute, sql, params, many, context):
+    """Execute wrapper charging each query to the request being served"""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        if stats.statements is not None:
+            stats.statements.append((elapsed, sql))
+
+
+class MetricsRegistry:
+    """
+    Histograms and counters split into one shard per thread.
+
+    A shard is only ever written by its own thread, and reading it is a
+    single ``dict.copy()``, which the GIL makes atomic. Histogram series
+    are ``[count per bucket..., count above the last bucket, sum]``.
+    """
+    def __init__(self, extra=None):
+        # Totals kept elsewhere (the connection pools), read on every snapshot
+        self._extra = extra
+        self._local = threading.local()
+        self._shards = []
+        self._flushed_at = 0.0
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            self._shards.append(shard)
+        return shard
+
+    def observe(self, name, value, labels):
+        buckets = HISTOGRAMS[name][1]
+        shard = self._shard()
+        key = (name, labels)
+        series = shard.get(key)
+        if series is None:
+            series = shard[key] = [0] * (len(buckets) + 1) + [0.0]
+        series[bisect_left(buckets, value)] += 1
+        series[-1] += value
+
+    def inc(self, name, labels, amount=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def snapshot(self):
+        """This process's totals as ``{(name, labels): series or count}``"""
+        totals = {}
+        for shard in list(self._shards):
+            for key, value in shard.copy().items():
+                _merge(totals, key, list(value) if isinstance(value, list) else value)
+        if self._extra is not None:
+            totals.update(self._extra())
+        return totals
+
+    def clear(self):
+        for shard in list(self._shards):
+            shard.clear()
+
+    def flush(self, force=False):
+        """Write this process's totals to MESSAGE_METRICS_DIR, at most once per interval"""
+        directory = settings.MESSAGE_METRICS_DIR
+        if not directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._flushed_at < settings.MESSAGE_METRICS_FLUSH_INTERVAL:
+            return
+        self._flushed_at = now
+
+        os.makedirs(directory, exist_ok=True)
+        path = Path(directory) / f"metrics-{os.getpid()}.json"
+        temporary = path.with_name(f"{path.name}.{threading.get_ident()}.tmp")
+        temporary.write_text(json.dumps([
+            [name, [list(label) for label in labels], value]
+            for (name, labels), value in self.snapshot().items()
+        ]))
+        os.replace(temporary, path)
+
+    def collect(self):
+        """Totals across the live worker processes sharing MESSAGE_METRICS_DIR"""
+        directory = settings.MESSAGE_METRICS_DIR
+        if not directory:
+            return self.snapshot()
+
+        self.flush(force=True)
+        totals = {}
+        for path in Path(directory).glob('metrics-*.json'):
+            pid = path.stem.removeprefix('metrics-')
+            if not _alive(pid):
+                # A recycled worker's totals would otherwise count forever
+                path.unlink(missing_ok=True)
+                continue
+            try:
+                entries = json.loads(path.read_text())
+            except (OSError, ValueError):
+                continue
+            for name, labels, value in entries:
+                labels = tuple(tuple(label) for label in labels)
+                if name in GAUGES:
+                    labels += (('pid', pid),)
+                _merge(totals, (name, labels), value)
+        return totals
+
+
+def _alive(pid):
+    try:
+        pid = int(pid)
+    except ValueError:
+        return False
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Someone else's process, but running
+        return True
+    return True
+
+
+def allowed(request):
+    """Whether ``request`` may read the metrics: staff, or an allowed address"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    try:
+        # Not X-Forwarded-For, which any client can set
+        address = ipaddress.ip_address(request.META.get('REMOTE_ADDR', ''))
+    except ValueError:
+        return False
+    return any(
+        address in ipaddress.ip_network(network, strict=False)
+        for network in settings.MESSAGE_METRICS_ALLOWED_IPS
+    )
+
+
+def _merge(totals, key, value):
+    current = totals.get(key)
+    if current is None:
+        totals[key] = value
+    elif isinstance(current, list):
+        totals[key] = [left + right for left, right in zip(current, value)]
+    else:
+        totals[key] = current + value
+
+
+registry = MetricsRegistry(extra=pool_totals)
+
+
+def render(totals):
+    """Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        for (series_name, labels), series in sorted(totals.items()):
+            if series_name != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                le = bound if bound == '+Inf' else _number(bound)
+                lines.append(f"{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {_number(series[-1])}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    for name, help_text in COUNTERS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+        for (series_name, labels), value in sorted(totals.items()):
+            if series_name == name:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+    for name, help_text in GAUGES.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        for (series_name, labels), value in sorted(totals.items()):
+            if series_name == name:
+                lines.append(f"{name}{_labels(labels)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -0,0 +1,109 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.signals import request_started
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .metrics import finish_request, instrument_queries, registry, start_request
+
+
+slow_logger = logging.getLogger('message.slow_requests')
+
+MAX_LOGGED_STATEMENTS = 100
+
+
+def _instrument_connection(connection, **kwargs):
+    if instrument_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(instrument_queries)
+
+
+class RequestMetricsMiddleware:
+    """
+    Records wall time, DB time, query count, rendering time and response
+    size for every request, labelled by view, into ``metrics.registry``.
+
+    Requests slower than MESSAGE_SLOW_REQUEST_MS are logged to
+    ``message.slow_requests`` together with the SQL they ran.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.MESSAGE_METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+        # Connections opened from now on are instrumented as they open;
+        # ones that already exist get the wrapper on their next request
+        connection_created.connect(_instrument_connection, dispatch_uid='message-metrics')
+        request_started.connect(self._instrument_open_connections, dispatch_uid='message-metrics')
+
+    @staticmethod
+    def _instrument_open_connections(**kwargs):
+        for connection in connections.all(initialized_only=True):
+            _instrument_connection(connection)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        stats, token = start_request(capture_sql=settings.MESSAGE_SLOW_REQUEST_MS > 0)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            finish_request(token)
+        self._record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats, token = start_request(capture_sql=settings.MESSAGE_SLOW_REQUEST_MS > 0)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            finish_request(token)
+        self._record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def _record(self, request, response, stats, elapsed):
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        labels = (('view', view), ('method', request.method))
+
+        registry.observe('message_request_duration_seconds', elapsed, labels)
+        registry.observe('message_request_db_seconds', stats.db_seconds, labels)
+        registry.observe('message_request_queries', stats.queries, labels)
+        if stats.serialization_seconds is not None:
+            registry.observe(
+                'message_request_serialization_seconds', stats.serialization_seconds, labels
+            )
+        # Streaming bodies (the SSE stream) have no size up front
+        if not response.streaming:
+            registry.observe('message_response_size_bytes', len(response.content), labels)
+        registry.inc('message_requests_total', labels + (('status', str(response.status_code)),))
+        registry.flush()
+
+        if stats.statements is not None and elapsed * 1000 >= settings.MESSAGE_SLOW_REQUEST_MS:
+            self._log_slow(request, view, elapsed, stats)
+
+    @staticmethod
+    def _log_slow(request, view, elapsed, stats):
+        statements = '\n'.join(
+            f"  {seconds * 1000:8.2f}ms  {sql}"
+            for seconds, sql in stats.statements[:MAX_LOGGED_STATEMENTS]
+        )
+        if len(stats.statements) > MAX_LOGGED_STATEMENTS:
+            statements += f"\n  ... {len(stats.statements) - MAX_LOGGED_STATEMENTS} more"
+        slow_logger.warning(
+            "Slow request %s %s (%s): %.1fms, %d queries, %.1fms in the database\n%s",
+            request.method, request.path, view, elapsed * 1000,
+            stats.queries, stats.db_seconds * 1000, statements,
+        )
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0003_alter_message_bot_text_alter_message_user_text'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['user_sender', 'created_at', 'id'], name='message_sender_created_idx'),
+        ),
+    ]
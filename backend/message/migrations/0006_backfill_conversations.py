@@ -0,0 +1,50 @@
+from django.db import migrations
+
+
+BOT_PREFIX = "Usuário: "
+
+
+def backfill_conversations(apps, schema_editor):
+    """
+    Bot rows used to store "Usuário: <user>" in user_sender; move them to
+    sender_role='bot' and attach every row to its user's Conversation.
+    Updates are set-based, one per distinct user_sender value.
+    """
+    db = schema_editor.connection.alias
+    Conversation = apps.get_model('message', 'Conversation')
+    Message = apps.get_model('message', 'Message')
+
+    senders = Message.objects.using(db).values_list('user_sender', flat=True).distinct()
+    for sender in list(senders):
+        if sender.startswith(BOT_PREFIX):
+            user, role = sender[len(BOT_PREFIX):], 'bot'
+        else:
+            user, role = sender, 'user'
+        conversation, _ = Conversation.objects.using(db).get_or_create(user=user)
+        Message.objects.using(db).filter(user_sender=sender).update(
+            user_sender=user, sender_role=role, conversation=conversation
+        )
+
+
+def restore_bot_senders(apps, schema_editor):
+    db = schema_editor.connection.alias
+    Message = apps.get_model('message', 'Message')
+
+    bot_senders = Message.objects.using(db).filter(sender_role='bot').values_list(
+        'user_sender', flat=True
+    ).distinct()
+    for user in list(bot_senders):
+        Message.objects.using(db).filter(sender_role='bot', user_sender=user).update(
+            user_sender=f"{BOT_PREFIX}{user}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0005_conversation_message_sender_role'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversations, restore_bot_senders),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-18 09:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0008_replyjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='replyjob',
+            name='bot_message',
+            field=models.OneToOneField(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='message.message'),
+        ),
+        migrations.AlterField(
+            model_name='replyjob',
+            name='user_message',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='reply_job', to='message.message'),
+        ),
+    ]
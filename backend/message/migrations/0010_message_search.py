@@ -0,0 +1,121 @@
+from django.db import migrations
+from django.db.utils import OperationalError
+
+
+# Postgres: the Portuguese configuration, accent-insensitive when the
+# unaccent extension is available (it ships with the official images)
+POSTGRES_CONFIGURATION = [
+    "CREATE TEXT SEARCH CONFIGURATION message_portuguese (COPY = portuguese)",
+]
+
+POSTGRES_UNACCENT = [
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """
+    ALTER TEXT SEARCH CONFIGURATION message_portuguese
+    ALTER MAPPING FOR hword, hword_part, word WITH unaccent, portuguese_stem
+    """,
+]
+
+# A stored generated tsvector, so every write keeps it current
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE message_message ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector(
+            'message_portuguese'::regconfig,
+            coalesce(user_text, '') || ' ' || coalesce(bot_text, '')
+        )
+    ) STORED
+    """,
+    "CREATE INDEX message_search_vector_idx ON message_message USING gin (search_vector)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS message_search_vector_idx",
+    "ALTER TABLE message_message DROP COLUMN IF EXISTS search_vector",
+    "DROP TEXT SEARCH CONFIGURATION IF EXISTS message_portuguese",
+]
+
+# SQLite: an external-content FTS5 index synced by triggers. Migrations that
+# rebuild message_message on SQLite drop the triggers and must re-create them
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE message_message_fts USING fts5(
+        user_text, bot_text,
+        content='message_message', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER message_message_fts_insert AFTER INSERT ON message_message BEGIN
+        INSERT INTO message_message_fts (rowid, user_text, bot_text)
+        VALUES (new.id, new.user_text, new.bot_text);
+    END
+    """,
+    """
+    CREATE TRIGGER message_message_fts_delete AFTER DELETE ON message_message BEGIN
+        INSERT INTO message_message_fts (message_message_fts, rowid, user_text, bot_text)
+        VALUES ('delete', old.id, old.user_text, old.bot_text);
+    END
+    """,
+    """
+    CREATE TRIGGER message_message_fts_update AFTER UPDATE ON message_message BEGIN
+        INSERT INTO message_message_fts (message_message_fts, rowid, user_text, bot_text)
+        VALUES ('delete', old.id, old.user_text, old.bot_text);
+        INSERT INTO message_message_fts (rowid, user_text, bot_text)
+        VALUES (new.id, new.user_text, new.bot_text);
+    END
+    """,
+    "INSERT INTO message_message_fts (message_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS message_message_fts_insert",
+    "DROP TRIGGER IF EXISTS message_message_fts_delete",
+    "DROP TRIGGER IF EXISTS message_message_fts_update",
+    "DROP TABLE IF EXISTS message_message_fts",
+]
+
+
+def _execute(schema_editor, statements):
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def add_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _execute(schema_editor, POSTGRES_CONFIGURATION)
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pg_available_extensions WHERE name = 'unaccent'"
+            )
+            if cursor.fetchone():
+                _execute(schema_editor, POSTGRES_UNACCENT)
+        _execute(schema_editor, POSTGRES_FORWARD)
+    elif vendor == 'sqlite':
+        try:
+            _execute(schema_editor, SQLITE_FORWARD[:1])
+        except OperationalError:
+            # SQLite built without FTS5: search falls back to a plain scan
+            return
+        _execute(schema_editor, SQLITE_FORWARD[1:])
+
+
+def remove_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        _execute(schema_editor, POSTGRES_BACKWARD)
+    elif vendor == 'sqlite':
+        _execute(schema_editor, SQLITE_BACKWARD)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0009_replyjob_message_links_without_constraint'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_search_index, remove_search_index),
+    ]
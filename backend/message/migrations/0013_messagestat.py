@@ -0,0 +1,41 @@
+# Generated by Django 5.2.8 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('message', '0012_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('hour', 'Hora'), ('day', 'Dia'), ('total', 'Total')], max_length=5)),
+                ('bucket', models.DateTimeField()),
+                ('user_sender', models.CharField(choices=[('A', 'Usuário A'), ('B', 'Usuário B')], max_length=10)),
+                ('sender_role', models.CharField(choices=[('user', 'Usuário'), ('bot', 'Bot')], max_length=10)),
+                ('slot', models.PositiveSmallIntegerField(default=0)),
+                ('count', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StatsProgress',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reconciled_until', models.DateTimeField(null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created_at'], name='message_created_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='messagestat',
+            constraint=models.UniqueConstraint(fields=('period', 'bucket', 'user_sender', 'sender_role', 'slot'), name='messagestat_key_uniq'),
+        ),
+    ]
@@ -1,4 +1,8 @@
 from django.db import models
+from django.utils import timezone
+
+from .replicas import read_alias
+from .sharding import shard_for
 
 
 USER_TYPE_CHOICES = [
@@ -6,11 +10,170 @@ USER_TYPE_CHOICES = [
     ("B", "Usuário B"),
 ]
 
+
+class SenderRole(models.TextChoices):
+    USER = "user", "Usuário"
+    BOT = "bot", "Bot"
+
+
+class ConversationManager(models.Manager):
+    def for_user(self, user):
+        """``user``'s conversation, created on their shard the first time"""
+        conversation, _ = self.db_manager(shard_for(user)).get_or_create(user=user)
+        return conversation
+
+    async def afor_user(self, user):
+        conversation, _ = await self.db_manager(shard_for(user)).aget_or_create(user=user)
+        return conversation
+
+
+class Conversation(models.Model):
+    user = models.CharField(max_length=10, choices=USER_TYPE_CHOICES, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = ConversationManager()
+
+
+class MessageQuerySet(models.QuerySet):
+    def for_user(self, user):
+        """User's own messages plus the bot responses addressed to them"""
+        return self.using(read_alias(shard_for(user))).filter(conversation__user=user)
+
+
 class Message(models.Model):
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name='messages'
+    )
     user_sender = models.CharField(max_length=10, choices=USER_TYPE_CHOICES)
+    sender_role = models.CharField(
+        max_length=10, choices=SenderRole.choices, default=SenderRole.USER
+    )
     user_text = models.TextField(null=True, blank=True)
     bot_text = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(
+                fields=['conversation', 'created_at', 'id'],
+                name='message_conv_created_idx',
+            ),
+            # Time-range scans across conversations: stats reconciliation
+            # and retention
+            models.Index(fields=['created_at'], name='message_created_idx'),
+        ]
+
+
+class ReplyJobStatus(models.TextChoices):
+    PENDING = "pending", "Pendente"
+    RUNNING = "running", "Em execução"
+    DONE = "done", "Concluído"
+    DEAD = "dead", "Falhou"
+
+
+class ReplyJob(models.Model):
+    """
+    Queued bot reply for a user message, consumed by run_reply_worker.
+
+    The message links carry no database constraint: once message_message is
+    partitioned (message/partitions.py) its rows can't be referenced by id
+    alone. Deletes still cascade through the ORM.
+    """
+    user_message = models.OneToOneField(
+        Message, on_delete=models.CASCADE, related_name='reply_job',
+        db_constraint=False
+    )
+    bot_message = models.OneToOneField(
+        Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+',
+        db_constraint=False
+    )
+    status = models.CharField(
+        max_length=10, choices=ReplyJobStatus.choices, default=ReplyJobStatus.PENDING
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    available_at = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['status', 'available_at'],
+                name='replyjob_status_avail_idx',
+            ),
+        ]
+
+
+class ImportProgress(models.Model):
+    """
+    How far import_messages got through a source file. Updated in the same
+    transaction as each imported chunk, so a resumed import neither skips
+    nor duplicates rows.
+    """
+    source = models.CharField(max_length=255, unique=True)
+    records_done = models.PositiveBigIntegerField(default=0)
+    rows_imported = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response stored for a send_message carrying an Idempotency-Key header.
+    The row is inserted before the messages, in the same transaction, and the
+    unique (user, key) pair is what serializes concurrent retries: a second
+    insert waits for the first transaction and then finds its response.
+    """
+    user = models.CharField(max_length=10, choices=USER_TYPE_CHOICES)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'key'], name='idempotencykey_user_key_uniq'
+            ),
+        ]
+
+
+class StatPeriod(models.TextChoices):
+    HOUR = "hour", "Hora"
+    DAY = "day", "Dia"
+    TOTAL = "total", "Total"
+
+
+class MessageStat(models.Model):
+    """
+    Messages counted per period bucket, user type and sender role, kept up
+    to date by message/stats.py. A counter is spread over several ``slot``
+    rows; its value is their sum.
+    """
+    period = models.CharField(max_length=5, choices=StatPeriod.choices)
+    bucket = models.DateTimeField()
+    user_sender = models.CharField(max_length=10, choices=USER_TYPE_CHOICES)
+    sender_role = models.CharField(max_length=10, choices=SenderRole.choices)
+    slot = models.PositiveSmallIntegerField(default=0)
+    count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['period', 'bucket', 'user_sender', 'sender_role', 'slot'],
+                name='messagestat_key_uniq'
+            ),
+        ]
+
+
+class StatsProgress(models.Model):
+    """
+    High-water mark of reconcile_stats on one database: the MessageStat
+    hours before ``reconciled_until`` were recounted from message_message.
+    """
+    reconciled_until = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
@@ -0,0 +1,305 @@
+"""
+Monthly range partitioning of the message table on Postgres, and retention.
+
+``convert()`` turns message_message into a table partitioned by created_at:
+the existing table becomes one partition holding everything before the next
+month, a DEFAULT partition catches rows no monthly partition covers, and
+``ensure_partitions()`` creates the months ahead. Expired months are archived
+as gzipped CSV, then detached and dropped in one step, which costs the same
+whatever their size; rows the partitions don't cover, and every expired row
+on other databases, are deleted in bounded chunks.
+
+Every function works on one shard, ``using``; the management commands loop
+over all of them.
+"""
+import gzip
+import os
+import re
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from .cache import invalidate_history
+from .models import Conversation, Message, ReplyJob
+
+
+TABLE = Message._meta.db_table
+LEGACY_PARTITION = f"{TABLE}_legacy"
+DEFAULT_PARTITION = f"{TABLE}_default"
+
+_BOUND = re.compile(r"FROM \((?:'([^']+)'|MINVALUE)\) TO \((?:'([^']+)'|MAXVALUE)\)")
+
+
+class PartitioningError(Exception):
+    pass
+
+
+def month_start(moment):
+    moment = moment.astimezone(dt_timezone.utc)
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(moment, months):
+    month = moment.month - 1 + months
+    return moment.replace(year=moment.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start:%Y%m}"
+
+
+def is_partitioned(using=DEFAULT_DB_ALIAS):
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = %s::regclass", [TABLE])
+        return cursor.fetchone()[0] == 'p'
+
+
+def partitions(using=DEFAULT_DB_ALIAS):
+    """``(name, lower, upper)`` per range partition; None stands for MINVALUE/MAXVALUE"""
+    with connections[using].cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname, pg_get_expr(child.relpartbound, child.oid)
+            FROM pg_inherits
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = %s::regclass
+            ORDER BY child.relname
+            """,
+            [TABLE],
+        )
+        rows = cursor.fetchall()
+
+    result = []
+    for name, bound in rows:
+        match = _BOUND.search(bound)
+        if match is None:  # the DEFAULT partition
+            continue
+        lower, upper = (
+            datetime.fromisoformat(value) if value else None for value in match.groups()
+        )
+        result.append((name, lower, upper))
+    return result
+
+
+def convert(now=None, using=DEFAULT_DB_ALIAS):
+    """
+    Turn the plain message table into a partitioned one. Locks the table
+    for the duration; the old table is attached as a partition, so its rows
+    aren't copied, only scanned to rebuild the primary key on
+    ``(id, created_at)`` and to validate the bound.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        raise PartitioningError("Partitioning needs PostgreSQL")
+    if is_partitioned(using):
+        return False
+
+    now = now or datetime.now(dt_timezone.utc)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        # ALTER TABLE refuses to run while deferred FK checks are queued
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f'LOCK TABLE "{TABLE}" IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(
+            "SELECT conrelid::regclass::text FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = %s::regclass",
+            [TABLE],
+        )
+        referencing = [row[0] for row in cursor.fetchall()]
+        if referencing:
+            raise PartitioningError(
+                f"Foreign keys from {', '.join(referencing)} point at {TABLE}; "
+                "partitioned tables can't be referenced by id alone"
+            )
+
+        cursor.execute("SELECT max(created_at), max(id) FROM " + f'"{TABLE}"')
+        newest, max_id = cursor.fetchone()
+        boundary = add_months(month_start(max(filter(None, (now, newest)))), 1)
+
+        # Index and constraint definitions move to the new parent under their
+        # current names, so later migrations still find them
+        cursor.execute(
+            "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid) FROM pg_index "
+            "WHERE indrelid = %s::regclass AND NOT indisprimary",
+            [TABLE],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype IN ('f', 'c')",
+            [TABLE],
+        )
+        constraints = cursor.fetchall()
+
+        cursor.execute(f'ALTER TABLE "{TABLE}" RENAME TO "{LEGACY_PARTITION}"')
+        # The primary key of a partitioned table must contain the partition
+        # key, and a partition can only carry the parent's one
+        cursor.execute(
+            f'ALTER TABLE "{LEGACY_PARTITION}" DROP CONSTRAINT "{TABLE}_pkey", '
+            f'ADD CONSTRAINT "{LEGACY_PARTITION}_pkey" PRIMARY KEY (id, created_at)'
+        )
+        for name, _ in indexes:
+            cursor.execute(f'ALTER INDEX "{name}" RENAME TO "{name[:55]}_legacy"')
+
+        cursor.execute(
+            f'CREATE TABLE "{TABLE}" (LIKE "{LEGACY_PARTITION}" INCLUDING DEFAULTS '
+            f'INCLUDING IDENTITY INCLUDING GENERATED) PARTITION BY RANGE (created_at)'
+        )
+        cursor.execute(f'ALTER TABLE "{TABLE}" ADD PRIMARY KEY (id, created_at)')
+        for name, definition in constraints:
+            cursor.execute(f'ALTER TABLE "{TABLE}" ADD CONSTRAINT "{name}" {definition}')
+        for name, definition in indexes:
+            definition = re.sub(r' ON \S+ USING ', f' ON "{TABLE}" USING ', definition, count=1)
+            cursor.execute(definition)
+        cursor.execute(
+            "SELECT setval(pg_get_serial_sequence(%s, 'id'), %s, %s)",
+            [TABLE, max_id or 1, max_id is not None],
+        )
+        # The parent's identity numbers every row now; PostgreSQL 17 refuses
+        # to attach a partition with an identity column of its own
+        cursor.execute(
+            f'ALTER TABLE "{LEGACY_PARTITION}" ALTER COLUMN id DROP IDENTITY IF EXISTS'
+        )
+
+        cursor.execute(
+            f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{LEGACY_PARTITION}" '
+            f"FOR VALUES FROM (MINVALUE) TO (%s)",
+            [boundary],
+        )
+        cursor.execute(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{TABLE}" DEFAULT')
+    return True
+
+
+def ensure_partitions(months_ahead=3, now=None, using=DEFAULT_DB_ALIAS):
+    """Create the monthly partitions from the current month up to ``months_ahead``"""
+    now = now or datetime.now(dt_timezone.utc)
+    covered = partitions(using)
+    created = []
+    for offset in range(months_ahead + 1):
+        start = add_months(month_start(now), offset)
+        end = add_months(start, 1)
+        if any(_overlaps(lower, upper, start, end) for _, lower, upper in covered):
+            continue
+        _create_partition(partition_name(start), start, end, using)
+        covered.append((partition_name(start), start, end))
+        created.append(partition_name(start))
+    return created
+
+
+def _overlaps(lower, upper, start, end):
+    return (lower is None or lower < end) and (upper is None or start < upper)
+
+
+def _create_partition(name, start, end, using):
+    # Rows that already landed in the DEFAULT partition for this range have
+    # to move first, or attaching the new partition fails
+    with transaction.atomic(using=using), connections[using].cursor() as cursor:
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(
+            f'CREATE TABLE "{name}" (LIKE "{TABLE}" INCLUDING DEFAULTS INCLUDING GENERATED)'
+        )
+        # Generated columns (search_vector) can't be inserted into
+        columns = ', '.join(f'"{field.column}"' for field in Message._meta.concrete_fields)
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM "{DEFAULT_PARTITION}" '
+            f'WHERE created_at >= %s AND created_at < %s RETURNING {columns}) '
+            f'INSERT INTO "{name}" ({columns}) SELECT {columns} FROM moved',
+            [start, end],
+        )
+        cursor.execute(
+            f'ALTER TABLE "{TABLE}" ATTACH PARTITION "{name}" FOR VALUES FROM (%s) TO (%s)',
+            [start, end],
+        )
+
+
+def drop_expired_partitions(cutoff, archive_dir, using=DEFAULT_DB_ALIAS):
+    """
+    Archive, detach and drop every partition entirely older than ``cutoff``.
+
+    The archive is written first, so a failure leaves the partition in
+    place; reply jobs pointing into it are cleaned up in the same
+    transaction as the drop, since partitions go without ORM cascades.
+    """
+    dropped = []
+    for name, _, upper in partitions(using):
+        if upper is None or upper > cutoff:
+            continue
+        archive_partition(name, archive_dir, using)
+        with transaction.atomic(using=using), connections[using].cursor() as cursor:
+            job_table = ReplyJob._meta.db_table
+            cursor.execute(
+                f'DELETE FROM "{job_table}" WHERE user_message_id IN (SELECT id FROM "{name}")'
+            )
+            cursor.execute(
+                f'UPDATE "{job_table}" SET bot_message_id = NULL '
+                f'WHERE bot_message_id IN (SELECT id FROM "{name}")'
+            )
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute(f'ALTER TABLE "{TABLE}" DETACH PARTITION "{name}"')
+            cursor.execute(f'DROP TABLE "{name}"')
+        dropped.append(name)
+
+    if dropped:
+        for user in Conversation.objects.using(using).values_list('user', flat=True):
+            invalidate_history(user, using=using)
+    return dropped
+
+
+def archive_partition(name, archive_dir, using=DEFAULT_DB_ALIAS):
+    """
+    Dump a partition to ``<archive_dir>/<name>.csv.gz`` with COPY; other
+    shards than the default one archive to ``<archive_dir>/<shard>/``.
+    """
+    if using != DEFAULT_DB_ALIAS:
+        archive_dir = os.path.join(archive_dir, using)
+    os.makedirs(archive_dir, exist_ok=True)
+    path = Path(archive_dir) / f"{name}.csv.gz"
+    temporary = path.with_name(f"{path.name}.tmp")
+    query = f'COPY (SELECT * FROM "{name}" ORDER BY created_at, id) TO STDOUT WITH (FORMAT csv, HEADER)'
+
+    with connections[using].cursor() as cursor, gzip.open(temporary, 'wb') as archive:
+        raw = cursor.cursor
+        if hasattr(raw, 'copy'):  # psycopg 3
+            with raw.copy(query) as copy:
+                for chunk in copy:
+                    archive.write(chunk)
+        else:  # psycopg2
+            raw.copy_expert(query, archive)
+    os.replace(temporary, path)
+    return path
+
+
+def delete_expired(cutoff, chunk_size=5000, using=DEFAULT_DB_ALIAS):
+    """
+    Delete messages older than ``cutoff`` in chunks of ``chunk_size``, each
+    in its own short transaction, oldest first. Returns the rows deleted.
+    """
+    messages = Message.objects.using(using)
+    deleted = 0
+    while True:
+        chunk = list(
+            messages.filter(created_at__lt=cutoff)
+            .order_by('created_at', 'id')
+            .values_list('id', 'conversation__user')[:chunk_size]
+        )
+        if not chunk:
+            break
+        with transaction.atomic(using=using):
+            messages.filter(id__in=[pk for pk, _ in chunk]).delete()
+            for user in {user for _, user in chunk}:
+                invalidate_history(user, using=using)
+        deleted += len(chunk)
+    return deleted
+
+
+def apply_retention(days, archive_dir, chunk_size=5000, now=None, using=DEFAULT_DB_ALIAS):
+    """Drop whole expired partitions when partitioned, then chunk-delete the rest"""
+    now = now or datetime.now(dt_timezone.utc)
+    cutoff = now - timedelta(days=days)
+    dropped = []
+    if is_partitioned(using):
+        dropped = drop_expired_partitions(cutoff, archive_dir, using)
+    return dropped, delete_expired(cutoff, chunk_size, using)
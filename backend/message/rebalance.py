@@ -0,0 +1,200 @@
+"""
+Moving conversations to the shard ``shard_for()`` assigns them after
+MESSAGE_SHARDS changed.
+
+A conversation is copied to its new shard in chunks, each committed on its
+own, and deleted from the old one, again in chunks, only once everything
+is across. Rows already on the target (same created_at, role and texts) are
+matched rather than copied again, so a move interrupted at any point is
+finished by running it again. Messages get new ids on the target, from its own
+sequence, so per-conversation ids keep growing in created_at order; reply
+jobs and stored idempotent responses are rewritten to the new message and
+conversation ids.
+
+Deploy the new shard list first, so new writes already go to the new
+shard, then rebalance; run it again until it reports nothing left to move,
+which picks up anything a worker still on the old list wrote meanwhile.
+"""
+from collections import Counter
+
+from django.db import transaction
+
+from .buffer import insert_messages
+from .cache import bump_history_version
+from .models import Conversation, IdempotencyKey, Message, ReplyJob
+from .sharding import shard_for, shards
+
+
+CHUNK_SIZE = 2000
+
+
+def misplaced(aliases=None):
+    """``(conversation, target shard)`` for every conversation on the wrong shard"""
+    aliases = aliases or shards()
+    for source in aliases:
+        for conversation in Conversation.objects.using(source).order_by('user'):
+            target = shard_for(conversation.user, aliases)
+            if target != source:
+                yield conversation, target
+
+
+def rebalance(aliases=None, chunk_size=CHUNK_SIZE, dry_run=False):
+    """Move every misplaced conversation; returns ``[(user, source, target, messages)]``"""
+    moved = []
+    for conversation, target in list(misplaced(aliases)):
+        count = Message.objects.using(conversation._state.db).filter(
+            conversation=conversation
+        ).count()
+        if not dry_run:
+            move_conversation(conversation, target, chunk_size)
+        moved.append((conversation.user, conversation._state.db, target, count))
+    return moved
+
+
+def move_conversation(conversation, target, chunk_size=CHUNK_SIZE):
+    source = conversation._state.db
+    user = conversation.user
+    destination = _target_conversation(conversation, target)
+
+    ids = {}
+    messages = Message.objects.using(source).filter(conversation=conversation)
+    last = None
+    while True:
+        chunk = messages.order_by('created_at', 'id')
+        if last is not None:
+            chunk = chunk.filter(created_at__gte=last[0]).exclude(
+                created_at=last[0], id__lte=last[1]
+            )
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        with transaction.atomic(using=target):
+            ids.update(_copy_messages(chunk, destination, target))
+        last = (chunk[-1].created_at, chunk[-1].id)
+
+    with transaction.atomic(using=target):
+        _copy_reply_jobs(conversation, destination, ids)
+        _copy_idempotency_keys(
+            source, target, user, ids, {conversation.pk: destination.pk}
+        )
+
+    # One cascade over the whole history would hold its locks and write its
+    # WAL in a single transaction; the copy is chunked for the same reason
+    _delete_messages(messages, chunk_size)
+    with transaction.atomic(using=source):
+        IdempotencyKey.objects.using(source).filter(user=user).delete()
+        conversation.delete()
+    bump_history_version(user)
+    return ids
+
+
+def _delete_messages(messages, chunk_size):
+    """Delete ``messages`` in pk order, ``chunk_size`` per transaction, with their reply jobs"""
+    while True:
+        chunk = list(messages.order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if not chunk:
+            break
+        with transaction.atomic(using=messages.db):
+            Message.objects.using(messages.db).filter(pk__in=chunk).delete()
+
+
+def _target_conversation(conversation, target):
+    destination = Conversation.objects.using(target).filter(user=conversation.user).first()
+    if destination is None:
+        destination = Conversation.objects.db_manager(target).create(user=conversation.user)
+        # Keep when the conversation really started, not when it moved
+        Conversation.objects.using(target).filter(pk=destination.pk).update(
+            created_at=conversation.created_at
+        )
+    return destination
+
+
+def _key(message):
+    return (message.created_at, message.sender_role, message.user_text, message.bot_text)
+
+
+def _copy_messages(chunk, destination, target):
+    """Insert the rows of ``chunk`` the target lacks; returns ``{old id: new id}``"""
+    existing = {}
+    for message in Message.objects.using(target).filter(
+        conversation=destination,
+        created_at__gte=chunk[0].created_at,
+        created_at__lte=chunk[-1].created_at,
+    ).order_by('id'):
+        existing.setdefault(_key(message), []).append(message.id)
+    available = Counter({key: len(found) for key, found in existing.items()})
+
+    ids, copies = {}, []
+    for message in chunk:
+        key = _key(message)
+        if available[key]:
+            # Copied by an earlier, interrupted run
+            ids[message.id] = existing[key][len(existing[key]) - available[key]]
+            available[key] -= 1
+            continue
+        copies.append((message.id, Message(
+            conversation=destination,
+            user_sender=message.user_sender,
+            sender_role=message.sender_role,
+            user_text=message.user_text,
+            bot_text=message.bot_text,
+            created_at=message.created_at,
+        )))
+
+    # Not bulk_create: auto_now_add would stamp the copies with the copy time
+    created = insert_messages([copy for _, copy in copies], target)
+    for (old_id, _), copy in zip(copies, created):
+        ids[old_id] = copy.id
+    return ids
+
+
+def _copy_reply_jobs(conversation, destination, ids):
+    jobs = ReplyJob.objects.using(conversation._state.db).filter(
+        user_message__conversation=conversation
+    )
+    done = set(
+        ReplyJob.objects.using(destination._state.db).filter(
+            user_message__conversation=destination
+        ).values_list('user_message_id', flat=True)
+    )
+    copies = [
+        ReplyJob(
+            user_message_id=ids[job.user_message_id],
+            bot_message_id=ids.get(job.bot_message_id),
+            status=job.status,
+            attempts=job.attempts,
+            last_error=job.last_error,
+            available_at=job.available_at,
+            locked_at=job.locked_at,
+        )
+        for job in jobs.iterator()
+        if ids[job.user_message_id] not in done
+    ]
+    ReplyJob.objects.using(destination._state.db).bulk_create(copies)
+
+
+def _copy_idempotency_keys(source, target, user, ids, conversations):
+    copies = []
+    for record in IdempotencyKey.objects.using(source).filter(user=user).iterator():
+        record.pk = None
+        record.response = _remap_response(record.response, ids, conversations)
+        copies.append(record)
+    IdempotencyKey.objects.using(target).bulk_create(copies, ignore_conflicts=True)
+
+
+def _remap_response(response, ids, conversations):
+    """A stored send_message response, pointing at the new message and conversation ids"""
+    if not isinstance(response, dict):
+        return response
+    response = dict(response)
+    for name in ('user_message', 'bot_message'):
+        message = response.get(name)
+        if not isinstance(message, dict):
+            continue
+        message = dict(message)
+        if message.get('id') in ids:
+            message['id'] = ids[message['id']]
+        if message.get('conversation') in conversations:
+            message['conversation'] = conversations[message['conversation']]
+        response[name] = message
+    return response
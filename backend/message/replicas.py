@@ -0,0 +1,142 @@
+"""
+Read replicas for the read-only message endpoints.
+
+MESSAGE_REPLICAS maps a primary alias (a shard) to its replica aliases.
+Reads run through ``read()`` go to a replica of whichever primary they
+would have used, the same one for the whole request; everything else,
+writes included, stays on the primary.
+
+A session that just wrote (``stick_to_primary()``) reads from the primary
+for MESSAGE_REPLICA_STICKY_SECONDS, so its user sees their own messages
+whatever the replication lag. A replica that fails a query is taken out
+for MESSAGE_REPLICA_RETRY_INTERVAL seconds and the read is retried on the
+primary.
+"""
+import contextvars
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, InterfaceError, OperationalError
+
+
+logger = logging.getLogger(__name__)
+
+STICKY_KEY = 'read_primary_until'
+
+_reads = contextvars.ContextVar('message_replica_reads', default=None)
+_down_until = {}
+
+
+@dataclass
+class _Reads:
+    # primary alias -> replica serving this request's reads from it
+    chosen: dict = field(default_factory=dict)
+
+
+def enabled():
+    return any(settings.MESSAGE_REPLICAS.values())
+
+
+def is_replica(alias):
+    return any(alias in aliases for aliases in settings.MESSAGE_REPLICAS.values())
+
+
+def primary_of(alias):
+    for primary, aliases in settings.MESSAGE_REPLICAS.items():
+        if alias in aliases:
+            return primary
+    return alias
+
+
+def healthy(alias):
+    return _down_until.get(alias, 0) <= time.monotonic()
+
+
+def mark_down(alias):
+    # The broken connection itself is recycled at the end of the request
+    _down_until[alias] = time.monotonic() + settings.MESSAGE_REPLICA_RETRY_INTERVAL
+
+
+def read_alias(primary=DEFAULT_DB_ALIAS):
+    """The alias to read ``primary``'s rows from in the current context"""
+    reads = _reads.get()
+    if reads is None:
+        return primary
+    if primary not in reads.chosen:
+        candidates = [
+            alias for alias in settings.MESSAGE_REPLICAS.get(primary, ()) if healthy(alias)
+        ]
+        if not candidates:
+            return primary
+        reads.chosen[primary] = random.choice(candidates)
+    return reads.chosen[primary]
+
+
+def stick_to_primary(session):
+    if enabled():
+        session[STICKY_KEY] = time.time() + settings.MESSAGE_REPLICA_STICKY_SECONDS
+
+
+async def astick_to_primary(session):
+    if enabled():
+        await session.aset(STICKY_KEY, time.time() + settings.MESSAGE_REPLICA_STICKY_SECONDS)
+
+
+def _sticky(until):
+    return until is not None and until > time.time()
+
+
+def read(session, query, fallback_on=()):
+    """
+    Run ``query()`` against replicas unless ``session`` is sticky. Returns
+    ``(result, from_replica)``; results from a replica may lag the primary.
+    ``fallback_on`` exceptions (e.g. a cursor naming a row the replica
+    doesn't have yet) retry the query on the primary too.
+    """
+    if not enabled() or _sticky(session.get(STICKY_KEY)):
+        return query(), False
+
+    reads = _Reads()
+    token = _reads.set(reads)
+    try:
+        return query(), bool(reads.chosen)
+    except (OperationalError, InterfaceError):
+        if not reads.chosen:
+            raise
+        _fail_over(reads)
+    except fallback_on:
+        if not reads.chosen:
+            raise
+    finally:
+        _reads.reset(token)
+    return query(), False
+
+
+async def aread(session, query, fallback_on=()):
+    """``read()`` for an async ``query``"""
+    if not enabled() or _sticky(await session.aget(STICKY_KEY)):
+        return await query(), False
+
+    reads = _Reads()
+    token = _reads.set(reads)
+    try:
+        return await query(), bool(reads.chosen)
+    except (OperationalError, InterfaceError):
+        if not reads.chosen:
+            raise
+        _fail_over(reads)
+    except fallback_on:
+        if not reads.chosen:
+            raise
+    finally:
+        _reads.reset(token)
+    return await query(), False
+
+
+def _fail_over(reads):
+    for alias in reads.chosen.values():
+        logger.warning("Replica %s failed; reading from its primary", alias, exc_info=True)
+        mark_down(alias)
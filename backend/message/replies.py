@@ -0,0 +1,17 @@
+from .engine import get_engine
+from .models import USER_TYPE_CHOICES
+
+
+def bot_reply(active_user, text):
+    """
+    Text of the bot response to ``text`` sent by ``active_user``.
+
+    The best matching rule of the response engine answers; messages no
+    rule recognises get the default acknowledgement.
+    """
+    nome_exibicao = dict(USER_TYPE_CHOICES).get(active_user, active_user)
+    rule = get_engine().match(text or '')
+    if rule is not None:
+        # Placeholders were checked when the rules file was loaded
+        return rule.response.format(nome=nome_exibicao)
+    return f"Obrigado por seu contato, {nome_exibicao}. Em breve responderemos."
@@ -0,0 +1,101 @@
+"""
+Full-text search over a user's conversation.
+
+Postgres matches against the generated ``search_vector`` column (GIN index,
+``message_portuguese``: the Portuguese configuration, plus unaccent when
+available) and ranks with ts_rank; SQLite uses the FTS5
+index kept by triggers and ranks with bm25. Both are created by migration
+0010. Anything else falls back to a case-insensitive scan.
+"""
+import re
+
+from django.db import connections
+from django.db.models import Q
+
+from .models import Conversation, Message
+from .replicas import read_alias
+from .sharding import shard_for
+
+
+FTS_TABLE = 'message_message_fts'
+
+_TOKEN = re.compile(r'\w+')
+
+
+def search_messages(user, query, limit, offset=0):
+    """
+    ``(message id, rank)`` pairs for ``user``'s messages matching ``query``,
+    best first. Higher ranks are better on every backend.
+    """
+    connection = connections[read_alias(shard_for(user))]
+    if connection.vendor == 'postgresql':
+        return _search_postgres(connection, user, query, limit, offset)
+    if connection.vendor == 'sqlite' and _has_fts_table(connection):
+        return _search_sqlite(connection, user, query, limit, offset)
+    return _search_scan(user, query, limit, offset)
+
+
+def _search_postgres(connection, user, query, limit, offset):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT message.id,
+                   ts_rank(message.search_vector, query) AS rank
+            FROM "{Message._meta.db_table}" message
+            JOIN "{Conversation._meta.db_table}" conversation
+                 ON conversation.id = message.conversation_id,
+                 websearch_to_tsquery('message_portuguese', %s) query
+            WHERE conversation."user" = %s AND message.search_vector @@ query
+            ORDER BY rank DESC, message.created_at DESC, message.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [query, user, limit, offset],
+        )
+        return cursor.fetchall()
+
+
+def _fts_query(query):
+    # Every word quoted, so user input can't use (or break) FTS5 syntax
+    return ' '.join(f'"{token}"' for token in _TOKEN.findall(query))
+
+
+def _search_sqlite(connection, user, query, limit, offset):
+    match = _fts_query(query)
+    if not match:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            SELECT message.id, -bm25({FTS_TABLE}) AS rank
+            FROM {FTS_TABLE}
+            JOIN "{Message._meta.db_table}" message ON message.id = {FTS_TABLE}.rowid
+            JOIN "{Conversation._meta.db_table}" conversation
+                 ON conversation.id = message.conversation_id
+            WHERE {FTS_TABLE} MATCH %s AND conversation."user" = %s
+            ORDER BY rank DESC, message.created_at DESC, message.id DESC
+            LIMIT %s OFFSET %s
+            """,
+            [match, user, limit, offset],
+        )
+        return cursor.fetchall()
+
+
+def _has_fts_table(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE]
+        )
+        return cursor.fetchone() is not None
+
+
+def _search_scan(user, query, limit, offset):
+    words = _TOKEN.findall(query)
+    if not words:
+        return []
+    condition = Q()
+    for word in words:
+        condition &= Q(user_text__icontains=word) | Q(bot_text__icontains=word)
+    ids = Message.objects.for_user(user).filter(condition).order_by(
+        '-created_at', '-id'
+    ).values_list('id', flat=True)[offset:offset + limit]
+    return [(pk, None) for pk in ids]
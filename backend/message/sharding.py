@@ -0,0 +1,97 @@
+"""
+Hash sharding of conversations across the databases in MESSAGE_SHARDS.
+
+Everything that belongs to one user (their Conversation, its messages, reply
+jobs and idempotency keys) lives on the shard ``shard_for(user)`` picks.
+The choice is rendezvous hashing: each shard scores the user with SHA-256
+and the highest score wins, so adding a shard only moves the conversations
+that now score highest on it, about 1/N of them, and nothing moves between
+the shards that were already there.
+
+Queries without an instance to route by must name their shard, which is
+what ``Conversation.objects.for_user()``/``Message.objects.for_user()`` do;
+``ShardRouter`` handles the rest (saves, related lookups, migrations).
+"""
+import hashlib
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from . import replicas
+
+
+# Models stored with their user's conversation; the rest of the app (and
+# every other app) stays on the default database
+SHARDED_MODELS = {'conversation', 'message', 'replyjob', 'idempotencykey'}
+
+
+def shards():
+    return list(settings.MESSAGE_SHARDS)
+
+
+def _score(shard, user):
+    return hashlib.sha256(f"{shard}:{user}".encode()).digest()
+
+
+def shard_for(user, aliases=None):
+    """Database alias holding ``user``'s conversation"""
+    aliases = shards() if aliases is None else aliases
+    if len(aliases) == 1:
+        return aliases[0]
+    return max(aliases, key=lambda shard: _score(shard, user))
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'message' and model._meta.model_name in SHARDED_MODELS
+
+
+def _user_of(instance):
+    model_name = instance._meta.model_name
+    if model_name == 'conversation' or model_name == 'idempotencykey':
+        return instance.user
+    if model_name == 'message':
+        return instance.user_sender
+    # ReplyJob: wherever its user message is
+    return None
+
+
+class ShardRouter:
+    """
+    Sends sharded rows to their user's shard and everything else to the
+    default database, reads to one of its replicas inside
+    ``replicas.read()``. Migrations for the message app run on every shard
+    (``migrate_shards``), so the same schema exists everywhere; replicas get
+    theirs through replication.
+    """
+    def _db_for(self, model, **hints):
+        if not is_sharded(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if instance._state.db:
+            return instance._state.db
+        if instance._meta.model_name == 'replyjob':
+            user_message = instance.user_message
+            return user_message._state.db or shard_for(user_message.user_sender)
+        user = _user_of(instance)
+        return shard_for(user) if user else None
+
+    def db_for_read(self, model, **hints):
+        return replicas.read_alias(self._db_for(model, **hints) or DEFAULT_DB_ALIAS)
+
+    def db_for_write(self, model, **hints):
+        database = self._db_for(model, **hints)
+        return database and replicas.primary_of(database)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if is_sharded(type(obj1)) or is_sharded(type(obj2)):
+            return replicas.primary_of(obj1._state.db) == replicas.primary_of(obj2._state.db)
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if replicas.is_replica(db):
+            return False
+        if app_label == 'message':
+            return db in shards() or db == DEFAULT_DB_ALIAS
+        return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,234 @@
+"""
+Message count rollups for the ops dashboards.
+
+MessageStat holds, on each shard, how many messages every user type sent
+and how many bot replies they got, per hour, per day (local time) and in
+total. Each path that writes messages calls ``record()`` in the same
+transaction, which adds to those counters with one ``INSERT ... ON
+CONFLICT DO UPDATE``, so ``summary()`` reads a bounded number of rows
+however large message_message grows.
+
+A counter is spread over MESSAGE_STATS_SLOTS rows and each write picks one
+at random: concurrent senders of the same user type would otherwise queue
+on a single row lock until each other's commit. Readers add the slots up.
+
+The increments can drift from the table: deletes never subtract, and
+rows written outside these paths (a manual fix in psql, say) are never
+counted. ``reconcile()`` recounts every hour from the
+shard's high-water mark (StatsProgress) up to MESSAGE_STATS_SETTLE_SECONDS
+ago, adds the difference as one more increment and moves the mark, all in
+one transaction per chunk. Hours behind the mark are left alone, so counts
+outlive the messages retention deletes. The first run is the backfill.
+"""
+import random
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncHour
+from django.utils import timezone
+
+from rest_framework.fields import DateTimeField
+
+from .models import Message, MessageStat, StatPeriod, StatsProgress
+from .replicas import read_alias
+from .sharding import shards
+
+
+# The all-time counters still need a bucket: NULLs never conflict
+TOTAL_BUCKET = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+DEFAULT_HOURS = 24
+MAX_HOURS = 24 * 7
+DEFAULT_DAYS = 30
+MAX_DAYS = 366
+
+RECONCILE_CHUNK = timedelta(days=1)
+
+
+def hour_of(moment):
+    return timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+
+
+def day_of(moment):
+    return timezone.localtime(moment).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def clamp(value, default, maximum):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(value, maximum))
+
+
+def increments(hourly):
+    """Counter increments for ``{(hour, user_sender, sender_role): messages}``"""
+    result = Counter()
+    for (hour, user, role), count in hourly.items():
+        for period, bucket in (
+            (StatPeriod.HOUR, hour),
+            (StatPeriod.DAY, day_of(hour)),
+            (StatPeriod.TOTAL, TOTAL_BUCKET),
+        ):
+            result[period, bucket, user, role] += count
+    return result
+
+
+def record_rows(rows, using=DEFAULT_DB_ALIAS):
+    """Count ``(created_at, user_sender, sender_role)`` rows just written to ``using``"""
+    hourly = Counter((hour_of(created_at), user, role) for created_at, user, role in rows)
+    add(increments(hourly), random.randrange(settings.MESSAGE_STATS_SLOTS), using)
+
+
+def record(messages, using=DEFAULT_DB_ALIAS):
+    """Count ``messages`` just written to ``using``"""
+    record_rows(
+        ((message.created_at, message.user_sender, message.sender_role)
+         for message in messages),
+        using
+    )
+
+
+def add(deltas, slot=0, using=DEFAULT_DB_ALIAS):
+    """Add ``{(period, bucket, user_sender, sender_role): delta}`` to ``slot``"""
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    connection = connections[using]
+    table = connection.ops.quote_name(MessageStat._meta.db_table)
+    values, params = [], []
+    # Always the same order, so two writers can't wait on each other's rows
+    for (period, bucket, user, role), delta in sorted(deltas.items()):
+        values.append('(%s, %s, %s, %s, %s, %s)')
+        params += [
+            period, connection.ops.adapt_datetimefield_value(bucket), user, role, slot, delta
+        ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (period, bucket, user_sender, sender_role, slot, count) '
+            f'VALUES {", ".join(values)} '
+            f'ON CONFLICT (period, bucket, user_sender, sender_role, slot) '
+            f'DO UPDATE SET count = {table}.count + EXCLUDED.count',
+            params
+        )
+
+
+def reconcile(using=DEFAULT_DB_ALIAS, since=None, now=None, chunk=RECONCILE_CHUNK):
+    """
+    Recount the hours of ``using`` from its high-water mark (or ``since``,
+    to redo hours already reconciled) up to MESSAGE_STATS_SETTLE_SECONDS
+    before ``now``. Returns ``(hours, corrected)``: the hours checked and
+    by how many messages their counters were off.
+    """
+    now = now or timezone.now()
+    end = hour_of(now - timedelta(seconds=settings.MESSAGE_STATS_SETTLE_SECONDS))
+    progress = StatsProgress.objects.using(using)
+    progress.get_or_create(pk=1)
+    if since is not None:
+        progress.filter(pk=1).update(reconciled_until=hour_of(since))
+
+    hours = corrected = 0
+    while True:
+        with transaction.atomic(using=using):
+            # Locked: a second reconcile waits here, then finds the mark moved
+            mark = progress.select_for_update().get(pk=1)
+            start = mark.reconciled_until or _first_hour(using)
+            if start is None or start >= end:
+                break
+            stop = min(hour_of(start + chunk), end)
+            corrected += _reconcile_range(start, stop, using)
+            mark.reconciled_until = stop
+            mark.save(update_fields=['reconciled_until', 'updated_at'])
+        hours += round((stop - start) / timedelta(hours=1))
+    return hours, corrected
+
+
+def _first_hour(using):
+    first = (
+        Message.objects.using(using).order_by('created_at')
+        .values_list('created_at', flat=True).first()
+    )
+    return hour_of(first) if first else None
+
+
+def _reconcile_range(start, stop, using):
+    actual = Counter({
+        (row['hour'], row['user_sender'], row['sender_role']): row['total']
+        for row in Message.objects.using(using)
+        .filter(created_at__gte=start, created_at__lt=stop)
+        .annotate(hour=TruncHour('created_at'))
+        .values('hour', 'user_sender', 'sender_role')
+        .annotate(total=Count('id'))
+        .order_by()
+    })
+    counted = Counter({
+        (row['bucket'], row['user_sender'], row['sender_role']): row['total']
+        for row in MessageStat.objects.using(using)
+        .filter(period=StatPeriod.HOUR, bucket__gte=start, bucket__lt=stop)
+        .values('bucket', 'user_sender', 'sender_role')
+        .annotate(total=Sum('count'))
+        .order_by()
+    })
+    deltas = {key: actual[key] - counted[key] for key in actual.keys() | counted.keys()}
+    add(increments(deltas), using=using)
+    return sum(abs(delta) for delta in deltas.values())
+
+
+def summary(hours=DEFAULT_HOURS, days=DEFAULT_DAYS, now=None):
+    """
+    Counts of the last ``hours`` hours, the last ``days`` days and all time,
+    added up over shards and slots. ``reconciled_until`` is the oldest
+    high-water mark: counts after it come from increments alone.
+    """
+    now = now or timezone.now()
+    since = Q(period=StatPeriod.HOUR, bucket__gte=hour_of(now) - timedelta(hours=hours - 1))
+    since |= Q(period=StatPeriod.DAY, bucket__gte=day_of(now) - timedelta(days=days - 1))
+    since |= Q(period=StatPeriod.TOTAL)
+
+    counts = {period: Counter() for period in StatPeriod}
+    marks = []
+    for shard in shards():
+        alias = read_alias(shard)
+        rows = (
+            MessageStat.objects.using(alias).filter(since)
+            .values('period', 'bucket', 'user_sender', 'sender_role')
+            .annotate(total=Sum('count'))
+            .order_by()
+        )
+        for row in rows:
+            key = (row['bucket'], row['user_sender'], row['sender_role'])
+            counts[row['period']][key] += row['total']
+        marks.append(
+            StatsProgress.objects.using(alias)
+            .values_list('reconciled_until', flat=True).first()
+        )
+
+    return {
+        "hourly": _listing(counts[StatPeriod.HOUR]),
+        "daily": _listing(counts[StatPeriod.DAY]),
+        "totals": [
+            {"user_sender": user, "sender_role": role, "count": count}
+            for (_, user, role), count in sorted(counts[StatPeriod.TOTAL].items())
+            if count
+        ],
+        "reconciled_until": (
+            DateTimeField().to_representation(min(marks)) if all(marks) else None
+        ),
+    }
+
+
+def _listing(counter):
+    to_representation = DateTimeField().to_representation
+    return [
+        {
+            "bucket": to_representation(bucket),
+            "user_sender": user,
+            "sender_role": role,
+            "count": count,
+        }
+        for (bucket, user, role), count in sorted(counter.items())
+        if count
+    ]
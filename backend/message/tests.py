@@ -1,43 +1,99 @@
-from django.test import TestCase
+import asyncio
+import csv
+import json
+import os
+import gzip
+import io
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from importlib import import_module
+from datetime import datetime, timedelta, timezone as dt_timezone
+from unittest import mock
+
+from django.db import connection, connections
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import (
+    AsyncClient, AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase,
+    override_settings,
+)
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
 from rest_framework import status
 
-from .models import Message
+from . import admin as message_admin, async_views
+from .engine import EngineLoader, KeywordMatcher, ResponseEngine, Rule, fold
+from .events import LocalBroker, PostgresBroker, channel_for, get_broker
+from .imports import clean_record
+from .jobs import ReplyWorker
+from .metrics import MetricsRegistry, registry, render
+from . import buffer, idempotency, partitions, rebalance, replicas, stats
+from .models import (
+    Conversation, IdempotencyKey, ImportProgress, Message, MessageStat, ReplyJob,
+    ReplyJobStatus, SenderRole, StatsProgress,
+)
+from .renderers import FastJSONRenderer
+from .serializers import FastMessageSerializer, MessageSerializer
+from .sharding import shard_for
+from .throttling import capacity, limiter
 
 
 class MessageTestCase(TestCase):
 
     def setUp(self):
         """Set up test data and client"""
+        cache.clear()
         self.client = APIClient()
         self.login_url = reverse('message-login')
         self.logout_url = reverse('message-logout')
         self.user_messages_url = reverse('message-user-messages')
         self.send_message_url = reverse('message-send-message')
 
+        self.conversation_a = Conversation.objects.create(user='A')
+        self.conversation_b = Conversation.objects.create(user='B')
+
         # Create some test messages for different users
         self.message_a1 = Message.objects.create(
+            conversation=self.conversation_a,
             user_sender='A',
             user_text='Hello from User A - Message 1'
         )
         self.message_a2 = Message.objects.create(
+            conversation=self.conversation_a,
             user_sender='A', 
             user_text='Hello from User A - Message 2'
         )
         self.message_b1 = Message.objects.create(
+            conversation=self.conversation_b,
             user_sender='B',
             user_text='Hello from User B - Message 1'
         )
         
         # Create bot responses
         self.bot_response_a = Message.objects.create(
-            user_sender='Usuário: A',
+            conversation=self.conversation_a,
+            user_sender='A',
+            sender_role=SenderRole.BOT,
             bot_text='Bot response to User A'
         )
         self.bot_response_b = Message.objects.create(
-            user_sender='Usuário: B', 
+            conversation=self.conversation_b,
+            user_sender='B', 
+            sender_role=SenderRole.BOT,
             bot_text='Bot response to User B'
         )
 
@@ -103,14 +159,16 @@ class MessageTestCase(TestCase):
         user_senders = [msg['user_sender'] for msg in messages]
         
         # Should only contain User A messages and bot responses to A
-        expected_senders = {'A', 'Usuário: A'}
-        actual_senders = set(user_senders)
-        
-        self.assertTrue(actual_senders.issubset(expected_senders))
+        self.assertEqual(set(user_senders), {'A'})
+        self.assertEqual(
+            {msg['sender_role'] for msg in messages}, {'user', 'bot'}
+        )
+        self.assertEqual(
+            {msg['conversation'] for msg in messages}, {self.conversation_a.id}
+        )
         
         # Should NOT contain User B messages or bot responses to B
         self.assertNotIn('B', user_senders)
-        self.assertNotIn('Usuário: B', user_senders)
         
         # Verify the correct messages are returned
         message_texts = [msg['user_text'] for msg in messages if msg['user_text']]
@@ -150,13 +208,16 @@ class MessageTestCase(TestCase):
         
         # Verify bot message data
         bot_message = response.data['bot_message']
-        self.assertEqual(bot_message['user_sender'], 'Usuário: A')
+        self.assertEqual(bot_message['user_sender'], 'A')
+        self.assertEqual(bot_message['sender_role'], 'bot')
         self.assertIn('Obrigado por seu contato, Usuário A', bot_message['bot_text'])
         self.assertIsNone(bot_message['user_text'])
         
         # Verify messages were saved to database
         self.assertEqual(Message.objects.filter(user_sender='A', user_text=message_text).count(), 1)
-        self.assertEqual(Message.objects.filter(user_sender='Usuário: A').count(), 2)  # Original + new
+        self.assertEqual(
+            Message.objects.filter(conversation=self.conversation_a, sender_role='bot').count(), 2
+        )  # Original + new
 
     def test_user_send_message_empty_text(self):
         """Test sending message with empty text"""
@@ -203,7 +264,7 @@ class MessageTestCase(TestCase):
         
         # User A should only see their own messages
         user_senders_a = set(msg['user_sender'] for msg in messages_a)
-        self.assertEqual(user_senders_a, {'A', 'Usuário: A'})
+        self.assertEqual(user_senders_a, {'A'})
         
         # Check User B's messages
         self.client.post(self.login_url, {'user': 'B'})
@@ -212,7 +273,7 @@ class MessageTestCase(TestCase):
         
         # User B should only see their own messages
         user_senders_b = set(msg['user_sender'] for msg in messages_b)
-        self.assertEqual(user_senders_b, {'B', 'Usuário: B'})
+        self.assertEqual(user_senders_b, {'B'})
 
     def test_message_ordering(self):
         """Test that messages are ordered by creation date"""
@@ -228,7 +289,7 @@ class MessageTestCase(TestCase):
         messages = response.data
         
         # Filter user messages (excluding bot responses)
-        user_messages = [msg for msg in messages if msg['user_sender'] == 'A']
+        user_messages = [msg for msg in messages if msg['sender_role'] == 'user']
         user_texts = [msg['user_text'] for msg in user_messages]
         
         # Messages should be in chronological order
@@ -255,3 +316,2098 @@ class MessageTestCase(TestCase):
         
         bot_message = response.data['bot_message']
         self.assertIn('Obrigado por seu contato, Usuário B', bot_message['bot_text'])
+
+    def test_user_messages_incremental_after_id(self):
+        """Test that after_id only returns messages newer than the given one"""
+        self.client.post(self.login_url, {'user': 'A'})
+        self.client.post(self.send_message_url, {'text': 'New message'})
+
+        response = self.client.get(
+            self.user_messages_url, {'after_id': self.bot_response_a.id}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        results = response.data['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0]['user_text'], 'New message')
+        self.assertEqual(results[1]['sender_role'], 'bot')
+        self.assertFalse(response.data['has_more'])
+
+        # Polling again with the returned cursor yields nothing new
+        response = self.client.get(
+            self.user_messages_url, {'after': response.data['next_cursor']}
+        )
+        self.assertEqual(response.data['results'], [])
+        self.assertIsNotNone(response.data['next_cursor'])
+
+    def test_user_messages_keyset_pages_backwards(self):
+        """Test paging backwards through history with a bounded page size"""
+        self.client.post(self.login_url, {'user': 'A'})
+
+        response = self.client.get(self.user_messages_url, {'page_size': 2})
+        latest = response.data['results']
+        self.assertEqual(
+            [msg['id'] for msg in latest],
+            [self.message_a2.id, self.bot_response_a.id]
+        )
+        self.assertTrue(response.data['has_more'])
+
+        response = self.client.get(self.user_messages_url, {
+            'page_size': 2, 'before': response.data['previous_cursor']
+        })
+        self.assertEqual(
+            [msg['id'] for msg in response.data['results']],
+            [self.message_a1.id]
+        )
+        self.assertFalse(response.data['has_more'])
+
+    def test_user_messages_invalid_cursor(self):
+        """Test that malformed cursors are rejected"""
+        self.client.post(self.login_url, {'user': 'A'})
+
+        response = self.client.get(self.user_messages_url, {'after': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Messages from another user can't be used as an anchor
+        response = self.client.get(
+            self.user_messages_url, {'after_id': self.message_b1.id}
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class MessageStreamTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.login_url = reverse('message-login')
+        self.send_message_url = reverse('message-send-message')
+        self.stream_url = reverse('message-stream')
+
+    async def test_local_broker_fan_out(self):
+        """Test that published events reach every subscriber of the channel"""
+        broker = LocalBroker()
+        first = broker.subscribe('messages.A')
+        second = broker.subscribe('messages.A')
+        other = broker.subscribe('messages.B')
+
+        broker.publish('messages.A', {'id': 1})
+
+        self.assertEqual(await asyncio.wait_for(anext(first), 1), {'id': 1})
+        self.assertEqual(await asyncio.wait_for(anext(second), 1), {'id': 1})
+        self.assertTrue(other.queue.empty())
+
+        for subscription in (first, second, other):
+            subscription.close()
+        self.assertEqual(broker._subscribers, {})
+
+    async def test_postgres_listener_reconnects_and_resets_streams(self):
+        """Test that a lost LISTEN connection is logged, retried and resyncs streams"""
+        broker = PostgresBroker()
+        broker.retry_delay = 0
+        attempts = []
+
+        async def listen_once(listening):
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                listening()
+                raise OSError('connection lost')
+            listening()
+            await asyncio.Event().wait()
+
+        broker._listen_once = listen_once
+        with self.assertLogs('message.events', 'ERROR') as logs:
+            subscription = broker.subscribe('messages.A')
+            with self.assertRaises(StopAsyncIteration):
+                await asyncio.wait_for(anext(subscription), 1)
+        self.assertIn('connection lost', logs.output[0])
+        self.assertEqual(attempts, [0, 1])
+
+        # Still listening, on the second connection
+        self.assertFalse(broker._listener.done())
+        broker._listener.cancel()
+        subscription.close()
+
+    def test_send_message_publishes_after_commit(self):
+        """Test that send_message publishes both messages once committed"""
+        client = APIClient()
+        client.post(self.login_url, {'user': 'A'})
+
+        published = []
+        broker = get_broker()
+        original_publish = broker.publish
+        broker.publish = lambda channel, event: published.append((channel, event))
+        try:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = client.post(self.send_message_url, {'text': 'Oi'})
+        finally:
+            broker.publish = original_publish
+
+        self.assertEqual(published, [
+            (channel_for('A'), response.data['user_message']),
+            (channel_for('A'), response.data['bot_message']),
+        ])
+
+    async def test_stream_requires_login(self):
+        """Test that the stream rejects anonymous sessions"""
+        response = await self.async_client.get(self.stream_url)
+        self.assertEqual(response.status_code, 401)
+
+    async def test_stream_replays_and_pushes_messages(self):
+        """Test replay after Last-Event-ID followed by live events"""
+        conversation_a = await Conversation.objects.acreate(user='A')
+        conversation_b = await Conversation.objects.acreate(user='B')
+        old = await Message.objects.acreate(
+            conversation=conversation_a, user_sender='A', user_text='Old'
+        )
+        missed = await Message.objects.acreate(
+            conversation=conversation_a, user_sender='A', user_text='Missed'
+        )
+        await Message.objects.acreate(
+            conversation=conversation_b, user_sender='B', user_text='Not mine'
+        )
+
+        await self.async_client.post(self.login_url, {'user': 'A'})
+        response = await self.async_client.get(
+            self.stream_url, headers={'Last-Event-ID': str(old.id)}
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'retry: 3000\n\n')
+
+        replayed = (await anext(chunks)).decode()
+        self.assertTrue(replayed.startswith(f'id: {missed.id}\n'))
+        self.assertEqual(
+            json.loads(replayed.split('data: ')[1])['user_text'], 'Missed'
+        )
+
+        get_broker().publish(channel_for('A'), {'id': missed.id + 100, 'user_text': 'Live'})
+        live = (await asyncio.wait_for(anext(chunks), 1)).decode()
+        self.assertIn('"user_text": "Live"', live)
+
+        # A reset ends the stream so the client reconnects and replays
+        get_broker().reset()
+        with self.assertRaises(StopAsyncIteration):
+            await asyncio.wait_for(anext(chunks), 1)
+
+
+class ConversationTestCase(TestCase):
+
+    def test_conversation_for_user_is_reused(self):
+        """Test that each user gets exactly one conversation"""
+        first = Conversation.objects.for_user('A')
+        second = Conversation.objects.for_user('A')
+        self.assertEqual(first.pk, second.pk)
+        self.assertNotEqual(Conversation.objects.for_user('B').pk, first.pk)
+
+    def test_send_message_attaches_both_rows_to_conversation(self):
+        """Test that user and bot rows share the user's conversation"""
+        client = APIClient()
+        client.post(reverse('message-login'), {'user': 'B'})
+        client.post(reverse('message-send-message'), {'text': 'Olá'})
+
+        conversation = Conversation.objects.get(user='B')
+        self.assertEqual(
+            list(conversation.messages.values_list('user_sender', 'sender_role')),
+            [('B', 'user'), ('B', 'bot')]
+        )
+
+
+class SendMessagesBatchTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.login_url = reverse('message-login')
+        self.send_messages_url = reverse('message-send-messages')
+
+    def test_send_messages_bulk_creates_in_order(self):
+        """Test that a batch creates every user/bot pair in request order"""
+        self.client.post(self.login_url, {'user': 'A'})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                self.send_messages_url,
+                {'texts': ['Primeira', 'Segunda', 'Terceira']},
+                format='json'
+            )
+
+        # All six rows go out in a single INSERT
+        message_inserts = [
+            query for query in queries.captured_queries
+            if query['sql'].startswith('INSERT INTO "message_message"')
+        ]
+        self.assertEqual(len(message_inserts), 1)
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['errors'], [])
+        self.assertEqual(
+            [item['user_message']['user_text'] for item in response.data['messages']],
+            ['Primeira', 'Segunda', 'Terceira']
+        )
+        for item in response.data['messages']:
+            self.assertEqual(item['bot_message']['sender_role'], 'bot')
+            self.assertLess(item['user_message']['id'], item['bot_message']['id'])
+        self.assertEqual(Message.objects.count(), 6)
+
+    def test_send_messages_reports_item_errors(self):
+        """Test that invalid items are reported without failing the batch"""
+        self.client.post(self.login_url, {'user': 'B'})
+
+        response = self.client.post(
+            self.send_messages_url,
+            {'texts': ['Válida', '   ', 42, 'Outra']},
+            format='json'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([item['index'] for item in response.data['messages']], [0, 3])
+        self.assertEqual([error['index'] for error in response.data['errors']], [1, 2])
+        self.assertEqual(Message.objects.count(), 4)
+
+    def test_send_messages_rejects_invalid_payload(self):
+        """Test batch validation and authentication"""
+        response = self.client.post(
+            self.send_messages_url, {'texts': ['Oi']}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.post(self.login_url, {'user': 'A'})
+        response = self.client.post(
+            self.send_messages_url, {'texts': 'not a list'}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post(
+            self.send_messages_url, {'texts': ['', ' ']}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(response.data['errors']), 2)
+        self.assertEqual(Message.objects.count(), 0)
+
+
+@override_settings(MESSAGE_REPLY_MODE='queue')
+class ReplyQueueTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.post(reverse('message-login'), {'user': 'A'})
+        self.send_message_url = reverse('message-send-message')
+
+    def test_send_message_enqueues_reply(self):
+        """Test that queue mode stores the user message and defers the bot reply"""
+        response = self.client.post(self.send_message_url, {'text': 'Oi'})
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIsNone(response.data['bot_message'])
+        self.assertEqual(response.data['reply_job']['status'], 'pending')
+        self.assertEqual(Message.objects.filter(sender_role='bot').count(), 0)
+
+        job = ReplyJob.objects.get()
+        self.assertEqual(job.user_message_id, response.data['user_message']['id'])
+
+    def test_worker_writes_bot_reply(self):
+        """Test that the worker command consumes the queue"""
+        self.client.post(self.send_message_url, {'text': 'Mensagem de teste'})
+
+        call_command('run_reply_worker', drain=True, stdout=mock.Mock())
+
+        job = ReplyJob.objects.get()
+        self.assertEqual(job.status, ReplyJobStatus.DONE)
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.bot_message.sender_role, SenderRole.BOT)
+        self.assertEqual(job.bot_message.conversation_id, job.user_message.conversation_id)
+        self.assertIn('Obrigado por seu contato', job.bot_message.bot_text)
+
+        # Nothing left to claim
+        self.assertEqual(ReplyWorker().run_once(), 0)
+
+    def test_worker_retries_then_dead_letters(self):
+        """Test retry with backoff and the dead-letter state"""
+        self.client.post(self.send_message_url, {'text': 'Oi'})
+        worker = ReplyWorker(max_attempts=2, retry_backoff=30)
+
+        failing = mock.patch('message.jobs.bot_reply', side_effect=RuntimeError('boom'))
+        with failing, self.assertLogs('message.jobs', 'ERROR'):
+            self.assertEqual(worker.run_once(), 1)
+            job = ReplyJob.objects.get()
+            self.assertEqual(job.status, ReplyJobStatus.PENDING)
+            self.assertIn('boom', job.last_error)
+            self.assertGreater(job.available_at, timezone.now())
+
+            # Not ready again until the backoff expires
+            self.assertEqual(worker.run_once(), 0)
+            job.available_at = timezone.now() - timedelta(seconds=1)
+            job.save()
+
+            self.assertEqual(worker.run_once(), 1)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ReplyJobStatus.DEAD)
+        self.assertEqual(job.attempts, 2)
+        self.assertIsNone(job.bot_message)
+
+    def test_expired_lease_is_reclaimed(self):
+        """Test that jobs left running by a crashed worker are picked up again"""
+        self.client.post(self.send_message_url, {'text': 'Oi'})
+        ReplyJob.objects.update(
+            status=ReplyJobStatus.RUNNING,
+            locked_at=timezone.now() - timedelta(minutes=10),
+            attempts=1,
+        )
+
+        self.assertEqual(ReplyWorker(lease_seconds=60).run_once(), 1)
+        job = ReplyJob.objects.get()
+        self.assertEqual(job.status, ReplyJobStatus.DONE)
+        self.assertEqual(job.attempts, 2)
+
+    def test_overrun_lease_writes_one_reply(self):
+        """Test that a worker finishing after its job was claimed again doesn't reply"""
+        self.client.post(self.send_message_url, {'text': 'Oi'})
+        slow, fast = ReplyWorker(lease_seconds=60), ReplyWorker(lease_seconds=60)
+        [late] = slow.claim()
+        ReplyJob.objects.update(locked_at=timezone.now() - timedelta(minutes=10))
+
+        self.assertEqual(fast.run_once(), 1)
+        with self.assertLogs('message.jobs', 'WARNING'):
+            self.assertFalse(slow.process(late))
+
+        self.assertEqual(Message.objects.filter(sender_role=SenderRole.BOT).count(), 1)
+        self.assertEqual(ReplyJob.objects.get().status, ReplyJobStatus.DONE)
+
+    @unittest.skipUnless(
+        connection.features.has_select_for_update_of, "Needs SELECT ... FOR UPDATE OF"
+    )
+    def test_claim_locks_only_job_rows(self):
+        """Test that claiming doesn't lock the user messages it joins"""
+        self.client.post(self.send_message_url, {'text': 'Oi'})
+        with CaptureQueriesContext(connection) as queries:
+            ReplyWorker().claim()
+        locking = [query['sql'] for query in queries if 'FOR UPDATE' in query['sql']]
+        self.assertEqual(len(locking), 1)
+        self.assertIn('FOR UPDATE OF "message_replyjob" SKIP LOCKED', locking[0])
+
+
+class ResponseEngineTestCase(TestCase):
+
+    def setUp(self):
+        self.engine = ResponseEngine([
+            Rule('saudacao', ('oi', 'bom dia'), 'Olá, {nome}!'),
+            Rule('cancelamento', ('cancelar',), 'Cancelando', priority=2),
+            Rule('noticia', ('bom dia brasil',), 'Notícia'),
+        ])
+
+    def test_fold_ignores_case_and_accents(self):
+        """Test Portuguese accent and case folding"""
+        self.assertEqual(fold('Olá, AÇÃO é Útil'), 'ola, acao e util')
+
+    def test_matcher_finds_overlapping_whole_words(self):
+        """Test Aho-Corasick matching on word boundaries"""
+        matcher = KeywordMatcher(['bom dia', 'dia', 'oi'])
+        hits = sorted(matcher.search('bom dia, oi'))
+        self.assertEqual(hits, [(0, 0), (1, 4), (2, 9)])
+        # "oi" inside "noite" is not a hit
+        self.assertEqual(list(matcher.search('boa noite')), [])
+
+    def test_match_prefers_priority_then_hits(self):
+        """Test rule selection order"""
+        self.assertEqual(self.engine.match('BOM DIA!').intent, 'saudacao')
+        self.assertEqual(self.engine.match('Oi, quero cancelar').intent, 'cancelamento')
+        self.assertEqual(self.engine.match('oi, bom dia brasil').intent, 'saudacao')
+        self.assertIsNone(self.engine.match('nada a ver'))
+
+    def test_loader_hot_reloads_rules_file(self):
+        """Test that edited rules are picked up without a restart"""
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as rules_file:
+            json.dump([{'intent': 'a', 'keywords': ['oi'], 'response': 'A'}], rules_file)
+        self.addCleanup(os.unlink, rules_file.name)
+
+        loader = EngineLoader(rules_file.name, interval=0)
+        self.assertEqual(loader.get().match('oi').response, 'A')
+
+        with open(rules_file.name, 'w') as handle:
+            json.dump([{'intent': 'b', 'keywords': ['oi'], 'response': 'B'}], handle)
+        os.utime(rules_file.name, ns=(0, os.stat(rules_file.name).st_mtime_ns + 10**9))
+        self.assertEqual(loader.get().match('oi').response, 'B')
+
+        # A broken file keeps the last good engine
+        with open(rules_file.name, 'w') as handle:
+            handle.write('{not json')
+        os.utime(rules_file.name, ns=(0, os.stat(rules_file.name).st_mtime_ns + 10**9))
+        with self.assertLogs('message.engine', 'ERROR'):
+            self.assertEqual(loader.get().match('oi').response, 'B')
+
+        # So does a response bot_reply could not fill in
+        for response in ('Olá, {nome', 'Olá, {cliente}!', 'Olá, {0}!', 'Olá, {nome.x}!'):
+            with open(rules_file.name, 'w') as handle:
+                json.dump([{'intent': 'c', 'keywords': ['oi'], 'response': response}], handle)
+            os.utime(rules_file.name, ns=(0, os.stat(rules_file.name).st_mtime_ns + 10**9))
+            with self.assertLogs('message.engine', 'ERROR'):
+                self.assertEqual(loader.get().match('oi').response, 'B')
+
+    def test_send_message_uses_rules(self):
+        """Test that send_message answers with the matched rule"""
+        client = APIClient()
+        client.post(reverse('message-login'), {'user': 'A'})
+        response = client.post(reverse('message-send-message'), {'text': 'Olá, bom dia'})
+        self.assertEqual(
+            response.data['bot_message']['bot_text'],
+            'Olá, Usuário A! Como posso ajudar você hoje?'
+        )
+
+
+class HistoryCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.post(reverse('message-login'), {'user': 'A'})
+        self.user_messages_url = reverse('message-user-messages')
+        self.send_message_url = reverse('message-send-message')
+        self.client.post(self.send_message_url, {'text': 'Primeira'})
+
+    def test_repeated_history_is_served_from_cache(self):
+        """Test that an unchanged history skips the message query"""
+        first = self.client.get(self.user_messages_url)
+
+        # Sessions live in a signed cookie, so no query at all is left
+        with self.assertNumQueries(0):
+            second = self.client.get(self.user_messages_url)
+
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_if_none_match_returns_304(self):
+        """Test conditional requests with the history ETag"""
+        etag = self.client.get(self.user_messages_url)['ETag']
+
+        response = self.client.get(self.user_messages_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+        # Different query parameters are a different representation
+        response = self.client.get(
+            self.user_messages_url, {'page_size': 1}, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_send_message_bumps_version(self):
+        """Test that writes invalidate the cached history"""
+        etag = self.client.get(self.user_messages_url)['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.send_message_url, {'text': 'Segunda'})
+
+        response = self.client.get(self.user_messages_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(
+            [msg['user_text'] for msg in response.data if msg['user_text']],
+            ['Primeira', 'Segunda']
+        )
+
+    def test_versions_are_per_conversation(self):
+        """Test that one user's writes don't invalidate another's history"""
+        etag = self.client.get(self.user_messages_url)['ETag']
+
+        other = APIClient()
+        other.post(reverse('message-login'), {'user': 'B'})
+        other.post(self.send_message_url, {'text': 'Outra conversa'})
+
+        response = self.client.get(self.user_messages_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class FastSerializationTestCase(TestCase):
+
+    def setUp(self):
+        conversation = Conversation.objects.create(user='A')
+        Message.objects.create(
+            conversation=conversation, user_sender='A',
+            user_text='Olá, ação "citada" \u2028 linha\nnova \U0001F600'
+        )
+        Message.objects.create(
+            conversation=conversation, user_sender='A',
+            sender_role=SenderRole.BOT, bot_text='Resposta'
+        )
+        self.queryset = Message.objects.order_by('created_at')
+
+    def test_fast_path_is_byte_compatible(self):
+        """Test that the fast path renders exactly like the DRF serializer"""
+        expected = JSONRenderer().render(MessageSerializer(self.queryset, many=True).data)
+
+        fast_rows = FastMessageSerializer.many(self.queryset)
+        self.assertEqual(FastJSONRenderer().render(fast_rows), expected)
+        self.assertEqual(JSONRenderer().render(fast_rows), expected)
+
+        from_values = FastMessageSerializer.from_values(
+            self.queryset.values(*FastMessageSerializer.attnames())
+        )
+        self.assertEqual(FastJSONRenderer().render(from_values), expected)
+
+    def test_fast_path_single_instance(self):
+        """Test serializing one freshly created instance"""
+        message = self.queryset.first()
+        self.assertEqual(
+            FastJSONRenderer().render(FastMessageSerializer.one(message)),
+            JSONRenderer().render(MessageSerializer(message).data)
+        )
+
+
+class SessionModeTestCase(TestCase):
+
+    def test_hot_endpoints_skip_session_table(self):
+        """Test that login/send/history make no django_session queries"""
+        client = APIClient()
+
+        with CaptureQueriesContext(connection) as queries:
+            client.post(reverse('message-login'), {'user': 'A'})
+            client.post(reverse('message-send-message'), {'text': 'Oi'})
+            response = client.get(reverse('message-user-messages'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 2)
+        self.assertFalse(
+            [query for query in queries.captured_queries if 'django_session' in query['sql']]
+        )
+
+    def test_purge_sessions_empties_table(self):
+        """Test that leftover database sessions are purged"""
+        for number in range(3):
+            Session.objects.create(
+                session_key=f'key{number}', session_data='', expire_date=timezone.now()
+            )
+
+        call_command('purge_sessions', chunk_size=2, stdout=mock.Mock())
+        self.assertEqual(Session.objects.count(), 0)
+
+    @override_settings(SESSION_ENGINE='django.contrib.sessions.backends.db')
+    def test_purge_sessions_keeps_database_sessions_in_use(self):
+        """Test that the purge is skipped while sessions are database-backed"""
+        Session.objects.create(session_key='key', session_data='', expire_date=timezone.now())
+
+        call_command('purge_sessions', stdout=mock.Mock())
+        self.assertEqual(Session.objects.count(), 1)
+
+
+class SettingsProfileTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_api_profile_serves_the_api(self):
+        """Test login/send/history through the API-only middleware and DRF settings"""
+        with override_settings(
+            MIDDLEWARE=settings.API_MIDDLEWARE, REST_FRAMEWORK=settings.API_REST_FRAMEWORK
+        ):
+            client = APIClient()
+            client.post(reverse('message-login'), {'user': 'A'})
+            client.post(reverse('message-send-message'), {'text': 'Oi'}, format='json')
+            response = client.get(reverse('message-user-messages'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()), 2)
+        self.assertNotIn('X-Frame-Options', response.headers)
+
+    def test_bench_startup_compares_profiles(self):
+        """Test that bench_startup measures both profiles in fresh interpreters"""
+        stdout = io.StringIO()
+        call_command('bench_startup', runs=1, requests=5, stdout=stdout)
+
+        output = stdout.getvalue()
+        self.assertIn('profile=full apps=8 middleware=9', output)
+        self.assertIn('profile=api  apps=3 middleware=5', output)
+        self.assertEqual(output.count('status=401'), 2)
+        self.assertIn('api vs full: startup', output)
+
+
+class AsyncViewsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = AsyncRequestFactory()
+        self.session = import_module(settings.SESSION_ENGINE).SessionStore()
+
+    def _request(self, method, data=None, headers=None):
+        if method == 'post':
+            request = self.factory.post(
+                '/', json.dumps(data or {}), content_type='application/json',
+                headers=headers
+            )
+        else:
+            request = self.factory.get('/', data or {}, headers=headers)
+        request.session = self.session
+        return request
+
+    async def test_login_uses_async_session(self):
+        """Test async login validation and session write"""
+        response = await async_views.login(self._request('post', {'user': 'C'}))
+        self.assertEqual(response.status_code, 400)
+
+        response = await async_views.login(self._request('post', {'user': 'B'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['active_user'], 'B')
+        self.assertEqual(await self.session.aget('active_user'), 'B')
+
+    async def test_requires_login(self):
+        """Test that anonymous sessions are rejected"""
+        response = await async_views.user_messages(self._request('get'))
+        self.assertEqual(response.status_code, 401)
+        response = await async_views.send_message(self._request('post', {'text': 'Oi'}))
+        self.assertEqual(response.status_code, 401)
+
+    async def test_send_and_read_match_sync_views(self):
+        """Test that async responses are byte-identical to the ViewSet ones"""
+        await async_views.login(self._request('post', {'user': 'A'}))
+
+        response = await async_views.send_message(self._request('post', {'text': ' '}))
+        self.assertEqual(response.status_code, 400)
+
+        response = await async_views.send_message(self._request('post', {'text': 'Olá'}))
+        self.assertEqual(response.status_code, 201)
+        sent = json.loads(response.content)
+        self.assertEqual(sent['bot_message']['sender_role'], 'bot')
+
+        response = await async_views.user_messages(self._request('get'))
+        self.assertEqual(
+            [message['id'] for message in json.loads(response.content)],
+            [sent['user_message']['id'], sent['bot_message']['id']]
+        )
+
+        sync_response = await sync_to_async(self._sync_history)()
+        self.assertEqual(response.content, sync_response.content)
+
+        response = await async_views.user_messages(
+            self._request('get', headers={'If-None-Match': response['ETag']})
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_send_message_writes_atomically(self):
+        """Test that a failure after the user message rolls it back"""
+        await async_views.login(self._request('post', {'user': 'A'}))
+        with mock.patch('message.views.stats.record', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                await async_views.send_message(self._request('post', {'text': 'Olá'}))
+        self.assertEqual(await Message.objects.for_user('A').acount(), 0)
+
+    def _sync_history(self):
+        client = APIClient()
+        client.post(reverse('message-login'), {'user': 'A'})
+        return client.get(reverse('message-user-messages'))
+
+    async def test_paginated_history(self):
+        """Test keyset paging through the async ORM"""
+        await async_views.login(self._request('post', {'user': 'A'}))
+        for text in ('Um', 'Dois'):
+            await async_views.send_message(self._request('post', {'text': text}))
+
+        response = await async_views.user_messages(self._request('get', {'page_size': 3}))
+        page = json.loads(response.content)
+        self.assertEqual(len(page['results']), 3)
+        self.assertTrue(page['has_more'])
+
+        response = await async_views.user_messages(
+            self._request('get', {'after_id': page['results'][0]['id']})
+        )
+        self.assertEqual(len(json.loads(response.content)['results']), 2)
+
+        response = await async_views.user_messages(self._request('get', {'after': 'x'}))
+        self.assertEqual(response.status_code, 400)
+
+
+class BenchmarkCommandTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def _run(self, **options):
+        stdout = mock.Mock()
+        call_command('benchmark', concurrency=1, stdout=stdout, **options)
+        return json.loads(stdout.write.call_args[0][0])
+
+    def test_report_covers_every_endpoint(self):
+        """Test seeding, driving the endpoints and the JSON report"""
+        report = self._run(conversations=5, messages=50, history=10, requests=20)
+
+        self.assertEqual(Conversation.objects.filter(user__startswith='#').count(), 5)
+        self.assertEqual(report['config']['vendor'], connection.vendor)
+        self.assertEqual(report['endpoints']['login']['requests'], 1)
+        self.assertEqual(report['total']['requests'], 21)
+        self.assertEqual(report['total']['errors'], 0)
+        for endpoint in ('send_message', 'user_messages'):
+            summary = report['endpoints'][endpoint]
+            self.assertGreater(summary['requests'], 0)
+            self.assertLessEqual(summary['p50_ms'], summary['p99_ms'])
+            self.assertGreater(summary['queries_per_request'], 0)
+
+    def test_cleanup_removes_created_rows(self):
+        """Test --cleanup deletes seeded and sent messages"""
+        existing = Message.objects.create(
+            conversation=Conversation.objects.for_user('A'), user_sender='A', user_text='Antiga'
+        )
+        self._run(conversations=3, messages=20, history=5, requests=5, cleanup=True)
+
+        self.assertEqual(list(Message.objects.all()), [existing])
+        self.assertFalse(Conversation.objects.filter(user__startswith='#').exists())
+
+
+class RequestMetricsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        registry.clear()
+        self.client = APIClient()
+        self.client.post(reverse('message-login'), {'user': 'A'})
+        self.client.post(reverse('message-send-message'), {'text': 'Olá'})
+
+    def _metrics(self):
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return response.content.decode()
+
+    def test_requests_are_recorded_per_view(self):
+        """Test counters and histograms for the served views"""
+        self.client.get(reverse('message-user-messages'))
+        body = self._metrics()
+
+        labels = 'view="message-user-messages",method="GET"'
+        self.assertIn(f'message_requests_total{{{labels},status="200"}} 1', body)
+        self.assertIn(f'message_request_duration_seconds_count{{{labels}}} 1', body)
+        self.assertIn(f'message_request_serialization_seconds_count{{{labels}}} 1', body)
+        self.assertIn(f'message_response_size_bytes_count{{{labels}}} 1', body)
+        # One history query, nothing else: the session lives in a cookie
+        self.assertIn(f'message_request_queries_bucket{{{labels},le="0"}} 0', body)
+        self.assertIn(f'message_request_queries_bucket{{{labels},le="1"}} 1', body)
+        self.assertIn(
+            'message_requests_total{view="message-send-message",method="POST",status="201"} 1',
+            body
+        )
+
+    async def test_async_handler_counts_queries(self):
+        """Test queries run by a sync view under ASGI are charged to the request"""
+        client = AsyncClient()
+        await client.post(reverse('message-login'), {'user': 'B'})
+        response = await client.post(reverse('message-send-message'), {'text': 'Oi'})
+        self.assertEqual(response.status_code, 201)
+
+        totals = registry.snapshot()
+        labels = (('view', 'message-send-message'), ('method', 'POST'))
+        queries = totals[('message_request_queries', labels)]
+        # Two requests; the ASGI one ran at least its two inserts
+        self.assertEqual(sum(queries[:-1]), 2)
+        self.assertGreaterEqual(queries[-1], 4)
+
+    def test_workers_are_aggregated(self):
+        """Test totals written by other worker processes are added up"""
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(MESSAGE_METRICS_DIR=directory):
+            login = (('view', 'message-login'), ('method', 'POST'), ('status', '200'))
+            pool = (('database', 'default'),)
+            dead = subprocess.Popen(['true'])
+            dead.wait()
+            for pid, requests in ((os.getppid(), 4), (dead.pid, 100)):
+                other = MetricsRegistry()
+                other.inc('message_requests_total', login, requests)
+                other.inc('message_db_pool_waiting', pool, 3)
+                with mock.patch('os.getpid', return_value=pid):
+                    other.flush(force=True)
+
+            body = self._metrics()
+            self.assertFalse(os.path.exists(os.path.join(directory, f'metrics-{dead.pid}.json')))
+
+        # The dead worker's totals are gone; gauges aren't summed
+        self.assertIn(
+            'message_requests_total{view="message-login",method="POST",status="200"} 5', body
+        )
+        self.assertIn(
+            f'message_db_pool_waiting{{database="default",pid="{os.getppid()}"}} 3', body
+        )
+        self.assertNotIn('message_db_pool_waiting{database="default"}', body)
+
+    def test_endpoint_is_restricted(self):
+        """Test /api/metrics only answers allowed addresses and staff"""
+        url = reverse('metrics')
+        self.assertEqual(
+            self.client.get(url, REMOTE_ADDR='203.0.113.5').status_code, 403
+        )
+        # A forged proxy header doesn't get in
+        self.assertEqual(
+            self.client.get(
+                url, REMOTE_ADDR='203.0.113.5', HTTP_X_FORWARDED_FOR='127.0.0.1'
+            ).status_code,
+            403
+        )
+        with override_settings(MESSAGE_METRICS_ALLOWED_IPS=['203.0.113.0/24']):
+            self.assertEqual(self.client.get(url, REMOTE_ADDR='203.0.113.5').status_code, 200)
+
+        staff = get_user_model().objects.create_user('ops', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='203.0.113.5').status_code, 200)
+
+    def test_slow_requests_log_sql(self):
+        """Test requests over the threshold are logged with their SQL"""
+        with override_settings(MESSAGE_SLOW_REQUEST_MS=0.000001), \
+                self.assertLogs('message.slow_requests', 'WARNING') as logs:
+            self.client.get(reverse('message-user-messages'))
+
+        self.assertIn('message-user-messages', logs.output[0])
+        self.assertIn('message_message', logs.output[0])
+
+    def test_histogram_rendering(self):
+        """Test buckets are cumulative and +Inf equals the count"""
+        local = MetricsRegistry()
+        labels = (('view', 'x'), ('method', 'GET'))
+        for value in (0, 2, 500):
+            local.observe('message_request_queries', value, labels)
+        body = render(local.snapshot())
+
+        self.assertIn('message_request_queries_bucket{view="x",method="GET",le="0"} 1', body)
+        self.assertIn('message_request_queries_bucket{view="x",method="GET",le="2"} 2', body)
+        self.assertIn('message_request_queries_bucket{view="x",method="GET",le="100"} 2', body)
+        self.assertIn('message_request_queries_bucket{view="x",method="GET",le="+Inf"} 3', body)
+        self.assertIn('message_request_queries_sum{view="x",method="GET"} 502.0', body)
+
+    @override_settings(MESSAGE_METRICS_ENABLED=False)
+    def test_endpoint_disabled(self):
+        """Test /api/metrics is hidden when metrics are off"""
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 404)
+
+    def test_pool_stats_are_exported(self):
+        """Test a database pool's stats show up as gauges and counters"""
+        pool = mock.Mock()
+        pool.get_stats.return_value = {
+            'pool_size': 4, 'pool_available': 1, 'pool_max': 20, 'requests_waiting': 3,
+            'requests_num': 50, 'requests_queued': 7, 'requests_wait_ms': 1500,
+        }
+        with mock.patch.dict(connections.settings['default']['OPTIONS'], {'pool': True}), \
+                mock.patch.object(type(connections['default']), 'pool', pool, create=True):
+            body = self._metrics()
+
+        self.assertIn('# TYPE message_db_pool_connections gauge', body)
+        self.assertIn('message_db_pool_connections{database="default"} 4', body)
+        self.assertIn('message_db_pool_waiting{database="default"} 3', body)
+        self.assertIn('message_db_pool_queued_total{database="default"} 7', body)
+        self.assertIn('message_db_pool_wait_seconds_total{database="default"} 1.5', body)
+        self.assertIn('message_db_pool_timeouts_total{database="default"} 0', body)
+
+
+class RetentionTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.conversation = Conversation.objects.for_user('A')
+        self.now = timezone.now()
+
+    def _message(self, text, days_ago):
+        message = Message.objects.create(
+            conversation=self.conversation, user_sender='A', user_text=text
+        )
+        Message.objects.filter(pk=message.pk).update(
+            created_at=self.now - timedelta(days=days_ago)
+        )
+        return message
+
+    def test_delete_expired_in_chunks(self):
+        """Test expired rows go in bounded chunks and cascade to reply jobs"""
+        old = [self._message(f"Antiga {number}", 40) for number in range(5)]
+        recent = self._message("Recente", 1)
+        ReplyJob.objects.create(user_message=old[0])
+        version = cache.get("message:history-version:A")
+
+        with CaptureQueriesContext(connection) as queries:
+            deleted = partitions.delete_expired(self.now - timedelta(days=30), chunk_size=2)
+
+        self.assertEqual(deleted, 5)
+        self.assertEqual(list(Message.objects.all()), [recent])
+        self.assertFalse(ReplyJob.objects.exists())
+        self.assertNotEqual(cache.get("message:history-version:A"), version)
+        deletes = [q for q in queries if q['sql'].startswith('DELETE FROM "message_message"')]
+        self.assertEqual(len(deletes), 3)
+
+    def test_prune_command(self):
+        """Test prune_messages honours --days and is a no-op without retention"""
+        self._message("Antiga", 40)
+        self._message("Recente", 1)
+
+        call_command('prune_messages', days=0, stdout=mock.Mock())
+        self.assertEqual(Message.objects.count(), 2)
+
+        call_command('prune_messages', days=30, stdout=mock.Mock())
+        self.assertEqual(list(Message.objects.values_list('user_text', flat=True)), ['Recente'])
+
+    def test_month_arithmetic(self):
+        """Test partition bounds roll over years"""
+        moment = datetime(2026, 11, 18, 15, 30, tzinfo=dt_timezone.utc)
+        start = partitions.month_start(moment)
+        self.assertEqual(start, datetime(2026, 11, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(partitions.add_months(start, 2), datetime(2027, 1, 1, tzinfo=dt_timezone.utc))
+        self.assertEqual(partitions.partition_name(start), 'message_message_p202611')
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "Partitioning needs PostgreSQL")
+    def test_partitioned_table_lifecycle(self):
+        """Test convert, partitions ahead and archival of expired months"""
+        old = self._message("Antiga", 400)
+        ReplyJob.objects.create(user_message=old)
+
+        self.assertTrue(partitions.convert(now=self.now))
+        self.assertFalse(partitions.convert(now=self.now))
+        self.assertTrue(partitions.is_partitioned())
+        created = partitions.ensure_partitions(2, now=self.now)
+        self.assertEqual(len(created), 2)
+        # The parent numbers every row; the old table's own identity is gone
+        # (PostgreSQL 17 refuses to attach it otherwise)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT attidentity FROM pg_attribute "
+                "WHERE attname = 'id' AND attrelid = %s::regclass",
+                [partitions.TABLE]
+            )
+            self.assertEqual(cursor.fetchone()[0], 'd')
+
+        # Writes keep working and ids keep growing
+        new = self._message("Nova", 0)
+        self.assertGreater(new.pk, old.pk)
+        self.assertEqual(Message.objects.count(), 2)
+
+        with tempfile.TemporaryDirectory() as directory:
+            # Far enough ahead that every existing partition has expired
+            later = partitions.add_months(self.now, 6)
+            dropped, deleted = partitions.apply_retention(1, directory, now=later)
+
+            self.assertIn(partitions.LEGACY_PARTITION, dropped)
+            with gzip.open(os.path.join(directory, f"{partitions.LEGACY_PARTITION}.csv.gz"), 'rt') as archive:
+                rows = archive.read().splitlines()
+        self.assertEqual(len(rows), 3)
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(ReplyJob.objects.exists())
+
+
+class StatsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.stats_url = reverse('message-stats')
+        self.conversation = Conversation.objects.for_user('A')
+
+    def _totals(self, response):
+        return {
+            (row['user_sender'], row['sender_role']): row['count']
+            for row in response.data['totals']
+        }
+
+    def _old_message(self, role, moment):
+        # Written behind the rollups' back, the way a lost increment looks
+        message = Message.objects.create(
+            conversation=self.conversation, user_sender='A', sender_role=role,
+            user_text="Antiga"
+        )
+        Message.objects.filter(pk=message.pk).update(created_at=moment)
+        MessageStat.objects.all().delete()
+        return message
+
+    def test_writes_update_rollups(self):
+        """Test send_message and send_messages count both sides, hourly, daily and in total"""
+        self.client.post(reverse('message-login'), {'user': 'A'}, format='json')
+        self.client.post(reverse('message-send-message'), {'text': 'Oi'}, format='json')
+        self.client.post(
+            reverse('message-send-messages'), {'texts': ['Um', 'Dois']}, format='json'
+        )
+
+        response = self.client.get(self.stats_url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._totals(response), {('A', 'user'): 3, ('A', 'bot'): 3})
+        hour = stats.hour_of(timezone.now())
+        self.assertEqual(
+            [
+                (datetime.fromisoformat(row['bucket']), row['sender_role'], row['count'])
+                for row in response.data['hourly']
+            ],
+            [(hour, 'bot', 3), (hour, 'user', 3)]
+        )
+        self.assertEqual(sum(row['count'] for row in response.data['daily']), 6)
+        self.assertIsNone(response.data['reconciled_until'])
+
+    def test_stats_reads_bounded_rows(self):
+        """Test the endpoint's queries don't depend on the messages stored"""
+        self.client.post(reverse('message-login'), {'user': 'A'}, format='json')
+        self.client.get(self.stats_url)
+        with CaptureQueriesContext(connection) as empty:
+            self.client.get(self.stats_url)
+
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, user_sender='A', user_text=str(number))
+            for number in range(200)
+        ])
+        with CaptureQueriesContext(connection) as full:
+            response = self.client.get(self.stats_url, {'hours': 1000, 'days': 'x'})
+
+        self.assertEqual(len(full), len(empty))
+        self.assertFalse(any('message_message"' in query['sql'] for query in full))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_stats_requires_login(self):
+        """Test anonymous requests are refused"""
+        response = self.client.get(self.stats_url)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_reconcile_backfills_and_corrects(self):
+        """Test reconcile_stats recounts closed hours once and advances the mark"""
+        now = timezone.now()
+        self._old_message(SenderRole.USER, now - timedelta(days=3))
+        self._old_message(SenderRole.BOT, now - timedelta(days=3))
+        self._old_message(SenderRole.USER, now - timedelta(days=1))
+        # Counted, then deleted: the rollup is one too high for this hour
+        deleted = Message.objects.create(
+            conversation=self.conversation, user_sender='A', user_text="Apagada"
+        )
+        Message.objects.filter(pk=deleted.pk).update(created_at=now - timedelta(hours=5))
+        stats.add(stats.increments({
+            (stats.hour_of(now - timedelta(hours=5)), 'A', SenderRole.USER): 1
+        }), using='default')
+        deleted.delete()
+        # Too recent to reconcile yet
+        Message.objects.create(conversation=self.conversation, user_sender='A', user_text="Nova")
+
+        out = io.StringIO()
+        call_command('reconcile_stats', stdout=out)
+
+        self.assertIn("counters were off by 4 messages", out.getvalue())
+        summary = stats.summary(days=7)
+        self.assertEqual(
+            [(row['user_sender'], row['sender_role'], row['count']) for row in summary['totals']],
+            [('A', 'bot', 1), ('A', 'user', 2)]
+        )
+        self.assertEqual(sum(row['count'] for row in summary['daily']), 3)
+        mark = StatsProgress.objects.get().reconciled_until
+        self.assertEqual(
+            mark, stats.hour_of(now - timedelta(seconds=settings.MESSAGE_STATS_SETTLE_SECONDS))
+        )
+
+        out = io.StringIO()
+        call_command('reconcile_stats', stdout=out)
+        self.assertIn("Reconciled 0 hours; counters were off by 0 messages", out.getvalue())
+
+        # Rewinding recounts without double counting
+        call_command('reconcile_stats', since=(now - timedelta(days=4)).isoformat(),
+                     stdout=mock.Mock())
+        self.assertEqual(stats.summary()['totals'], summary['totals'])
+
+
+class MessageAdminTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(get_user_model().objects.create_superuser('admin', password=None))
+        self.url = reverse('admin:message_message_changelist')
+        now = timezone.now()
+        self.messages = []
+        for number in range(5):
+            user = 'A' if number % 2 == 0 else 'B'
+            message = Message.objects.create(
+                conversation=Conversation.objects.for_user(user), user_sender=user,
+                user_text=f"Mensagem {number}"
+            )
+            message.created_at = now - timedelta(days=40 * number)
+            Message.objects.filter(pk=message.pk).update(created_at=message.created_at)
+            self.messages.append(message)
+
+    def _ids(self, response):
+        return [message.pk for message in response.context['cl'].result_list]
+
+    @mock.patch.object(message_admin.MessageAdmin, 'list_per_page', 2)
+    def test_changelist_pages_by_cursor(self):
+        """Test the change list walks newest first by cursors, without OFFSET"""
+        ids = [message.pk for message in self.messages]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._ids(response), ids[:2])
+        self.assertFalse(any('OFFSET' in query['sql'] for query in queries))
+        self.assertIsNone(response.context['cl'].newer_url)
+
+        second = self.client.get(self.url + response.context['cl'].older_url)
+        self.assertEqual(self._ids(second), ids[2:4])
+        last = self.client.get(self.url + second.context['cl'].older_url)
+        self.assertEqual(self._ids(last), ids[4:])
+        self.assertIsNone(last.context['cl'].older_url)
+
+        back = self.client.get(self.url + last.context['cl'].newer_url)
+        self.assertEqual(self._ids(back), ids[2:4])
+        self.assertContains(back, 'Próxima página')
+
+    def test_user_filter_and_date_hierarchy(self):
+        """Test the user filter and a hierarchy drill-down narrow the list"""
+        response = self.client.get(self.url, {'user_sender': 'B'})
+        self.assertEqual(self._ids(response), [self.messages[1].pk, self.messages[3].pk])
+
+        newest = timezone.localtime(self.messages[0].created_at)
+        response = self.client.get(
+            self.url, {'created_at__year': newest.year, 'created_at__month': newest.month}
+        )
+        self.assertEqual(self._ids(response), [self.messages[0].pk])
+
+    def test_hierarchy_periods_match_distinct_dates(self):
+        """Test the probed periods are the ones SELECT DISTINCT would find"""
+        probed = message_admin.MessageAdminQuerySet(Message)
+        for kind in ('year', 'month', 'day'):
+            self.assertEqual(
+                probed.datetimes('created_at', kind),
+                list(Message.objects.datetimes('created_at', kind))
+            )
+        with self.assertNumQueries(len(self.messages) + 1):
+            probed.datetimes('created_at', 'day')
+
+    def test_invalid_cursor(self):
+        """Test a broken cursor sends the admin back to its error page"""
+        response = self.client.get(self.url, {'before': 'nope'})
+        self.assertRedirects(response, f"{self.url}?e=1", fetch_redirect_response=False)
+
+    @unittest.skipUnless(connection.vendor == 'postgresql', "Estimates need PostgreSQL")
+    def test_estimated_count(self):
+        """Test large tables get reltuples or planner estimates instead of COUNT(*)"""
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE "message_message"')
+        with mock.patch.object(message_admin, 'EXACT_COUNT_LIMIT', 0):
+            self.assertEqual(message_admin.estimate_count(Message.objects.all()), 5)
+            self.assertIsInstance(
+                message_admin.estimate_count(Message.objects.filter(user_sender='A')), int
+            )
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(self.url)
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries))
+        self.assertContains(response, 'cerca de 5')
+
+    def test_bench_admin_command(self):
+        """Test bench_admin times every page and removes what it seeded"""
+        out = io.StringIO()
+        call_command('bench_admin', messages=50, runs=1, cleanup=True, stdout=out)
+
+        output = out.getvalue()
+        for label in ('first page', 'user filter', 'last 7 days', 'hierarchy month',
+                      'middle page', 'stock COUNT(*)', 'stock OFFSET page'):
+            self.assertIn(label, output)
+        self.assertEqual(Message.objects.count(), len(self.messages))
+
+
+class SearchTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.search_url = reverse('message-search')
+        self.client.post(reverse('message-login'), {'user': 'A'})
+        conversation = Conversation.objects.for_user('A')
+        for text in (
+            'Meu pedido não chegou',
+            'Quero cancelar o pedido do cartão',
+            'Qual o horário de atendimento?',
+        ):
+            Message.objects.create(conversation=conversation, user_sender='A', user_text=text)
+        Message.objects.create(
+            conversation=Conversation.objects.for_user('B'), user_sender='B',
+            user_text='Outro pedido'
+        )
+
+    def _texts(self, response):
+        return [message['user_text'] for message in response.data['results']]
+
+    @staticmethod
+    def _has_unaccent():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'unaccent'")
+            return cursor.fetchone() is not None
+
+    def test_search_matches_own_conversation(self):
+        """Test matches are limited to the logged-in user's conversation"""
+        response = self.client.get(self.search_url, {'q': 'pedido'})
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertCountEqual(
+            self._texts(response),
+            ['Meu pedido não chegou', 'Quero cancelar o pedido do cartão']
+        )
+        self.assertIn('rank', response.data['results'][0])
+        self.assertFalse(response.data['has_more'])
+
+    def test_search_ignores_accents_and_requires_all_words(self):
+        """Test accent-insensitive matching with every word required"""
+        queries = ['horário']
+        if connection.vendor == 'sqlite' or self._has_unaccent():
+            queries.append('horario')
+        for query in queries:
+            response = self.client.get(self.search_url, {'q': query})
+            self.assertEqual(self._texts(response), ['Qual o horário de atendimento?'])
+
+        response = self.client.get(self.search_url, {'q': 'cancelar pedido'})
+        self.assertEqual(self._texts(response), ['Quero cancelar o pedido do cartão'])
+
+    def test_search_is_kept_current_on_write(self):
+        """Test new, edited and deleted messages are reflected"""
+        self.client.post(reverse('message-send-message'), {'text': 'Problema com boleto'})
+        self.assertEqual(
+            self._texts(self.client.get(self.search_url, {'q': 'boleto'})),
+            ['Problema com boleto']
+        )
+
+        Message.objects.filter(user_text='Problema com boleto').update(user_text='Problema com fatura')
+        self.assertEqual(self._texts(self.client.get(self.search_url, {'q': 'boleto'})), [])
+        Message.objects.filter(user_text='Problema com fatura').delete()
+        self.assertEqual(self._texts(self.client.get(self.search_url, {'q': 'fatura'})), [])
+
+    def test_search_pagination(self):
+        """Test page/page_size with has_more and next_page"""
+        response = self.client.get(self.search_url, {'q': 'pedido', 'page_size': 1})
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertTrue(response.data['has_more'])
+        self.assertEqual(response.data['next_page'], 2)
+
+        second = self.client.get(self.search_url, {'q': 'pedido', 'page_size': 1, 'page': 2})
+        self.assertEqual(len(second.data['results']), 1)
+        self.assertFalse(second.data['has_more'])
+        self.assertNotEqual(self._texts(response), self._texts(second))
+
+    def test_search_requires_login_and_query(self):
+        """Test 401 without a session and 400 without q"""
+        self.assertEqual(
+            self.client.get(self.search_url, {'q': '"; DROP'}).status_code, status.HTTP_200_OK
+        )
+        self.assertEqual(self.client.get(self.search_url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            APIClient().get(self.search_url, {'q': 'pedido'}).status_code,
+            status.HTTP_401_UNAUTHORIZED
+        )
+
+
+class ExportTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        now = timezone.now()
+        for user in ('A', 'B'):
+            conversation = Conversation.objects.for_user(user)
+            for days_ago in (10, 5, 1):
+                message = Message.objects.create(
+                    conversation=conversation, user_sender=user,
+                    user_text=f"{user} há {days_ago} dias"
+                )
+                Message.objects.filter(pk=message.pk).update(
+                    created_at=now - timedelta(days=days_ago)
+                )
+        self.week_ago = (now - timedelta(days=7)).date().isoformat()
+
+    async def _download(self, **params):
+        client = AsyncClient()
+        await client.post(reverse('message-login'), {'user': 'A'})
+        response = await client.get(reverse('message-export'), params)
+        if not response.streaming:
+            return response, None
+        return response, b''.join([part async for part in response.streaming_content])
+
+    async def test_ndjson_export_of_own_history(self):
+        """Test the export streams the user's rows, oldest first, as NDJSON"""
+        response, body = await self._download(since=self.week_ago)
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertIn('mensagens-A.ndjson', response['Content-Disposition'])
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([row['user_text'] for row in rows], ['A há 5 dias', 'A há 1 dias'])
+        self.assertEqual(set(rows[0]), set(MessageSerializer().fields))
+
+    async def test_gzipped_csv_export(self):
+        """Test CSV with a header row, compressed on the fly"""
+        response, body = await self._download(format='csv', compress='gzip')
+
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = list(csv.DictReader(gzip.decompress(body).decode().splitlines()))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['user_text'], 'A há 10 dias')
+        self.assertEqual(rows[0]['bot_text'], '')
+
+    async def test_export_validation(self):
+        """Test 400 for unknown formats and dates, 401 without a session"""
+        response, _ = await self._download(format='xml')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response, _ = await self._download(since='ontem')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = await AsyncClient().get(reverse('message-export'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_export_command(self):
+        """Test the command filters by user and date, in small chunks"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.ndjson.gz')
+            call_command(
+                'export_messages', user=['B'], until=self.week_ago, gzip=True,
+                chunk_size=1, output=path
+            )
+            with gzip.open(path, 'rt') as export:
+                rows = [json.loads(line) for line in export]
+
+        self.assertEqual([row['user_text'] for row in rows], ['B há 10 dias'])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv')
+            call_command('export_messages', format='csv', chunk_size=2, output=path)
+            with open(path, newline='') as export:
+                self.assertEqual(len(list(csv.DictReader(export))), 6)
+
+
+class ImportMessagesTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def _write(self, name, lines):
+        path = os.path.join(self.directory.name, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wt', encoding='utf-8') as source:
+            source.write('\n'.join(lines) + '\n')
+        return path
+
+    def _import(self, *args, **options):
+        stdout, stderr = mock.Mock(), mock.Mock()
+        call_command('import_messages', *args, stdout=stdout, stderr=stderr, **options)
+        return [call[0][0] for call in stderr.write.call_args_list]
+
+    def test_ndjson_import_validates_and_keeps_timestamps(self):
+        """Test rows land in their user's conversation with their own created_at"""
+        path = self._write('historico.ndjson.gz', [
+            json.dumps({'user_sender': 'A', 'user_text': 'Olá', 'created_at': '2024-01-02T10:00:00Z'}),
+            json.dumps({'user_sender': 'A', 'sender_role': 'bot', 'bot_text': 'Oi, A'}),
+            json.dumps({'user_sender': 'C', 'user_text': 'Inválido'}),
+            'não é json',
+            json.dumps({'user_sender': 'B', 'user_text': 'Tudo bem?'}),
+        ])
+
+        errors = self._import(path, chunk_size=2)
+
+        self.assertEqual(Message.objects.count(), 3)
+        first = Message.objects.get(user_text='Olá')
+        self.assertEqual(first.conversation.user, 'A')
+        self.assertEqual(first.created_at.year, 2024)
+        self.assertEqual(Message.objects.get(bot_text='Oi, A').sender_role, SenderRole.BOT)
+        self.assertEqual(Message.objects.get(user_text='Tudo bem?').conversation.user, 'B')
+        self.assertEqual(len(errors), 2)
+        self.assertIn('record 3', errors[0])
+        self.assertIn('user_sender', errors[0])
+
+    def test_bad_values_are_skipped(self):
+        """Test impossible dates and non-string fields are reported, not fatal"""
+        path = self._write('historico.ndjson', [
+            json.dumps({'user_sender': 'A', 'user_text': 'Antes'}),
+            json.dumps({'user_sender': 'A', 'user_text': 'Data', 'created_at': '2026-02-30T10:00:00'}),
+            json.dumps({'user_sender': 'A', 'user_text': 'Número', 'created_at': 123}),
+            json.dumps({'user_sender': 'A', 'user_text': ['lista']}),
+            json.dumps({'user_sender': ['A'], 'user_text': 'Usuário'}),
+            json.dumps({'user_sender': 'B', 'user_text': 'Depois'}),
+        ])
+
+        errors = self._import(path)
+
+        self.assertEqual(
+            sorted(Message.objects.values_list('user_text', flat=True)), ['Antes', 'Depois']
+        )
+        self.assertEqual(len(errors), 4)
+        self.assertIn('created_at', errors[0])
+        self.assertIn('user_text', errors[2])
+
+    def test_resume_after_failure(self):
+        """Test a failed import resumes after its last committed chunk"""
+        path = self._write('historico.ndjson', [
+            json.dumps({'user_sender': 'A', 'user_text': f'Mensagem {number}'})
+            for number in range(5)
+        ])
+
+        def crash_on_fourth_record(record):
+            if record['user_text'] == 'Mensagem 3':
+                raise RuntimeError('queda')
+            return clean_record(record)
+
+        with mock.patch('message.imports.clean_record', crash_on_fourth_record):
+            with self.assertRaises(RuntimeError):
+                self._import(path, chunk_size=2)
+        self.assertEqual(Message.objects.count(), 2)
+
+        self._import(path, chunk_size=2)
+        self.assertEqual(
+            sorted(Message.objects.values_list('user_text', flat=True)),
+            [f'Mensagem {number}' for number in range(5)]
+        )
+        self.assertEqual(ImportProgress.objects.get().rows_imported, 5)
+
+        # Finished files are skipped, unless restarted
+        self._import(path)
+        self.assertEqual(Message.objects.count(), 5)
+        self._import(path, restart=True)
+        self.assertEqual(Message.objects.count(), 10)
+
+    def test_export_round_trip(self):
+        """Test a CSV export loads back unchanged"""
+        conversation = Conversation.objects.for_user('B')
+        Message.objects.create(conversation=conversation, user_sender='B', user_text='Pergunta, com vírgula')
+        Message.objects.create(
+            conversation=conversation, user_sender='B', sender_role=SenderRole.BOT, bot_text='Resposta\nem linhas'
+        )
+        path = os.path.join(self.directory.name, 'export.csv')
+        call_command('export_messages', format='csv', output=path)
+        exported = list(Message.objects.values_list('sender_role', 'user_text', 'bot_text', 'created_at'))
+        Message.objects.all().delete()
+
+        self._import(path)
+
+        self.assertEqual(
+            list(Message.objects.values_list('sender_role', 'user_text', 'bot_text', 'created_at')),
+            exported
+        )
+
+
+@override_settings(MESSAGE_RATE_LIMITS={
+    'login': {'ip': '2/m'},
+    'send_message': {'user': '2/m', 'ip': '100/m'},
+})
+class RateLimitTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.send_message_url = reverse('message-send-message')
+        self.client.post(reverse('message-login'), {'user': 'A'})
+
+    def _send(self, client=None):
+        return (client or self.client).post(self.send_message_url, {'text': 'Olá'})
+
+    def test_user_bucket_refuses_with_retry_after(self):
+        """Test the 429 once a user's burst is spent, leaving other users alone"""
+        self.assertEqual(self._send().status_code, 201)
+        self.assertEqual(self._send().status_code, 201)
+
+        response = self._send()
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Erro', response.json())
+        self.assertTrue(1 <= int(response['Retry-After']) <= 30)
+        self.assertEqual(Message.objects.count(), 4)
+
+        other = APIClient()
+        other.post(reverse('message-login'), {'user': 'B'})
+        self.assertEqual(self._send(other).status_code, 201)
+
+    def test_tokens_refill_over_time(self):
+        """Test that a token comes back after rate's interval, and only one"""
+        now = int(timezone.now().timestamp() * 1000)
+        with mock.patch('message.throttling._now_ms', return_value=now):
+            self._send()
+            self._send()
+            self.assertEqual(self._send().status_code, 429)
+        with mock.patch('message.throttling._now_ms', return_value=now + 31000):
+            self.assertEqual(self._send().status_code, 201)
+            self.assertEqual(self._send().status_code, 429)
+
+    def test_ip_bucket_covers_anonymous_logins(self):
+        """Test that login is limited per client IP"""
+        client = APIClient(REMOTE_ADDR='10.0.0.1')
+        login_url = reverse('message-login')
+        self.assertEqual(client.post(login_url, {'user': 'A'}).status_code, 200)
+        self.assertEqual(client.post(login_url, {'user': 'B'}).status_code, 200)
+        self.assertEqual(client.post(login_url, {'user': 'A'}).status_code, 429)
+
+        other = APIClient(REMOTE_ADDR='10.0.0.2')
+        self.assertEqual(other.post(login_url, {'user': 'A'}).status_code, 200)
+
+    @override_settings(MESSAGE_MAX_CONCURRENT_REQUESTS=1, MESSAGE_CONCURRENCY_TIMEOUT=0)
+    def test_sheds_load_when_saturated(self):
+        """Test the 503 while every request slot is taken"""
+        self.assertTrue(limiter.acquire())
+        try:
+            response = self._send()
+        finally:
+            limiter.release()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(Message.objects.count(), 0)
+
+        self.assertEqual(self._send().status_code, 201)
+        self.assertEqual(limiter.active, 0)
+
+    @override_settings(
+        MESSAGE_MAX_CONCURRENT_REQUESTS=20, DATABASE_MAX_CONNECTIONS=90, WEB_CONCURRENCY=4,
+        DATABASE_POOL=True, DATABASE_POOL_OPTIONS={'max_size': 10},
+    )
+    def test_capacity_follows_the_database(self):
+        """Test the per-process cap is the process' share of the connections"""
+        self.assertEqual(capacity(), 10)
+        with self.settings(DATABASE_POOL=False):
+            self.assertEqual(capacity(), 20)
+            with self.settings(WEB_CONCURRENCY=9):
+                self.assertEqual(capacity(), 10)
+            with self.settings(DATABASE_MAX_CONNECTIONS=0):
+                self.assertEqual(capacity(), 20)
+
+    @override_settings(MESSAGE_CONCURRENCY_TIMEOUT=0)
+    def test_saturated_pool_admits_no_more_requests(self):
+        """Test that requests waiting on the pool keep new ones out"""
+        pool = mock.Mock()
+        pool.get_stats.return_value = {'requests_waiting': 2}
+        self.assertTrue(limiter.acquire())
+        try:
+            with mock.patch.dict(connections.settings['default']['OPTIONS'], {'pool': True}), \
+                    mock.patch.object(type(connections['default']), 'pool', pool, create=True):
+                self.assertFalse(limiter.acquire())
+            self.assertTrue(limiter.acquire())
+            limiter.release()
+        finally:
+            limiter.release()
+
+    async def test_async_views_share_the_buckets(self):
+        """Test that the async send_message spends the same tokens"""
+        await sync_to_async(self._send)()
+        await sync_to_async(self._send)()
+
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        await session.aset('active_user', 'A')
+        request = AsyncRequestFactory().post(
+            '/', json.dumps({'text': 'Olá'}), content_type='application/json'
+        )
+        request.session = session
+        response = await async_views.send_message(request)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+
+    @override_settings(MESSAGE_RATE_LIMITS={'user_messages': {'user': '1/m'}})
+    async def test_history_reads_are_limited(self):
+        """Test that user_messages has its own bucket, in both view stacks"""
+        url = reverse('message-user-messages')
+        self.assertEqual((await sync_to_async(self.client.get)(url)).status_code, 200)
+        self.assertEqual((await sync_to_async(self.client.get)(url)).status_code, 429)
+
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        await session.aset('active_user', 'A')
+        request = AsyncRequestFactory().get('/')
+        request.session = session
+        response = await async_views.user_messages(request)
+        self.assertEqual(response.status_code, 429)
+
+
+class IdempotencyTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.send_message_url = reverse('message-send-message')
+        self.client.post(reverse('message-login'), {'user': 'A'})
+
+    def _send(self, text='Olá', key='retry-1', client=None):
+        return (client or self.client).post(
+            self.send_message_url, {'text': text}, headers={'Idempotency-Key': key}
+        )
+
+    def test_retry_replays_the_first_response(self):
+        """Test that a repeated key writes once and returns the stored body"""
+        first = self._send()
+        retry = self._send()
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first)
+        self.assertEqual(Message.objects.count(), 2)
+
+        self.assertEqual(self._send(key='retry-2').status_code, 201)
+        self.assertEqual(Message.objects.count(), 4)
+
+    def test_key_reused_with_other_text(self):
+        """Test the 422 for a key already bound to a different message"""
+        self._send(text='Olá')
+        response = self._send(text='Tchau')
+        self.assertEqual(response.status_code, 422)
+        self.assertIn('Erro', response.json())
+        self.assertEqual(Message.objects.count(), 2)
+
+        response = self._send(key='x' * 256)
+        self.assertEqual(response.status_code, 400)
+
+    def test_keys_are_scoped_per_user(self):
+        """Test that another user's identical key is a new request"""
+        self._send()
+        other = APIClient()
+        other.post(reverse('message-login'), {'user': 'B'})
+        self.assertNotIn('Idempotent-Replayed', self._send(client=other))
+        self.assertEqual(Message.objects.count(), 4)
+
+    @override_settings(MESSAGE_IDEMPOTENCY_WINDOW=60)
+    def test_expired_keys_are_forgotten(self):
+        """Test that a key outside the window writes again and gets pruned"""
+        self._send()
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(seconds=61))
+
+        self.assertNotIn('Idempotent-Replayed', self._send())
+        self.assertEqual(Message.objects.count(), 4)
+        self.assertEqual(IdempotencyKey.objects.count(), 1)
+
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(idempotency.delete_expired(), 1)
+
+    @override_settings(MESSAGE_REPLY_MODE='queue')
+    def test_queue_mode_replays_the_job(self):
+        """Test that a retried queued send points at the same reply job"""
+        first = self._send()
+        retry = self._send()
+        self.assertEqual(retry.status_code, 202)
+        self.assertEqual(retry.json()['reply_job'], first.json()['reply_job'])
+        self.assertEqual(ReplyJob.objects.count(), 1)
+
+    async def test_async_view_replays(self):
+        """Test the same contract on the async send_message"""
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        await session.aset('active_user', 'A')
+
+        def request():
+            request = AsyncRequestFactory().post(
+                '/', json.dumps({'text': 'Olá'}), content_type='application/json',
+                headers={'Idempotency-Key': 'async-1'}
+            )
+            request.session = session
+            return request
+
+        first = await async_views.send_message(request())
+        retry = await async_views.send_message(request())
+        self.assertEqual(json.loads(retry.content), json.loads(first.content))
+        self.assertEqual(retry['Idempotent-Replayed'], 'true')
+        self.assertEqual(await Message.objects.acount(), 2)
+
+
+@unittest.skipUnless(connection.vendor == 'postgresql', "Needs concurrent writers")
+class IdempotencyConcurrencyTestCase(TransactionTestCase):
+
+    def test_concurrent_duplicates_write_once(self):
+        """Test that a retry racing the original waits for it and replays"""
+        barrier = threading.Barrier(2)
+        responses = []
+
+        def slow_reply(user, text):
+            # Keeps the first transaction open while the duplicate arrives
+            time.sleep(0.3)
+            return 'Resposta'
+
+        def send():
+            client = APIClient()
+            client.post(reverse('message-login'), {'user': 'A'})
+            barrier.wait(timeout=5)
+            responses.append(client.post(
+                reverse('message-send-message'), {'text': 'Olá'},
+                headers={'Idempotency-Key': 'race'}
+            ))
+            connection.close()
+
+        with mock.patch('message.views.bot_reply', side_effect=slow_reply):
+            threads = [threading.Thread(target=send) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [201, 201])
+        self.assertEqual(responses[0].json(), responses[1].json())
+        self.assertEqual(Message.objects.count(), 2)
+
+
+class ConnectionStressTestCase(TransactionTestCase):
+
+    def test_every_mode_is_driven_and_cleaned_up(self):
+        """Test stress_connections runs each mode, then restores settings and rows"""
+        original = dict(connections.settings['default'])
+        stdout = io.StringIO()
+        call_command('stress_connections', concurrency=[1], requests=3, stdout=stdout)
+
+        modes = ['direct', 'persistent']
+        if connection.vendor == 'postgresql':
+            modes.append('pool')
+        for mode in modes:
+            self.assertIn(f"mode={mode:<10} clients=  1 requests=    3 errors=0", stdout.getvalue())
+        self.assertEqual(dict(connections.settings['default']), original)
+        self.assertFalse(Message.objects.exists())
+
+
+@override_settings(MESSAGE_WRITE_MODE='buffered')
+class WriteBufferTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.directory = tempfile.mkdtemp()
+        self.buffer = buffer.WriteBuffer(self.directory, background=False)
+        self.buffer.start()
+        patcher = mock.patch('message.buffer._buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = APIClient()
+        self.client.post(reverse('message-login'), {'user': 'A'})
+        self.earlier = Message.objects.create(
+            conversation=Conversation.objects.for_user('A'), user_sender='A',
+            user_text='Mensagem já gravada'
+        )
+
+    def tearDown(self):
+        for segment in [self.buffer._segment, *self.buffer._sealed]:
+            segment.file.close()
+
+    def _send(self, text='Olá'):
+        return self.client.post(reverse('message-send-message'), {'text': text})
+
+    def _spilled(self):
+        return [
+            json.loads(line)
+            for path in sorted(os.listdir(self.directory))
+            for line in open(os.path.join(self.directory, path))
+        ]
+
+    def test_insert_messages_assigns_ids_and_keeps_timestamps(self):
+        """Test raw inserts without ids, as imports and rebalancing do them"""
+        moment = timezone.now() - timedelta(days=3)
+        message = Message(
+            conversation=self.earlier.conversation, user_sender='A',
+            user_text='Importada', created_at=moment
+        )
+        buffer.insert_messages([message])
+
+        self.assertGreater(message.pk, self.earlier.pk)
+        self.assertEqual(Message.objects.get(pk=message.pk).created_at, moment)
+        self.assertTrue(Message._meta.get_field('created_at').auto_now_add)
+
+    def test_unsupported_database_is_refused_up_front(self):
+        """Test that buffered writes on another vendor fail before accepting anything"""
+        with mock.patch('message.buffer._buffer', None), \
+                mock.patch.object(connection, 'vendor', 'mysql'):
+            with self.assertRaisesMessage(ImproperlyConfigured, "shard 'default' is mysql"):
+                buffer.get_buffer()
+
+    def test_several_workers_are_refused_up_front(self):
+        """Test that buffered writes refuse to run in more than one process"""
+        with mock.patch('message.buffer._buffer', None), \
+                self.settings(WEB_CONCURRENCY=4):
+            with self.assertRaisesMessage(ImproperlyConfigured, "WEB_CONCURRENCY = 1"):
+                buffer.get_buffer()
+
+    def test_send_is_spilled_then_flushed(self):
+        """Test that accepted messages hit the spill file first and the table on flush"""
+        sent = self._send().json()
+        ids = [sent['user_message']['id'], sent['bot_message']['id']]
+
+        self.assertEqual(Message.objects.count(), 1)
+        self.assertEqual([record['id'] for record in self._spilled()], ids)
+        # Reserved ids are never handed out to direct inserts
+        direct = Message.objects.create(
+            conversation=self.earlier.conversation, user_sender='A', user_text='Direta'
+        )
+        self.assertNotIn(direct.id, ids)
+
+        history = self.client.get(reverse('message-user-messages')).json()
+        self.assertEqual([message['id'] for message in history], [self.earlier.id, *ids, direct.id])
+
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self._spilled(), [])
+        flushed = Message.objects.get(id=sent['user_message']['id'])
+        self.assertEqual(FastMessageSerializer.one(flushed), sent['user_message'])
+
+        response = self.client.get(reverse('message-user-messages'))
+        self.assertEqual(response.json(), history)
+        self.assertIn('ETag', response)
+
+    def test_paginated_reads_see_pending_rows(self):
+        """Test after_id and the latest page with unflushed messages"""
+        sent = self._send().json()
+        url = reverse('message-user-messages')
+
+        page = self.client.get(url, {'after_id': self.earlier.id}).json()
+        self.assertEqual(
+            [message['id'] for message in page['results']],
+            [sent['user_message']['id'], sent['bot_message']['id']]
+        )
+        page = self.client.get(url, {'after_id': sent['user_message']['id']}).json()
+        self.assertEqual(page['results'], [sent['bot_message']])
+
+        page = self.client.get(url, {'page_size': 1}).json()
+        self.assertEqual(page['results'], [sent['bot_message']])
+        self.assertTrue(page['has_more'])
+
+    def test_recover_loads_orphaned_spill_files(self):
+        """Test that another buffer inserts what a dead process left, once"""
+        sent = self._send().json()
+        # What a crash leaves: the spill file, no longer locked
+        self.buffer._segment.file.close()
+
+        survivor = buffer.WriteBuffer(self.directory, background=False)
+        self.assertEqual(survivor.recover(), 2)
+        self.assertEqual(survivor.recover(), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(
+            FastMessageSerializer.one(Message.objects.get(id=sent['bot_message']['id'])),
+            sent['bot_message']
+        )
+
+    def test_live_spill_files_are_left_alone(self):
+        """Test that recover() skips segments a running buffer holds"""
+        self._send()
+        self.assertEqual(buffer.WriteBuffer(self.directory, background=False).recover(), 0)
+        self.assertEqual(len(self._spilled()), 2)
+
+
+class TemporaryDatabases:
+    """Registers ``aliases`` as migrated SQLite files for the test class"""
+    aliases = ()
+
+    @classmethod
+    def setUpClass(cls):
+        # Registered here rather than in DATABASES, so the test runner
+        # doesn't try to create test copies of them
+        cls.databases = set(cls.aliases)
+        cls.directory = tempfile.mkdtemp()
+        for alias in cls.aliases:
+            connections.settings[alias] = connections.configure_settings({
+                'default': connections.settings['default'],
+                alias: {
+                    'ENGINE': 'django.db.backends.sqlite3',
+                    'NAME': os.path.join(cls.directory, f'{alias}.sqlite3'),
+                },
+            })[alias]
+        super().setUpClass()
+        with override_settings(MESSAGE_SHARDS=list(cls.aliases), MESSAGE_REPLICAS={}):
+            for alias in cls.aliases:
+                call_command('migrate', 'message', database=alias, verbosity=0)
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in cls.aliases:
+            connections[alias].close()
+            del connections[alias]
+            del connections.settings[alias]
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        cache.clear()
+        for alias in self.aliases:
+            for model in (IdempotencyKey, ReplyJob, Message, Conversation):
+                model.objects.using(alias).all().delete()
+
+
+SHARDS = ['shard_test_0', 'shard_test_1', 'shard_test_2']
+
+
+class ShardingTestCase(TemporaryDatabases, SimpleTestCase):
+    """Conversations spread over three SQLite databases"""
+    aliases = SHARDS
+
+    @staticmethod
+    def _write(user, count):
+        conversation = Conversation.objects.for_user(user)
+        for number in range(count):
+            conversation.messages.create(user_sender=user, user_text=f'{user} {number}')
+        return conversation
+
+    @staticmethod
+    def _history(user, alias):
+        return list(
+            Message.objects.using(alias).filter(conversation__user=user)
+            .order_by('created_at', 'id').values_list('user_text', 'bot_text')
+        )
+
+    def test_rows_land_on_the_user_shard(self):
+        """Test the API reads and writes each user's rows on their shard only"""
+        with override_settings(MESSAGE_SHARDS=SHARDS):
+            for user in ('A', 'B'):
+                client = APIClient()
+                client.post(reverse('message-login'), {'user': user})
+                client.post(
+                    reverse('message-send-message'), {'text': 'Olá'},
+                    headers={'Idempotency-Key': f'chave-{user}'}
+                )
+                history = client.get(reverse('message-user-messages')).json()
+
+                home = shard_for(user)
+                self.assertEqual(len(history), 2)
+                self.assertEqual(len(self._history(user, home)), 2)
+                self.assertTrue(IdempotencyKey.objects.using(home).filter(user=user).exists())
+                for alias in set(SHARDS) - {home}:
+                    self.assertFalse(Conversation.objects.using(alias).filter(user=user).exists())
+
+    def test_adding_a_shard_only_moves_users_to_it(self):
+        """Test rendezvous hashing moves about 1/N of the users, all to the new shard"""
+        users = [f'u{number}' for number in range(3000)]
+        before = {user: shard_for(user, SHARDS[:2]) for user in users}
+        after = {user: shard_for(user, SHARDS) for user in users}
+
+        moved = [user for user in users if before[user] != after[user]]
+        self.assertEqual({after[user] for user in moved}, {SHARDS[2]})
+        self.assertAlmostEqual(len(moved) / len(users), 1 / 3, delta=0.05)
+
+    def test_rebalance_moves_conversations_once(self):
+        """Test rebalance copies history, jobs and keys to the new shard and is idempotent"""
+        users = [f'u{number}' for number in range(12)]
+        with override_settings(MESSAGE_SHARDS=SHARDS[:1]):
+            for user in users:
+                conversation = self._write(user, 3)
+                message = conversation.messages.first()
+                ReplyJob.objects.using(SHARDS[0]).create(user_message=message)
+                IdempotencyKey.objects.using(SHARDS[0]).create(
+                    user=user, key='chave', request_hash='x', status_code=201,
+                    response={
+                        'user_message': {'id': message.id, 'conversation': conversation.pk},
+                        'bot_message': None,
+                    }
+                )
+        expected = {user: self._history(user, SHARDS[0]) for user in users}
+
+        with override_settings(MESSAGE_SHARDS=SHARDS):
+            moved = rebalance.rebalance()
+            self.assertEqual(
+                sorted(user for user, *_ in moved),
+                sorted(user for user in users if shard_for(user) != SHARDS[0])
+            )
+            self.assertEqual(rebalance.rebalance(), [])
+
+            for user in users:
+                home = shard_for(user)
+                self.assertEqual(self._history(user, home), expected[user])
+                first = Message.objects.for_user(user).order_by('created_at', 'id').first()
+                self.assertEqual(ReplyJob.objects.using(home).get(
+                    user_message__conversation__user=user
+                ).user_message_id, first.id)
+                key = IdempotencyKey.objects.using(home).get(user=user)
+                self.assertEqual(key.response['user_message']['id'], first.id)
+                self.assertEqual(
+                    key.response['user_message']['conversation'], first.conversation_id
+                )
+                if home != SHARDS[0]:
+                    self.assertEqual(self._history(user, SHARDS[0]), [])
+
+    def test_source_is_deleted_in_chunks(self):
+        """Test the moved history leaves the old shard in chunk-sized deletes"""
+        with override_settings(MESSAGE_SHARDS=SHARDS[:1]):
+            users = [f'u{number}' for number in range(20)]
+            for user in users:
+                self._write(user, 5)
+
+        with override_settings(MESSAGE_SHARDS=SHARDS):
+            user = next(user for user in users if shard_for(user) != SHARDS[0])
+            conversation = Conversation.objects.using(SHARDS[0]).get(user=user)
+            with CaptureQueriesContext(connections[SHARDS[0]]) as queries:
+                rebalance.move_conversation(conversation, shard_for(user), chunk_size=2)
+
+        deletes = [
+            query['sql'] for query in queries
+            if query['sql'].startswith('DELETE FROM "message_message"')
+        ]
+        self.assertEqual(len(deletes), 3)
+        self.assertEqual(self._history(user, SHARDS[0]), [])
+        self.assertFalse(Conversation.objects.using(SHARDS[0]).filter(user=user).exists())
+
+    def test_interrupted_rebalance_resumes_without_duplicates(self):
+        """Test a move that failed halfway is finished by the next run"""
+        with override_settings(MESSAGE_SHARDS=SHARDS[:1]):
+            users = [f'u{number}' for number in range(20)]
+            for user in users:
+                self._write(user, 5)
+
+        with override_settings(MESSAGE_SHARDS=SHARDS):
+            user = next(user for user in users if shard_for(user) != SHARDS[0])
+            expected = self._history(user, SHARDS[0])
+            conversation = Conversation.objects.using(SHARDS[0]).get(user=user)
+            copy_messages = rebalance._copy_messages
+            calls = []
+
+            def fail_on_third_chunk(*args):
+                calls.append(args)
+                if len(calls) == 3:
+                    raise RuntimeError('queda')
+                return copy_messages(*args)
+
+            with mock.patch('message.rebalance._copy_messages', fail_on_third_chunk):
+                with self.assertRaises(RuntimeError):
+                    rebalance.move_conversation(conversation, shard_for(user), chunk_size=2)
+            self.assertEqual(len(self._history(user, shard_for(user))), 4)
+
+            rebalance.rebalance(chunk_size=2)
+            self.assertEqual(self._history(user, shard_for(user)), expected)
+            self.assertEqual(self._history(user, SHARDS[0]), [])
+
+
+@override_settings(
+    MESSAGE_SHARDS=['primary_test'],
+    MESSAGE_REPLICAS={'primary_test': ['primary_test_replica']},
+)
+class ReplicaTestCase(TemporaryDatabases, SimpleTestCase):
+    """A primary and a replica that never catches up, as separate SQLite files"""
+    aliases = ['primary_test', 'primary_test_replica']
+
+    def setUp(self):
+        super().setUp()
+        replicas._down_until.clear()
+        for alias, text in [('primary_test', 'Do primário'), ('primary_test_replica', 'Da réplica')]:
+            # Explicit aliases: the router would send writes for the replica to the primary
+            conversation = Conversation.objects.using(alias).create(user='A')
+            Message.objects.using(alias).create(
+                conversation=conversation, user_sender='A', user_text=text
+            )
+
+    def _client(self):
+        client = APIClient()
+        client.post(reverse('message-login'), {'user': 'A'})
+        return client
+
+    def _texts(self, response):
+        return [message['user_text'] for message in response.json()]
+
+    def test_reads_stick_to_the_primary_after_a_write(self):
+        """Test replica reads, and primary reads for the session that just wrote"""
+        writer, reader = self._client(), self._client()
+        url = reverse('message-user-messages')
+
+        response = reader.get(url)
+        self.assertEqual(self._texts(response), ['Da réplica'])
+        # Possibly stale, so never cached or tagged
+        self.assertNotIn('ETag', response)
+
+        writer.post(reverse('message-send-message'), {'text': 'Olá'})
+        self.assertEqual(Message.objects.using('primary_test').count(), 3)
+        response = writer.get(url)
+        self.assertEqual(self._texts(response), ['Do primário', 'Olá', None])
+        self.assertIn('ETag', response)
+
+        cache.clear()
+        later = time.time() + settings.MESSAGE_REPLICA_STICKY_SECONDS + 1
+        with mock.patch('message.replicas.time.time', return_value=later):
+            self.assertEqual(self._texts(writer.get(url)), ['Da réplica'])
+
+    def test_failing_replica_falls_back_to_the_primary(self):
+        """Test a broken replica is skipped until its retry interval is over"""
+        replica = connections['primary_test_replica']
+        path = replica.settings_dict['NAME']
+        replica.close()
+        os.rename(path, f'{path}.bak')
+
+        def restore():
+            if os.path.exists(f'{path}.bak'):
+                replica.close()
+                os.replace(f'{path}.bak', path)
+        self.addCleanup(restore)
+
+        url = reverse('message-user-messages')
+        self.assertEqual(self._texts(self._client().get(url)), ['Do primário'])
+        self.assertFalse(replicas.healthy('primary_test_replica'))
+
+        restore()
+        cache.clear()
+        self.assertEqual(self._texts(self._client().get(url)), ['Do primário'])
+        # That primary read filled the shared cache
+        cache.clear()
+        later = time.monotonic() + settings.MESSAGE_REPLICA_RETRY_INTERVAL + 1
+        with mock.patch('message.replicas.time.monotonic', return_value=later):
+            self.assertEqual(self._texts(self._client().get(url)), ['Da réplica'])
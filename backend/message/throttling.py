@@ -0,0 +1,254 @@
+"""
+Rate limiting and load shedding for the message endpoints.
+
+Rate limits are token buckets kept in the default cache, one per action and
+per session user and/or client IP (MESSAGE_RATE_LIMITS). Each bucket is a
+single integer, its theoretical arrival time in milliseconds (GCRA): taking
+a token is one atomic ``incr``, so concurrent workers sharing the cache
+can't both spend the last token. The key expires when the bucket is full
+again, which is what makes an idle client start over with a full burst.
+
+``limiter`` caps the requests a process runs against the database at once.
+The cap is per process: MESSAGE_MAX_CONCURRENT_REQUESTS, lowered to the
+process' share of DATABASE_MAX_CONNECTIONS (split over WEB_CONCURRENCY
+workers) and to its pool's max_size, so all the workers together can't ask
+for more connections than the database has. While a pool already has
+requests waiting for a connection no new request is let in either. Requests
+that can't get a slot within MESSAGE_CONCURRENCY_TIMEOUT are turned away
+with a 503 instead of queueing.
+"""
+import asyncio
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+THROTTLED_MESSAGE = "Muitas requisições, tente novamente em {} s"
+OVERLOADED_MESSAGE = "Servidor sobrecarregado, tente novamente em instantes"
+
+
+class Overloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = OVERLOADED_MESSAGE
+
+
+class RateLimit:
+    """``"<requests>/<period>"``: a burst of ``requests``, refilled evenly over the period"""
+    def __init__(self, rate):
+        requests, _, period = rate.partition('/')
+        self.capacity = int(requests)
+        if self.capacity <= 0 or not period or period[0] not in PERIODS:
+            raise ValueError(f"Invalid rate {rate!r}")
+        # Whole milliseconds, since the bucket lives in an integer counter
+        self.interval = math.ceil(PERIODS[period[0]] * 1000 / self.capacity)
+
+    @property
+    def horizon(self):
+        # How far ahead of now the arrival time may run before requests are refused
+        return self.capacity * self.interval
+
+
+def _now_ms():
+    return time.time_ns() // 1_000_000
+
+
+def _key(action, kind, ident):
+    return f"message:ratelimit:{action}:{kind}:{ident}"
+
+
+def _ttl(tat, now):
+    return max(1, math.ceil((tat - now) / 1000))
+
+
+def buckets(action, active_user, ip):
+    """``(cache key, RateLimit)`` for every limit configured for ``action``"""
+    limits = settings.MESSAGE_RATE_LIMITS.get(action) or {}
+    idents = {'user': active_user, 'ip': ip}
+    return [
+        (_key(action, kind, idents[kind]), RateLimit(rate))
+        for kind, rate in limits.items()
+        if rate and idents.get(kind)
+    ]
+
+
+def _take(key, limit, now):
+    """Spend one token; returns the seconds to wait, 0 when allowed"""
+    step = limit.interval
+    for _ in range(2):
+        try:
+            tat = cache.incr(key, step)
+            break
+        except ValueError:
+            # Missing (or just expired) key: a full bucket
+            if cache.add(key, now + step, _ttl(now + step, now)):
+                return 0
+    else:
+        return 0
+
+    if tat - now > limit.horizon:
+        _refund(key, limit)
+        return (tat - now - limit.horizon) / 1000
+    cache.touch(key, _ttl(tat, now))
+    return 0
+
+
+async def _atake(key, limit, now):
+    step = limit.interval
+    for _ in range(2):
+        try:
+            tat = await cache.aincr(key, step)
+            break
+        except ValueError:
+            if await cache.aadd(key, now + step, _ttl(now + step, now)):
+                return 0
+    else:
+        return 0
+
+    if tat - now > limit.horizon:
+        await _arefund(key, limit)
+        return (tat - now - limit.horizon) / 1000
+    await cache.atouch(key, _ttl(tat, now))
+    return 0
+
+
+def _refund(key, limit):
+    try:
+        cache.decr(key, limit.interval)
+    except ValueError:
+        pass
+
+
+async def _arefund(key, limit):
+    try:
+        await cache.adecr(key, limit.interval)
+    except ValueError:
+        pass
+
+
+def check_rate_limits(action, active_user, ip):
+    """
+    Take a token from each of ``action``'s buckets. Returns None when the
+    request may go ahead, otherwise the seconds until it would be allowed;
+    a refused request doesn't keep the tokens it took from other buckets.
+    """
+    now = _now_ms()
+    taken, wait = [], 0
+    for key, limit in buckets(action, active_user, ip):
+        delay = _take(key, limit, now)
+        if delay:
+            wait = max(wait, delay)
+        else:
+            taken.append((key, limit))
+    if not wait:
+        return None
+    for key, limit in taken:
+        _refund(key, limit)
+    return wait
+
+
+async def acheck_rate_limits(action, active_user, ip):
+    now = _now_ms()
+    taken, wait = [], 0
+    for key, limit in buckets(action, active_user, ip):
+        delay = await _atake(key, limit, now)
+        if delay:
+            wait = max(wait, delay)
+        else:
+            taken.append((key, limit))
+    if not wait:
+        return None
+    for key, limit in taken:
+        await _arefund(key, limit)
+    return wait
+
+
+def retry_after(wait):
+    return str(max(1, math.ceil(wait)))
+
+
+def client_ip(request):
+    # Same rules as DRF's throttles, NUM_PROXIES included
+    return BaseThrottle().get_ident(request)
+
+
+class ActionRateThrottle(BaseThrottle):
+    """DRF throttle applying MESSAGE_RATE_LIMITS to the view's current action"""
+    def allow_request(self, request, view):
+        self.delay = check_rate_limits(
+            view.action, request.session.get('active_user'), client_ip(request)
+        )
+        return self.delay is None
+
+    def wait(self):
+        return self.delay
+
+
+def capacity():
+    """Requests one worker process may serve at once (0: no limit)"""
+    limit = settings.MESSAGE_MAX_CONCURRENT_REQUESTS
+    if not limit:
+        return 0
+    if settings.DATABASE_MAX_CONNECTIONS:
+        share = settings.DATABASE_MAX_CONNECTIONS // max(settings.WEB_CONCURRENCY, 1)
+        limit = min(limit, max(share, 1))
+    if settings.DATABASE_POOL:
+        limit = min(limit, settings.DATABASE_POOL_OPTIONS['max_size'])
+    return limit
+
+
+def pool_saturated():
+    """Whether a database pool of this process has requests waiting for a connection"""
+    for alias in connections:
+        if connections.settings[alias].get('OPTIONS', {}).get('pool'):
+            if connections[alias].pool.get_stats().get('requests_waiting', 0):
+                return True
+    return False
+
+
+class ConcurrencyLimiter:
+    """Counts the requests in flight in this process against capacity()"""
+    def __init__(self):
+        self.active = 0
+        self._condition = threading.Condition()
+
+    def _try_acquire(self):
+        limit = capacity()
+        if limit and self.active and (self.active >= limit or pool_saturated()):
+            return False
+        self.active += 1
+        return True
+
+    def acquire(self, timeout=None):
+        timeout = settings.MESSAGE_CONCURRENCY_TIMEOUT if timeout is None else timeout
+        with self._condition:
+            return self._condition.wait_for(self._try_acquire, timeout)
+
+    async def aacquire(self, timeout=None):
+        # Polls rather than waiting on the condition, which would block the event loop
+        timeout = settings.MESSAGE_CONCURRENCY_TIMEOUT if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._condition:
+                if self._try_acquire():
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.005)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+limiter = ConcurrencyLimiter()
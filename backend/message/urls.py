@@ -1,11 +1,29 @@
 from rest_framework.routers import DefaultRouter
 
+from django.conf import settings
 from django.urls import path, include
 
-from .views import MessageViewSet
+from .views import MessageViewSet, message_export, message_stream, metrics_view
 
 
 router = DefaultRouter()
 router.register(r'message', MessageViewSet, basename='message')
 
-urlpatterns = [path("", include(router.urls))]
+urlpatterns = [
+    path("metrics", metrics_view, name="metrics"),
+    path("message/stream/", message_stream, name="message-stream"),
+    path("message/export/", message_export, name="message-export"),
+]
+
+if settings.MESSAGE_ASYNC_VIEWS:
+    # Native async views, routed ahead of the matching ViewSet actions; only
+    # imported when they serve requests
+    from . import async_views
+
+    urlpatterns += [
+        path("message/login/", async_views.login, name="message-login"),
+        path("message/user_messages/", async_views.user_messages, name="message-user-messages"),
+        path("message/send_message/", async_views.send_message, name="message-send-message"),
+    ]
+
+urlpatterns.append(path("", include(router.urls)))
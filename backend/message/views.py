@@ -1,21 +1,155 @@
+import asyncio
+import json
+
 from rest_framework.viewsets import ViewSet
 from rest_framework.decorators import action
+from rest_framework.exceptions import Throttled
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
 from rest_framework import status
 
-from django.db.models import Q
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
 
-from .models import Message, USER_TYPE_CHOICES
-from .serializers import MessageSerializer
+from . import buffer, replicas, stats
+from .buffer import merge_pending, pending_rows
+from .cache import (
+    etag_matches, get_cached_history, history_etag, history_version,
+    invalidate_history, set_cached_history,
+)
+from .events import channel_for, get_broker, publish_messages
+from .export import FORMATS, ExportEncoder, aiter_export, export_querysets, parse_bound
+from .idempotency import MAX_KEY_LENGTH, KeyReused, request_hash, run_idempotent
+from .jobs import send_queued_message
+from . import metrics
+from .models import Conversation, Message, SenderRole, USER_TYPE_CHOICES
+from .pagination import KeysetPaginator, InvalidCursor
+from .replies import bot_reply
+from .search import search_messages
+from .renderers import FastJSONRenderer
+from .serializers import FastMessageSerializer, MessageSerializer
+from .throttling import (
+    OVERLOADED_MESSAGE, THROTTLED_MESSAGE, ActionRateThrottle, Overloaded,
+    limiter, retry_after,
+)
 from .utils import Verifier
 
 
 VALID_USERS = {user[0] for user in USER_TYPE_CHOICES}
+PAGINATION_PARAMS = {'after_id', 'after', 'before', 'page_size'}
+WRITE_ACTIONS = {'send_message', 'send_messages'}
+class HistoryPage:
+    """
+    Incremental sync and backwards paging for user_messages, shared by the
+    ViewSet and the async view; each runs the queries its own way.
+
+    ``after_id``/``after`` return only rows newer than what the client
+    already has, ``before`` pages back through older history; both are
+    capped by ``page_size``. ``pending`` rows (buffered writes) are
+    merged into whichever page they fall in.
+    """
+    def __init__(self, params, pending=()):
+        self.paginator = KeysetPaginator(params.get('page_size'))
+        self.pending = pending
+        self.forward = bool(params.get('after_id') or params.get('after'))
+        self.after_id = self.anchor = None
+        try:
+            if params.get('after_id'):
+                self.after_id = int(params['after_id'])
+            elif params.get('after'):
+                self.anchor = self.paginator.decode_cursor(params['after'])
+            elif params.get('before'):
+                self.anchor = self.paginator.decode_cursor(params['before'])
+        except ValueError as exc:
+            raise InvalidCursor(str(exc))
+
+    def position_query(self, queryset):
+        """``(created_at, id)`` of the ``after_id`` message, for ``set_position``"""
+        return queryset.filter(pk=self.after_id).values_list('created_at', 'id')
+
+    def set_position(self, anchor):
+        """Anchor on the ``after_id`` message, which may still be buffered"""
+        if anchor is None:
+            anchor = next(
+                ((row['created_at'], row['id'])
+                 for row in self.pending if row['id'] == self.after_id),
+                None
+            )
+        if anchor is None:
+            raise InvalidCursor(self.after_id)
+        self.anchor = anchor
+
+    def query(self, queryset):
+        if self.forward:
+            return self.paginator.after_query(queryset, *self.anchor)
+        return self.paginator.before_query(queryset, *(self.anchor or ()))
+
+    def data(self, rows):
+        """Response body for the ``rows`` that ``query()`` returned"""
+        paginator, anchor = self.paginator, self.anchor
+        if self.forward:
+            page = paginator.page(merge_pending(rows, self.pending, after=anchor))
+        else:
+            page = paginator.page(
+                merge_pending(rows, self.pending, descending=True, before=anchor),
+                descending=True
+            )
+
+        previous_cursor, next_cursor = paginator.cursors(page['results'])
+        if next_cursor is None and anchor is not None:
+            # Nothing new yet: hand the same position back for the next poll
+            next_cursor = paginator.encode_cursor(*anchor)
+
+        return {
+            "results": FastMessageSerializer.from_values(page['results']),
+            "has_more": page['has_more'],
+            "next_cursor": next_cursor,
+            "previous_cursor": previous_cursor,
+        }
+
+
+# The browsable API needs templates, which the API-only profile leaves out
+FAST_RENDERERS = [FastJSONRenderer, *([BrowsableAPIRenderer] if settings.TEMPLATES else [])]
 
 class MessageViewSet(ViewSet):
     serializer_class = MessageSerializer
     queryset = Message.objects.all()
-    
+    throttle_classes = [ActionRateThrottle]
+
+    def initial(self, request, *args, **kwargs):
+        # Rate limits are checked first: a throttled request never waits for a slot
+        super().initial(request, *args, **kwargs)
+        if not limiter.acquire():
+            raise Overloaded()
+        self._holds_slot = True
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if getattr(self, '_holds_slot', False):
+            self._holds_slot = False
+            limiter.release()
+        if self.action in WRITE_ACTIONS and status.is_success(response.status_code):
+            # Read this session's own writes from the primary for a while
+            replicas.stick_to_primary(request.session)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, Throttled):
+            wait = retry_after(exc.wait or 1)
+            return Response(
+                {"Erro": THROTTLED_MESSAGE.format(wait)},
+                status=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={'Retry-After': wait}
+            )
+        if isinstance(exc, Overloaded):
+            return Response(
+                {"Erro": OVERLOADED_MESSAGE},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': '1'}
+            )
+        return super().handle_exception(exc)
+
     @action(detail=False, methods=['post'])
     def login(self, request):
         user = request.data.get('user') or request.query_params.get('user')
@@ -36,7 +170,7 @@ class MessageViewSet(ViewSet):
         request.session.pop('active_user', None)
         return Response({"active_user": None, "message": "Logged out"})
 
-    @action(detail=False, methods=['get'])
+    @action(detail=False, methods=['get'], renderer_classes=FAST_RENDERERS)
     def user_messages(self, request):
         """Get messages only for the currently logged-in user"""
         active_user = request.session.get('active_user')
@@ -47,16 +181,147 @@ class MessageViewSet(ViewSet):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        # Filter messages: user's messages + bot responses to this user
-        user_messages_filtered = Message.objects.filter(
-            Q(user_sender=active_user) | 
-            Q(user_sender=f"Usuário: {active_user}")
+        # Writes still in this worker's buffer are invisible to the shared
+        # cache and to ETags other workers hand out, so they bypass both
+        pending = pending_rows(active_user)
+        etag = data = None
+        if not pending:
+            # An unchanged history answers 304 without touching the database
+            version = history_version(active_user)
+            etag = history_etag(active_user, version, request.query_params)
+            if etag_matches(request, etag):
+                return self._with_etag(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+            data = get_cached_history(etag)
+
+        if data is None:
+            try:
+                data, from_replica = replicas.read(
+                    request.session,
+                    lambda: self._history_data(request, active_user, pending),
+                    fallback_on=InvalidCursor
+                )
+            except InvalidCursor:
+                return Response(
+                    {"Erro": "Cursor de paginação inválido"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if from_replica:
+                # Possibly behind the version the ETag names: neither
+                # cached nor tagged, so only primary reads fill the cache
+                etag = None
+            if etag is not None:
+                set_cached_history(etag, data)
+
+        if etag is None:
+            return Response(data)
+        return self._with_etag(Response(data), etag)
+
+    @staticmethod
+    def _with_etag(response, etag):
+        response['ETag'] = etag
+        # Browsers must revalidate, which is what makes the 304 path useful
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
+    def _history_data(self, request, active_user, pending=()):
+        # The user's conversation holds their messages and the bot responses
+        user_messages_filtered = Message.objects.for_user(
+            active_user
         ).order_by('created_at')
-        
-        serializer = MessageSerializer(user_messages_filtered, many=True)
-        return Response(serializer.data)
 
-    @action(detail=False, methods=['post'])
+        if PAGINATION_PARAMS.isdisjoint(request.query_params):
+            if not pending:
+                return FastMessageSerializer.many(user_messages_filtered)
+            rows = list(user_messages_filtered.values(*FastMessageSerializer.attnames()))
+            return FastMessageSerializer.from_values(merge_pending(rows, pending))
+
+        queryset = user_messages_filtered.values(*FastMessageSerializer.attnames())
+        page = HistoryPage(request.query_params, pending)
+        if page.after_id is not None:
+            page.set_position(page.position_query(queryset).first())
+        return page.data(list(page.query(queryset)))
+
+    @action(detail=False, methods=['get'], renderer_classes=FAST_RENDERERS)
+    def search(self, request):
+        """Full-text search over the logged-in user's conversation, best match first"""
+        active_user = request.session.get('active_user')
+
+        if not active_user:
+            return Response(
+                {"Erro": "Usuário não está logado"},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+
+        query = (request.query_params.get('q') or '').strip()
+        if not query:
+            return Response(
+                {"Erro": "O parâmetro q é obrigatório"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        page_size = KeysetPaginator.clamp_page_size(request.query_params.get('page_size'))
+        try:
+            page = max(1, int(request.query_params.get('page', 1)))
+        except ValueError:
+            page = 1
+
+        # One extra row tells whether another page exists
+        (hits, rows), _ = replicas.read(
+            request.session,
+            lambda: self._search_rows(active_user, query, page_size + 1, (page - 1) * page_size)
+        )
+        has_more = len(hits) > page_size
+        hits = hits[:page_size]
+
+        ranks = [rank for pk, rank in hits if pk in rows]
+        results = FastMessageSerializer.from_values(
+            rows[pk] for pk, _ in hits if pk in rows
+        )
+        for result, rank in zip(results, ranks):
+            result['rank'] = rank
+
+        return Response({
+            "results": results,
+            "has_more": has_more,
+            "next_page": page + 1 if has_more else None,
+        })
+
+    @action(detail=False, methods=['get'], renderer_classes=FAST_RENDERERS)
+    def stats(self, request):
+        """
+        Message and bot reply counts per user type for the last ``hours``
+        hours, the last ``days`` days and all time, read from the rollups
+        in message/stats.py instead of counted
+        """
+        if not request.session.get('active_user'):
+            return Response(
+                {"Erro": "Usuário não está logado"},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+
+        hours = stats.clamp(
+            request.query_params.get('hours'), stats.DEFAULT_HOURS, stats.MAX_HOURS
+        )
+        days = stats.clamp(
+            request.query_params.get('days'), stats.DEFAULT_DAYS, stats.MAX_DAYS
+        )
+        data, _ = replicas.read(request.session, lambda: stats.summary(hours, days))
+        return Response(data)
+
+    @staticmethod
+    def _search_rows(active_user, query, limit, offset):
+        hits = search_messages(active_user, query, limit, offset)
+        rows = {
+            row['id']: row
+            for row in Message.objects.for_user(active_user).filter(
+                id__in=[pk for pk, _ in hits]
+            ).values(
+                *FastMessageSerializer.attnames()
+            )
+        }
+        return hits, rows
+
+    @action(detail=False, methods=['post'], renderer_classes=FAST_RENDERERS)
     def send_message(self, request):
         # Get user from session instead of request data for security
         active_user = request.session.get('active_user')
@@ -75,20 +340,309 @@ class MessageViewSet(ViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        user_msg = Message.objects.create(
-            user_sender=active_user, 
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            data, status_code = write_message(active_user, text)
+            return Response(data, status=status_code)
+
+        if not key.strip() or len(key) > MAX_KEY_LENGTH:
+            return Response({
+                "Erro": f"Idempotency-Key deve ter de 1 a {MAX_KEY_LENGTH} caracteres"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            data, status_code, replayed = run_idempotent(
+                active_user, key, request_hash(text.strip()),
+                lambda: write_message(active_user, text)
+            )
+        except KeyReused:
+            return Response({
+                "Erro": "Idempotency-Key já usada com outro texto"},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY
+            )
+
+        response = Response(data, status=status_code)
+        if replayed:
+            response['Idempotent-Replayed'] = 'true'
+        return response
+
+    @action(detail=False, methods=['post'], renderer_classes=FAST_RENDERERS)
+    def send_messages(self, request):
+        """
+        Send a batch of messages at once.
+
+        Every valid text gets its user/bot pair, and all rows are written by
+        a single bulk insert in one transaction. Invalid items are reported
+        by index in ``errors`` without failing the rest of the batch.
+        """
+        active_user = request.session.get('active_user')
+
+        if not active_user:
+            return Response({
+                "Erro": "Usuário não está logado"},
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+
+        if hasattr(request.data, 'getlist'):
+            texts = request.data.getlist('texts')
+        elif isinstance(request.data, dict):
+            texts = request.data.get('texts')
+        else:
+            texts = None
+
+        if not isinstance(texts, list) or not texts:
+            return Response({
+                "Erro": "O campo 'texts' deve ser uma lista de textos"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        max_size = settings.MESSAGE_BATCH_MAX_SIZE
+        if len(texts) > max_size:
+            return Response({
+                "Erro": f"O lote deve ter no máximo {max_size} mensagens"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        conversation = Conversation.objects.for_user(active_user)
+        rows, accepted, errors = [], [], []
+        for index, text in enumerate(texts):
+            if not isinstance(text, str) or not text.strip():
+                errors.append({"index": index, "Erro": "O texto é obrigatório"})
+                continue
+            accepted.append(index)
+            rows.append(Message(
+                conversation=conversation,
+                user_sender=active_user,
+                sender_role=SenderRole.USER,
+                user_text=text.strip()
+            ))
+            rows.append(Message(
+                conversation=conversation,
+                user_sender=active_user,
+                sender_role=SenderRole.BOT,
+                bot_text=bot_reply(active_user, text)
+            ))
+
+        if not rows:
+            return Response(
+                {"messages": [], "errors": errors},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        shard = conversation._state.db
+        with transaction.atomic(using=shard):
+            created = Message.objects.using(shard).bulk_create(rows)
+            stats.record(created, shard)
+            invalidate_history(active_user, using=shard)
+            data = [FastMessageSerializer.one(message) for message in created]
+            transaction.on_commit(lambda: publish_messages(active_user, *data), using=shard)
+
+        messages = [
+            {
+                "index": index,
+                "user_message": data[2 * position],
+                "bot_message": data[2 * position + 1],
+            }
+            for position, index in enumerate(accepted)
+        ]
+        return Response(
+            {"messages": messages, "errors": errors},
+            status=status.HTTP_201_CREATED
+        )
+
+
+def write_message(active_user, text):
+    """
+    Store a user message and its bot reply (or, in queue mode, the job that
+    will write it). Returns the response body and status code.
+    """
+    conversation = Conversation.objects.for_user(active_user)
+
+    if settings.MESSAGE_REPLY_MODE == 'queue':
+        # The reply is written and published by run_reply_worker, so the
+        # response carries ``bot_message: null`` and the job to follow
+        user_data, job = send_queued_message(conversation, active_user, text)
+        return {
+            "user_message": user_data,
+            "bot_message": None,
+            "reply_job": {"id": job.id, "status": job.status},
+        }, status.HTTP_202_ACCEPTED
+
+    if buffer.enabled():
+        # Durable in the spill file once accept() returns; inserted and
+        # published by the buffer's next flush
+        user_msg, bot_msg = buffer.get_buffer().accept([
+            Message(
+                conversation=conversation,
+                user_sender=active_user,
+                sender_role=SenderRole.USER,
+                user_text=text.strip(),
+                created_at=timezone.now()
+            ),
+            Message(
+                conversation=conversation,
+                user_sender=active_user,
+                sender_role=SenderRole.BOT,
+                bot_text=bot_reply(active_user, text),
+                created_at=timezone.now()
+            ),
+        ])
+        return {
+            "user_message": FastMessageSerializer.one(user_msg),
+            "bot_message": FastMessageSerializer.one(bot_msg),
+        }, status.HTTP_201_CREATED
+
+    shard = conversation._state.db
+    with transaction.atomic(using=shard):
+        # Created through the conversation so they land on its shard
+        user_msg = conversation.messages.create(
+            user_sender=active_user,
+            sender_role=SenderRole.USER,
             user_text=text.strip()
         )
-        
-        bot_sender = f"Usuário: {active_user}"
-        nome_exibicao = dict(USER_TYPE_CHOICES).get(active_user, active_user)
-        bot_text = f"Obrigado por seu contato, {nome_exibicao}. Em breve responderemos."
-        bot_msg = Message.objects.create(
-            user_sender=bot_sender, 
-            bot_text=bot_text
+
+        bot_msg = conversation.messages.create(
+            user_sender=active_user,
+            sender_role=SenderRole.BOT,
+            bot_text=bot_reply(active_user, text)
         )
+        stats.record([user_msg, bot_msg], shard)
 
-        return Response({
-            "user_message": MessageSerializer(user_msg).data,
-            "bot_message": MessageSerializer(bot_msg).data,
-        }, status=status.HTTP_201_CREATED)
+        invalidate_history(active_user, using=shard)
+        user_data = FastMessageSerializer.one(user_msg)
+        bot_data = FastMessageSerializer.one(bot_msg)
+        transaction.on_commit(
+            lambda: publish_messages(active_user, user_data, bot_data), using=shard
+        )
+
+    return {
+        "user_message": user_data,
+        "bot_message": bot_data,
+    }, status.HTTP_201_CREATED
+
+
+async def message_stream(request):
+    """
+    Server-Sent Events stream of the logged-in user's new messages.
+
+    Needs to be served through ASGI (configs/asgi.py) so the open connection
+    doesn't pin a worker thread. Reconnecting clients send ``Last-Event-ID``
+    and get everything they missed replayed before the live events.
+    """
+    active_user = await request.session.aget('active_user')
+
+    if not active_user:
+        return JsonResponse(
+            {"Erro": "Usuário não está logado"},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+
+    last_event_id = request.headers.get('Last-Event-ID') or \
+                    request.GET.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    response = StreamingHttpResponse(
+        _event_stream(active_user, last_event_id),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def message_export(request):
+    """
+    Streamed download of the logged-in user's history.
+
+    ``format`` is ndjson (default) or csv, ``since``/``until`` take ISO
+    dates or datetimes and ``compress=gzip`` gzips the stream on the fly.
+    """
+    active_user = await request.session.aget('active_user')
+
+    if not active_user:
+        return JsonResponse(
+            {"Erro": "Usuário não está logado"},
+            status=status.HTTP_401_UNAUTHORIZED
+        )
+
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return JsonResponse(
+            {"Erro": "Formato deve ser 'ndjson' ou 'csv'"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    try:
+        since = parse_bound(request.GET.get('since'))
+        until = parse_bound(request.GET.get('until'), end=True)
+    except ValueError:
+        return JsonResponse(
+            {"Erro": "Data inválida"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    compress = request.GET.get('compress') == 'gzip'
+    filename = f"mensagens-{active_user}.{fmt}" + ('.gz' if compress else '')
+    response = StreamingHttpResponse(
+        aiter_export(
+            export_querysets([active_user], since, until),
+            ExportEncoder(fmt, compress)
+        ),
+        content_type='application/gzip' if compress else FORMATS[fmt]
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+def _format_event(event):
+    return f"id: {event['id']}\nevent: message\ndata: {json.dumps(event)}\n\n"
+
+
+async def _event_stream(active_user, last_event_id):
+    keepalive = getattr(settings, 'MESSAGE_STREAM_KEEPALIVE', 15)
+    # Subscribe before the replay query so nothing committed in between is lost
+    subscription = get_broker().subscribe(channel_for(active_user))
+    try:
+        yield "retry: 3000\n\n"
+
+        if last_event_id is not None:
+            missed = Message.objects.for_user(active_user).filter(
+                id__gt=last_event_id
+            ).order_by('id')
+            async for message in missed:
+                event = FastMessageSerializer.one(message)
+                last_event_id = event['id']
+                yield _format_event(event)
+
+        while True:
+            try:
+                event = await asyncio.wait_for(anext(subscription), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            except StopAsyncIteration:
+                # The broker may have lost events: end the stream, so the
+                # client reconnects and replays from Last-Event-ID
+                return
+            if last_event_id is not None and event['id'] <= last_event_id:
+                continue
+            yield _format_event(event)
+    finally:
+        subscription.close()
+
+
+def metrics_view(request):
+    """Request metrics of every worker in the Prometheus text format"""
+    if not settings.MESSAGE_METRICS_ENABLED:
+        raise Http404
+    if not metrics.allowed(request):
+        return JsonResponse(
+            {"Erro": "Acesso às métricas não permitido"},
+            status=status.HTTP_403_FORBIDDEN
+        )
+    return HttpResponse(
+        metrics.render(metrics.registry.collect()),
+        content_type='text/plain; version=0.0.4; charset=utf-8'
+    )
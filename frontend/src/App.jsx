@@ -25,6 +25,27 @@ function App() {
     }
   }, [activeUser]);
 
+  useEffect(() => {
+    // Live updates over Server-Sent Events, when the browser supports them
+    if (!activeUser || typeof EventSource === 'undefined') return;
+
+    const source = new EventSource(`${API_BASE_URL}/message/stream/`, {
+      withCredentials: true
+    });
+    source.addEventListener('message', (event) => {
+      setMessages(prev => mergeMessages(prev, [JSON.parse(event.data)]));
+    });
+
+    return () => source.close();
+  }, [activeUser]);
+
+  const mergeMessages = (current, incoming) => {
+    // The stream and the send_message response can deliver the same message,
+    // and queued replies arrive later with bot_message still null
+    const known = new Set(current.map(message => message.id));
+    return [...current, ...incoming.filter(message => message && !known.has(message.id))];
+  };
+
   const checkSession = async () => {
     try {
       const sessionUser = localStorage.getItem('activeUser');
@@ -94,11 +115,10 @@ function App() {
         text: newMessage
       });
 
-      setMessages(prev => [
-        ...prev,
+      setMessages(prev => mergeMessages(prev, [
         response.data.user_message,
         response.data.bot_message
-      ]);
+      ]));
 
       setNewMessage('');
     } catch (err) {
@@ -118,20 +138,20 @@ function App() {
   };
 
   const getMessageType = (message) => {
-    if (message.user_sender === activeUser) {
-      return 'user-message';
-    } else if (message.user_sender.startsWith('Usuário: ')) {
+    if (message.sender_role === 'bot') {
       return 'bot-message';
+    } else if (message.user_sender === activeUser) {
+      return 'user-message';
     } else {
       return 'other-user-message';
     }
   };
 
   const getDisplayName = (message) => {
-    if (message.user_sender === activeUser) {
-      return 'You';
-    } else if (message.user_sender.startsWith('Usuário: ')) {
+    if (message.sender_role === 'bot') {
       return 'Bot';
+    } else if (message.user_sender === activeUser) {
+      return 'You';
     }
     return message.user_sender;
   };
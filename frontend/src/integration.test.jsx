@@ -41,13 +41,15 @@ describe('Integration Tests', () => {
           user_message: {
             id: 1,
             user_sender: 'B',
+            sender_role: 'user',
             user_text: 'Hello, I need help',
             bot_text: null,
             created_at: '2023-01-01T00:00:00Z'
           },
           bot_message: {
             id: 2,
-            user_sender: 'Usuário: B',
+            user_sender: 'B',
+            sender_role: 'bot',
             user_text: null,
             bot_text: 'Obrigado por seu contato, Usuário B. Em breve responderemos.',
             created_at: '2023-01-01T00:00:01Z'